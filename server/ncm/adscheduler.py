@@ -0,0 +1,167 @@
+#  Copyright 2011 Bill Glover
+#
+#  This file is part of Creare.
+#
+#  Creare is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Creare is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Creare.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Picks the advertisement to show on a page.
+#
+# Each instance keeps the shown ads and their remaining impressions in
+# memory and rotates through them with smooth weighted round-robin, so
+# choosing an ad costs no RPCs. Impressions served are counted locally
+# and reconciled with the sharded impression counters in one batch every
+# RECONCILE_INTERVAL seconds. The ad list itself is shared through
+# memcache and reloaded every REFRESH_INTERVAL seconds, which is also
+# when ads that have run out of impressions are taken out of rotation.
+#
+# Instances only learn about each other's impressions on refresh, so an
+# ad can overshoot its budget by what the instances serve in that time.
+#
+# Reconciling happens on the next ad request after RECONCILE_INTERVAL,
+# and on the /flush_counters cron for the instance that runs it. An
+# instance that goes idle holds its impressions until its next request,
+# and loses them (up to MAX_UNRECONCILED) if it is shut down first, so
+# an ad can also undercount by that much.
+#
+import logging
+import time
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import db
+
+import shardedcounter
+from model import Advertisement
+
+ADS_CACHE_KEY = 'adscheduler:ads'
+ADS_CACHE_TTL = 300
+REFRESH_INTERVAL = 60       # seconds before an instance reloads the ads
+RECONCILE_INTERVAL = 30     # seconds between impression write-backs
+MAX_UNRECONCILED = 500      # or sooner, if this many impressions are waiting
+
+PSA_WEIGHT = 1              # public service ads fill in between paid ones
+IMPRESSIONS_PER_WEIGHT = 1000
+MAX_WEIGHT = 10
+
+class _Slot(object):
+    """ One ad in an instance's rotation. """
+    def __init__(self, ad, image_key, remaining):
+        self.ad = ad
+        self.image_key = image_key
+        self.remaining = remaining
+        self.current = 0
+        if ad.PSA:
+            self.weight = PSA_WEIGHT
+        else:
+            self.weight = min(MAX_WEIGHT, 1 + remaining / IMPRESSIONS_PER_WEIGHT)
+
+_slots = []
+_loaded = 0
+_unreconciled = {} # ad key -> impressions not yet written back
+_last_reconcile = time.time()
+
+def _load_ads():
+    """ The shown ads with their image keys, through memcache. """
+    cached = memcache.get(ADS_CACHE_KEY)
+    if cached is not None:
+        return [(db.model_from_protobuf(entity_pb.EntityProto(pb)), image_key) for (pb, image_key) in cached]
+
+    ads = Advertisement.all().filter('show =', True).fetch(1000)
+    loaded = [(ad, str(ad.image)) for ad in ads]
+    memcache.set(ADS_CACHE_KEY,
+                 [(db.model_to_protobuf(ad).Encode(), image_key) for (ad, image_key) in loaded],
+                 time=ADS_CACHE_TTL)
+    return loaded
+
+def refresh():
+    """ Reload this instance's rotation and retire exhausted ads. """
+    global _slots, _loaded
+    reconcile()
+    loaded = _load_ads()
+    counts = shardedcounter.get_counts([str(ad.key()) for (ad, image_key) in loaded if not ad.PSA])
+
+    slots = []
+    exhausted = []
+    for (ad, image_key) in loaded:
+        remaining = 0
+        if not ad.PSA:
+            remaining = counts[str(ad.key())]
+            if remaining <= 0:
+                exhausted.append(ad)
+                continue
+        slots.append(_Slot(ad, image_key, remaining))
+
+    if exhausted:
+        for ad in exhausted:
+            ad.show = False
+        db.put(exhausted)
+        memcache.delete(ADS_CACHE_KEY)
+        logging.info('adscheduler: %d ads out of impressions' % len(exhausted))
+
+    _slots = slots
+    _loaded = time.time()
+
+def invalidate():
+    """ Call after changing an ad so this instance and the cache reload it. """
+    global _loaded
+    memcache.delete(ADS_CACHE_KEY)
+    _loaded = 0
+
+def reconcile():
+    """ Write the impressions served by this instance to the ad counters. """
+    global _unreconciled, _last_reconcile
+    served = _unreconciled
+    _unreconciled = {}
+    _last_reconcile = time.time()
+    if not served:
+        return
+    try:
+        shardedcounter.increment_multi(dict([(key, -count) for (key, count) in served.items()]))
+    except Exception, e:
+        logging.error('adscheduler: keeping %d impressions for the next reconcile (%s)' % (sum(served.values()), e))
+        for (key, count) in served.items():
+            _unreconciled[key] = _unreconciled.get(key, 0) + count
+
+def next_ad():
+    """
+    Choose the next ad to show and count the impression. Returns the
+    Advertisement with img set to its image URL, or None.
+    """
+    if time.time() - _loaded > REFRESH_INTERVAL:
+        refresh()
+
+    # smooth weighted round-robin: every slot gains its weight, the
+    # leader is shown and pays back the total
+    total = 0
+    chosen = None
+    for slot in _slots:
+        if not slot.ad.PSA and slot.remaining <= 0:
+            continue
+        slot.current += slot.weight
+        total += slot.weight
+        if chosen is None or slot.current > chosen.current:
+            chosen = slot
+    if chosen is None:
+        return None
+    chosen.current -= total
+
+    ad = chosen.ad
+    if not ad.PSA:
+        chosen.remaining -= 1
+        key = str(ad.key())
+        _unreconciled[key] = _unreconciled.get(key, 0) + 1
+        if time.time() - _last_reconcile > RECONCILE_INTERVAL or sum(_unreconciled.values()) >= MAX_UNRECONCILED:
+            reconcile()
+
+    ad.img = '/images/' + chosen.image_key
+    return ad
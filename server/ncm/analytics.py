@@ -0,0 +1,135 @@
+#  Copyright 2011 Bill Glover
+#
+#  This file is part of Creare.
+#
+#  Creare is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Creare is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Creare.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Time-bucketed analytics counters (product views, cart adds, ...).
+#
+# Every hit is counted in an hourly and a daily bucket, each of which is
+# a buffered sharded counter. Hits are first added up in a dict in the
+# instance and handed to shardedcounter in one batch, so a hit normally
+# costs no RPCs at all. The batch goes on the first hit after
+# FLUSH_INTERVAL seconds, or when MAX_PENDING_NAMES buckets have hits,
+# and on the /flush_counters cron for the instance that runs it. An idle
+# instance holds its hits until its next request, and loses them if it
+# is shut down first: up to MAX_PENDING_NAMES buckets' worth. That is
+# fine for popularity numbers. All buckets are in UTC.
+#
+import datetime
+import logging
+import time
+import shardedcounter
+
+FLUSH_INTERVAL = 30      # seconds between batches from an instance
+MAX_PENDING_NAMES = 200  # or sooner, if this many buckets have hits
+BUCKET_SHARDS = 2        # hits arrive in batches, so little contention
+
+HOUR = datetime.timedelta(hours=1)
+DAY = datetime.timedelta(days=1)
+
+_pending = {} # counter name -> (hits, bucket end)
+_last_flush = time.time()
+
+def _hour_bucket(when):
+    return when.replace(minute=0, second=0, microsecond=0)
+
+def _day_bucket(when):
+    return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def counter_name(metric, subject, bucket, length):
+    """ The sharded counter behind one bucket. """
+    if length == DAY:
+        return 'analytics:%s:%s:d%s' % (metric, subject, bucket.strftime('%Y%m%d'))
+    else:
+        return 'analytics:%s:%s:h%s' % (metric, subject, bucket.strftime('%Y%m%d%H'))
+
+def record(metric, subject, count=1, when=None):
+    """
+    Count a hit, e.g. record('view', str(product.key())).
+    Parameters:
+      metric - What happened
+      subject - What it happened to
+      count - How many times
+      when - A UTC datetime, defaults to now
+    """
+    if when is None:
+        when = datetime.datetime.utcnow()
+    for (bucket, length) in [(_hour_bucket(when), HOUR), (_day_bucket(when), DAY)]:
+        name = counter_name(metric, subject, bucket, length)
+        (hits, end) = _pending.get(name, (0, bucket + length))
+        _pending[name] = (hits + count, end)
+
+    if time.time() - _last_flush > FLUSH_INTERVAL or len(_pending) >= MAX_PENDING_NAMES:
+        flush()
+
+def flush():
+    """ Hand the hits collected in this instance to shardedcounter. """
+    global _pending, _last_flush
+    pending = _pending
+    _pending = {}
+    _last_flush = time.time()
+
+    by_end = {}
+    for (name, (hits, end)) in pending.items():
+        by_end.setdefault(end, {})[name] = hits
+    for (end, deltas) in by_end.items():
+        try:
+            shardedcounter.increment_multi(deltas, until=end, num_shards=BUCKET_SHARDS)
+        except Exception, e:
+            logging.error('analytics: keeping %d buckets for the next flush (%s)' % (len(deltas), e))
+            for (name, hits) in deltas.items():
+                more = _pending.get(name, (0, end))[0]
+                _pending[name] = (hits + more, end)
+
+def buckets(start, end):
+    """
+    The (bucket, length) pairs covering start (inclusive) to end
+    (exclusive), using whole days where they fit and hours elsewhere.
+    Both ends are rounded out to the hour.
+    """
+    result = []
+    t = _hour_bucket(start)
+    if _hour_bucket(end) < end:
+        end = _hour_bucket(end) + HOUR
+    while t < end:
+        if t == _day_bucket(t) and t + DAY <= end:
+            result.append((t, DAY))
+            t += DAY
+        else:
+            result.append((t, HOUR))
+            t += HOUR
+    return result
+
+def get_totals(metric, subjects, start, end):
+    """
+    Totals for several subjects over a window, read together.
+    Returns a dict of subject to total.
+    """
+    names = {}
+    for subject in subjects:
+        names[subject] = [counter_name(metric, subject, bucket, length) for (bucket, length) in buckets(start, end)]
+    all_names = []
+    for subject_names in names.values():
+        all_names.extend(subject_names)
+    counts = shardedcounter.get_counts(all_names)
+
+    totals = {}
+    for (subject, subject_names) in names.items():
+        totals[subject] = sum([counts[name] for name in subject_names])
+    return totals
+
+def get_total(metric, subject, start, end):
+    """ Total for one subject from start (inclusive) to end (exclusive). """
+    return get_totals(metric, [subject], start, end)[subject]
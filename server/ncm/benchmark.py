@@ -0,0 +1,305 @@
+# !/usr/bin/env python
+#  Copyright 2011 Bill Glover
+#
+#  This file is part of Creare.
+#
+#  Creare is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Creare is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Creare.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Micro-benchmarks for the hot paths of the site. These run inside the
+# app (dev_appserver or a deployed version) so they see the real
+# memcache and datastore. Visit /bench/<name> as an admin, the results
+# come back as plain text.
+#
+import os
+import datetime
+import time
+import random
+import urllib
+from StringIO import StringIO
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp import util
+from google.appengine.ext import db
+
+import gaesessions
+from gaesessions import get_current_session, SessionMiddleware
+from gaesessions import MemcacheDatastoreBackend, MemcacheBackend, InProcessBackend
+import rpcjson
+from model import ShoppingCartItem, Community, Maker, Product, CartTransaction, MakerTransaction
+
+BENCHMARK_COOKIE_KEY = 'benchmark-only-key-do-not-use-for-real-sessions-0123456789'
+
+def _cart_app(environ, start_response):
+    """ A stand-in for the RPC handlers: touches the cart the way they do. """
+    session = get_current_session()
+    action = environ['bench.action']
+    if action == 'end':
+        session.terminate()
+    elif action != 'view':
+        items = session.get('ShoppingCartItems', [])
+        product_key = environ['bench.product']
+        for item in items:
+            if item.product_key == product_key:
+                if action == 'add':
+                    item.count += 1
+                elif item.count > 1:
+                    item.count -= 1
+                else:
+                    items.remove(item)
+                break
+        else:
+            if action == 'add':
+                items.append(ShoppingCartItem(product_key=product_key, price=12.5, shipping=3.0, count=1))
+        session['ShoppingCartItems'] = items
+    else:
+        session.get('ShoppingCartItems', [])
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['']
+
+def _update_cookie_jar(jar, set_cookie):
+    """ Apply a Set-Cookie header the way a browser would. """
+    (name, value) = set_cookie.split(';')[0].strip().split('=', 1)
+    if value:
+        jar[name] = value
+    else:
+        jar.pop(name, None)
+
+def _cookie_header(jar):
+    return '; '.join(['%s=%s' % (name, jar[name]) for name in sorted(jar.keys())])
+
+def run_session_benchmark(backend, cookie_only_threshold, compress=True, shoppers=20, requests_per_shopper=25, catalog_size=40):
+    """
+    Drive SessionMiddleware with synthetic cart traffic: each shopper
+    mostly adds products, sometimes views or trims the cart. Returns a
+    dict of totals.
+    """
+    middleware = SessionMiddleware(_cart_app,
+                                   cookie_key=BENCHMARK_COOKIE_KEY,
+                                   cookie_only_threshold=cookie_only_threshold,
+                                   backend=backend,
+                                   compress=compress)
+    rng = random.Random(1138)
+    jars = [{} for i in xrange(shoppers)]
+    results = {'requests':0, 'seconds':0.0, 'upstream_bytes':0, 'downstream_bytes':0}
+    saved_cookie = os.environ.get('HTTP_COOKIE')
+    try:
+        for r in xrange(requests_per_shopper + 1):
+            for jar in jars:
+                if r == requests_per_shopper:
+                    action = 'end'
+                else:
+                    action = rng.choice(['add', 'add', 'add', 'view', 'view', 'remove'])
+                cookie = _cookie_header(jar)
+                os.environ['HTTP_COOKIE'] = cookie
+                environ = {'bench.action':action,
+                           'bench.product':'product%04d' % rng.randint(0, catalog_size - 1)}
+                headers = []
+                def start_response(status, response_headers, exc_info=None):
+                    headers.extend(response_headers)
+
+                start = time.time()
+                middleware(environ, start_response)
+                elapsed = time.time() - start
+
+                for (name, value) in headers:
+                    if name == 'Set-Cookie':
+                        _update_cookie_jar(jar, value)
+                        if action != 'end':
+                            results['downstream_bytes'] += len(value)
+                if action != 'end':
+                    results['requests'] += 1
+                    results['seconds'] += elapsed
+                    results['upstream_bytes'] += len(cookie)
+    finally:
+        if saved_cookie is None:
+            os.environ.pop('HTTP_COOKIE', None)
+        else:
+            os.environ['HTTP_COOKIE'] = saved_cookie
+    return results
+
+def session_configurations():
+    """ (name, backend, cookie_only_threshold, compress) for each setup we compare. """
+    return [
+        ('cookie-only', InProcessBackend(), gaesessions.DEFAULT_COOKIE_ONLY_THRESH, True),
+        ('cookie-only raw', InProcessBackend(), gaesessions.DEFAULT_COOKIE_ONLY_THRESH, False),
+        ('in-process', InProcessBackend(), 0, True),
+        ('memcache', MemcacheBackend(), 0, True),
+        ('memcache+datastore', MemcacheDatastoreBackend(), 0, True),
+        ]
+
+class SessionBenchmark(webapp.RequestHandler):
+    """ Compare session backends under synthetic cart traffic. """
+    def get(self):
+        shoppers = int(self.request.get('shoppers', '20'))
+        requests_per_shopper = int(self.request.get('requests', '25'))
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write('%-20s %10s %12s %14s %16s\n' % ('backend', 'requests', 'ms/request', 'cookie B/req', 'set-cookie B/req'))
+        for (name, backend, threshold, compress) in session_configurations():
+            results = run_session_benchmark(backend, threshold, compress, shoppers, requests_per_shopper)
+            n = max(results['requests'], 1)
+            self.response.out.write('%-20s %10d %12.3f %14d %16d\n' % (
+                    name,
+                    results['requests'],
+                    results['seconds'] * 1000.0 / n,
+                    results['upstream_bytes'] / n,
+                    results['downstream_bytes'] / n))
+
+def _checkout_fixture(num_makers=5, num_products=20):
+    """ Makers and products for the checkout benchmark, already put. """
+    makers = []
+    for i in xrange(num_makers):
+        makers.append(Maker(store_name='Benchmark Store #%d' % i,
+                            store_description='A benchmark store',
+                            full_name='Bench Maker%d' % i,
+                            email='bench%d@example.com' % i,
+                            paypal_business_account_email='bench%d@example.com' % i,
+                            phone_number='5551110000',
+                            location='Nowhere',
+                            mailing_address='1 Bench St',
+                            approval_status='Approved',
+                            tags=['benchmark']))
+    db.put(makers)
+    products = []
+    for i in xrange(num_products):
+        products.append(Product(maker=makers[i % num_makers],
+                                name='Benchmark Product #%d' % i,
+                                short_description='benchmark only',
+                                description='benchmark only',
+                                price=10.0 + i,
+                                shipping=2.0,
+                                tags=['benchmark'],
+                                show=False,
+                                inventory=1000))
+    db.put(products)
+    return (makers, products)
+
+def _checkout_per_item(items, community):
+    """ Checkout's datastore work the old way: a get per line, puts one by one. """
+    cart_transaction = CartTransaction(transaction_type='Sale')
+    cart_transaction.put()
+    maker_transactions = []
+    for item in items:
+        product = Product.get(item.product_key)
+        for maker_transaction in maker_transactions:
+            if maker_transaction.maker.key() == product.maker.key():
+                maker_transaction.detail.append(str(item.count))
+                break
+        else:
+            maker_transaction = MakerTransaction(parent=cart_transaction,
+                                                 maker=product.maker,
+                                                 email=product.maker.paypal_business_account_email,
+                                                 when_time=datetime.datetime.now())
+            maker_transaction.detail.append(str(item.count))
+            maker_transactions.append(maker_transaction)
+    # and createReceiverList fetched every product again
+    for item in items:
+        Product.get(item.product_key).maker.paypal_business_account_email
+    cart_transaction.put()
+    db.put(maker_transactions)
+    return [cart_transaction] + maker_transactions
+
+def _checkout_batched(items, community):
+    """ Checkout's datastore work as OrderProductsInCart does it now. """
+    products = ShoppingCartItem.loadProducts(items)
+    (cart_transaction, maker_transactions) = CartTransaction.createForCart(items, products, False)
+    ShoppingCartItem.createReceiverList(community=community, shopping_cart_items=items, products=products)
+    cart_transaction.transaction_status = 'CREATED'
+    db.put([cart_transaction] + maker_transactions)
+    return [cart_transaction] + maker_transactions
+
+class CheckoutBenchmark(webapp.RequestHandler):
+    """ Checkout latency against cart size, leaving out the call to Paypal. """
+    def get(self):
+        repeat = int(self.request.get('repeat', '5'))
+        community = Community(name='Benchmark')
+        (makers, products) = _checkout_fixture()
+        created = []
+        try:
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.out.write('%-10s %14s %14s\n' % ('lines', 'per-item ms', 'batched ms'))
+            for lines in [1, 2, 5, 10, 20]:
+                items = [ShoppingCartItem(product_key=str(product.key()), price=product.price,
+                                          shipping=product.shipping, count=1)
+                         for product in products[:lines]]
+                timings = []
+                for checkout in [_checkout_per_item, _checkout_batched]:
+                    start = time.time()
+                    for i in xrange(repeat):
+                        created.extend(checkout(items, community))
+                    timings.append((time.time() - start) * 1000.0 / repeat)
+                self.response.out.write('%-10d %14.1f %14.1f\n' % (lines, timings[0], timings[1]))
+        finally:
+            db.delete(created)
+            db.delete(products)
+            db.delete(makers)
+
+def _rpc_request(body, content_type):
+    request = webapp.Request.blank('/rpc/bench', environ={'REQUEST_METHOD':'POST'})
+    request.headers['Content-Type'] = content_type
+    request.body = body
+    return request
+
+def _activity_table(rows):
+    """ A GetMakerActivityTable sized result. """
+    sale = {'transaction':'agtuY20tYmVuY2htYXJrcg8LEg9NYWtlclRyYW5zYWN0aW9uGAEM',
+            'transaction_status':'Paid', 'date':'2011-06-14', 'shipped':False,
+            'shopper_name':'Bench Shopper', 'shopper_email':'shopper@example.com',
+            'shopper_phone':'5305551212', 'shopper_shipping':'1 Bench St</br>Nevada City, CA 95959',
+            'products':[{'product_name':'Benchmark thing %d' % i, 'items':i + 1} for i in range(3)],
+            'items':6, 'fee':'3.95', 'amount':'26.00', 'shipping':'4.00', 'net':'22.05'}
+    return {'sales':[sale] * rows, 'cursor':'E-ABAIICK2oMbmNtLWJlbmNobWFya3IPCxIPTWFrZXJUcmFuc2FjdGlvbhgBDBQ',
+            'total_sales':'390.00', 'total_items':90}
+
+class RPCBenchmark(webapp.RequestHandler):
+    """ RPC argument decoding and result encoding, without the method call. """
+    def get(self):
+        repeat = int(self.request.get('repeat', '1000'))
+        args = ['Bench Shopper', 'shopper@example.com', '5305551212', '1 Bench St\nNevada City, CA 95959']
+        form = urllib.urlencode([('arg%d' % i, rpcjson.simplejson.dumps(arg)) for (i, arg) in enumerate(args)])
+        body = rpcjson.simplejson.dumps(args)
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write('encoder: %s\n\n' % rpcjson.ENCODER)
+        self.response.out.write('%-24s %12s\n' % ('decode 4 args', 'us/request'))
+        for (name, data, content_type) in [('form fields', form, 'application/x-www-form-urlencoded'),
+                                           ('JSON body', body, rpcjson.JSON_CONTENT_TYPE)]:
+            start = time.time()
+            for i in xrange(repeat):
+                rpcjson.decode_args(_rpc_request(data, content_type))
+            self.response.out.write('%-24s %12.1f\n' % (name, (time.time() - start) * 1000000.0 / repeat))
+
+        self.response.out.write('\n%-24s %12s %12s %10s\n' % ('encode activity table', 'dumps us', 'stream us', 'bytes'))
+        for rows in [15, 100, 500]:
+            result = _activity_table(rows)
+            timings = []
+            for encode in [lambda out: rpcjson.write_result(result, out),
+                           lambda out: rpcjson.stream_result(result, out)]:
+                start = time.time()
+                for i in xrange(max(repeat / rows, 10)):
+                    out = StringIO()
+                    encode(out)
+                timings.append((time.time() - start) * 1000000.0 / max(repeat / rows, 10))
+            self.response.out.write('%-24s %12.1f %12.1f %10d\n' % ('%d rows' % rows, timings[0], timings[1], len(out.getvalue())))
+
+def main():
+    app = webapp.WSGIApplication([
+        ('/bench/sessions', SessionBenchmark),
+        ('/bench/checkout', CheckoutBenchmark),
+        ('/bench/rpc', RPCBenchmark),
+        ], debug=True)
+    # No session middleware here, the benchmarks install their own.
+    util.run_bare_wsgi_app(app)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+# !/usr/bin/env python
+#  Copyright 2011 Bill Glover
+#
+#  This file is part of Creare.
+#
+#  Creare is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Creare is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Creare.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Cron, every minute: write out buffered counters. The analytics hits
+# and ad impressions this instance has collected are handed over first,
+# so an instance that handles the cron never holds them for more than a
+# minute.
+#
+import logging
+import adscheduler
+import analytics
+import shardedcounter
+
+analytics.flush()
+adscheduler.reconcile()
+written = shardedcounter.flush()
+logging.info('flush_counters: wrote %d buffered counters' % written)
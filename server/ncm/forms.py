@@ -218,6 +218,7 @@ class ProductForm(djangoforms.ModelForm):
           'slug',
           'disable',
           'when',
+          'when_time',
           'tags',
           'primary_image',
           ]
@@ -8,6 +8,7 @@ import logging
 import pickle
 import os
 import time
+import zlib
 
 from google.appengine.api import memcache
 from google.appengine.ext import db
@@ -17,17 +18,20 @@ COOKIE_NAME_PREFIX = "DgU"  # identifies a cookie as being one used by gae-sessi
 COOKIE_PATH = "/"
 DEFAULT_COOKIE_ONLY_THRESH = 10240  # 10KB: GAE only allows ~16000B in HTTP header - leave ~6KB for other info
 DEFAULT_LIFETIME = datetime.timedelta(days=7)
+NO_SESSION_PATHS = ('/images/', '/static/')  # requests which never need the session
+COMPRESS_THRESH = 128  # don't bother compressing session data smaller than this
 
 # constants
 SID_LEN = 43  # timestamp (10 chars) + underscore + md5 (32 hex chars)
 SIG_LEN = 44  # base 64 encoded HMAC-SHA256
 MAX_COOKIE_LEN = 4096
-EXPIRE_COOKIE_FMT = ' %s=; expires=Wed, 01-Jan-1970 00:00:00 GMT; Path=' + COOKIE_PATH
-COOKIE_FMT = ' ' + COOKIE_NAME_PREFIX + '%02d="%s"; expires=%s; Path=' + COOKIE_PATH + '; HttpOnly'
+EXPIRE_COOKIE_FMT = ' %s=; expires=Wed, 01-Jan-1970 00:00:00 GMT; Path=%s'
+COOKIE_FMT = ' ' + COOKIE_NAME_PREFIX + '%02d="%s"; expires=%s; Path=%s; HttpOnly'
 COOKIE_FMT_SECURE = COOKIE_FMT + '; Secure'
 COOKIE_DATE_FMT = '%a, %d-%b-%Y %H:%M:%S GMT'
-COOKIE_OVERHEAD = len(COOKIE_FMT % (0, '', '')) + 29 + 150  # 29=date len, 150=safety margin (e.g., in case browser uses 4000 instead of 4096)
+COOKIE_OVERHEAD = len(COOKIE_FMT % (0, '', '', COOKIE_PATH)) + 29 + 150  # 29=date len, 150=safety margin (e.g., in case browser uses 4000 instead of 4096)
 MAX_DATA_PER_COOKIE = MAX_COOKIE_LEN - COOKIE_OVERHEAD
+COMPRESSED_MARKER = 'Z'  # prefixes zlib'd data; a pickle (protocol 2) always starts with '\x80'
 
 _current_session = None
 def get_current_session():
@@ -42,6 +46,100 @@ class SessionModel(db.Model):
     pickled dictionary which maps session variables to their values."""
     pdump = db.BlobProperty()
 
+class SessionBackend(object):
+    """Server-side storage for sessions which are too big (or are not allowed)
+    to live in a cookie.  Data is stored as the pickled string built by
+    ``Session`` and is keyed by session ID.
+
+    ``durable`` is False for changes made through ``pop_quick`` and
+    ``set_quick``; a backend with a slow persistent tier may skip that tier
+    for such writes.
+    """
+    def get(self, sid):
+        """Returns the pickled data stored for sid, or None if there is none."""
+        raise NotImplementedError()
+
+    def set(self, sid, pdump, expiration, durable=True):
+        """Stores pdump for sid until the UNIX timestamp ``expiration``."""
+        raise NotImplementedError()
+
+    def delete(self, sid):
+        """Removes any data stored for sid."""
+        raise NotImplementedError()
+
+class MemcacheBackend(SessionBackend):
+    """Keeps sessions in memcache only.  Writes are fast, but a session is
+    lost whenever memcache evicts it."""
+    def get(self, sid):
+        pdump = memcache.get(sid, namespace='')
+        if pdump is None:
+            logging.info("can't find session data in memcache for sid=%s (using memcache only sessions)" % sid)
+        return pdump
+
+    def set(self, sid, pdump, expiration, durable=True):
+        memcache.set(sid, pdump, namespace='', time=expiration)  # may fail if memcache is down
+
+    def delete(self, sid):
+        memcache.delete(sid, namespace='') # not really needed; it'll go away on its own
+
+class MemcacheDatastoreBackend(MemcacheBackend):
+    """Writes sessions through memcache to the datastore (``SessionModel``),
+    and goes to the datastore when memcache has lost a session.  This is the
+    default backend."""
+    @staticmethod
+    def db_key(sid):
+        return db.Key.from_path(SessionModel.kind(), sid, namespace='')
+
+    def get(self, sid):
+        pdump = memcache.get(sid, namespace='')
+        if pdump is None:
+            # memcache lost it, go to the datastore
+            session_model_instance = db.get(self.db_key(sid))
+            if session_model_instance:
+                pdump = session_model_instance.pdump
+            else:
+                logging.error("can't find session data in the datastore for sid=%s" % sid)
+        return pdump
+
+    def set(self, sid, pdump, expiration, durable=True):
+        MemcacheBackend.set(self, sid, pdump, expiration)
+        if not durable:
+            return
+        try:
+            SessionModel(key_name=sid, pdump=pdump).put()
+        except Exception, e:
+            logging.warning("unable to persist session to datastore for sid=%s (%s)" % (sid,e))
+
+    def delete(self, sid):
+        MemcacheBackend.delete(self, sid)
+        try:
+            db.delete(self.db_key(sid))
+        except:
+            pass # either it wasn't in the db (maybe cookie/memcache-only) or db is down => cron will expire it
+
+class InProcessBackend(SessionBackend):
+    """Keeps sessions in a dictionary in this process.  Nothing is shared
+    between instances, so this is only useful for tests and for measuring the
+    cost of the session machinery without any RPCs."""
+    def __init__(self):
+        self.store = {}
+
+    def get(self, sid):
+        entry = self.store.get(sid)
+        if entry is None:
+            return None
+        pdump, expiration = entry
+        if expiration and time.time() > expiration:
+            del self.store[sid]
+            return None
+        return pdump
+
+    def set(self, sid, pdump, expiration, durable=True):
+        self.store[sid] = (pdump, expiration)
+
+    def delete(self, sid):
+        self.store.pop(sid, None)
+
 class Session(object):
     """Manages loading, reading/writing key-value pairs, and saving of a session.
 
@@ -51,7 +149,8 @@ class Session(object):
     DIRTY_BUT_DONT_PERSIST_TO_DB = 1
 
     def __init__(self, sid=None, lifetime=DEFAULT_LIFETIME, no_datastore=False,
-                 cookie_only_threshold=DEFAULT_COOKIE_ONLY_THRESH, cookie_key=None):
+                 cookie_only_threshold=DEFAULT_COOKIE_ONLY_THRESH, cookie_key=None,
+                 backend=None, cookie_path=COOKIE_PATH, compress=True):
         self.sid = None
         self.cookie_keys = []
         self.cookie_data = None
@@ -62,6 +161,14 @@ class Session(object):
         self.no_datastore = no_datastore
         self.cookie_only_thresh = cookie_only_threshold
         self.base_key = cookie_key
+        self.cookie_path = cookie_path
+        self.compress = compress
+        if backend is None:
+            if no_datastore:
+                backend = MemcacheBackend()
+            else:
+                backend = MemcacheDatastoreBackend()
+        self.backend = backend
 
         if sid:
             self.__set_sid(sid, False)
@@ -109,17 +216,17 @@ class Session(object):
         """Returns a list of cookie headers to send (if any)."""
         # expire all cookies if the session has ended
         if not self.sid:
-            return [EXPIRE_COOKIE_FMT % k for k in self.cookie_keys]
+            return [EXPIRE_COOKIE_FMT % (k, self.cookie_path) for k in self.cookie_keys]
 
         if self.cookie_data is None:
             return []  # no cookie headers need to be sent
 
         # build the cookie header(s): includes sig, sid, and cookie_data
+        m = MAX_DATA_PER_COOKIE - (len(self.cookie_path) - len(COOKIE_PATH))
         if self.is_ssl_only():
-            m = MAX_DATA_PER_COOKIE - 8
+            m -= 8
             fmt = COOKIE_FMT_SECURE
         else:
-            m = MAX_DATA_PER_COOKIE
             fmt = COOKIE_FMT
         sig = Session.__compute_hmac(self.base_key, self.sid, self.cookie_data)
         cv = sig + self.sid + b64encode(self.cookie_data)
@@ -128,12 +235,12 @@ class Session(object):
             ed = datetime.datetime.fromtimestamp(self.get_expiration()).strftime(COOKIE_DATE_FMT)
         else:
             ed = 0
-        cookies = [fmt % (i, cv[i*m:i*m+m], ed) for i in xrange(num_cookies)]
+        cookies = [fmt % (i, cv[i*m:i*m+m], ed, self.cookie_path) for i in xrange(num_cookies)]
 
         # expire old cookies which aren't needed anymore
         old_cookies = xrange(num_cookies, len(self.cookie_keys))
         key = COOKIE_NAME_PREFIX + '%02d'
-        cookies_to_ax = [EXPIRE_COOKIE_FMT % (key % i) for i in old_cookies]
+        cookies_to_ax = [EXPIRE_COOKIE_FMT % (key % i, self.cookie_path) for i in old_cookies]
         return cookies + cookies_to_ax
 
     def is_active(self):
@@ -187,9 +294,23 @@ class Session(object):
                 eO[k] = v
         return pickle.dumps((eP,eO), 2)
 
+    @staticmethod
+    def __compress_data(pdump):
+        """Returns pdump zlib compressed and prefixed with COMPRESSED_MARKER,
+        or pdump itself if compressing it wouldn't make it any smaller."""
+        if len(pdump) < COMPRESS_THRESH:
+            return pdump
+        compressed = COMPRESSED_MARKER + zlib.compress(pdump)
+        if len(compressed) < len(pdump):
+            return compressed
+        return pdump
+
     @staticmethod
     def __decode_data(pdump):
-        """Returns a data dictionary after decoding it from "pickled+" form."""
+        """Returns a data dictionary after decoding it from "pickled+" form
+        (which may have been compressed)."""
+        if pdump[:1] == COMPRESSED_MARKER:
+            pdump = zlib.decompress(pdump[1:])
         eP, eO = pickle.loads(pdump)
         for k,v in eP.iteritems():
             eO[k] = db.model_from_protobuf(v)
@@ -247,39 +368,24 @@ class Session(object):
         if self.sid:
             self.__clear_data()
         self.sid = sid
-        self.db_key = db.Key.from_path(SessionModel.kind(), sid, namespace='')
 
         # set the cookie if requested
         if make_cookie:
             self.cookie_data = ''  # trigger the cookie to be sent
 
     def __clear_data(self):
-        """Deletes this session from memcache and the datastore."""
+        """Deletes this session from the backend."""
         if self.sid:
-            memcache.delete(self.sid, namespace='') # not really needed; it'll go away on its own
-            try:
-                db.delete(self.db_key)
-            except:
-                pass # either it wasn't in the db (maybe cookie/memcache-only) or db is down => cron will expire it
+            self.backend.delete(self.sid)
 
     def __retrieve_data(self):
         """Sets the data associated with this session after retrieving it from
-        memcache or the datastore.  Assumes self.sid is set.  Checks for session
-        expiration after getting the data."""
-        pdump = memcache.get(self.sid, namespace='')
+        the backend.  Assumes self.sid is set.  Checks for session expiration
+        after getting the data."""
+        pdump = self.backend.get(self.sid)
         if pdump is None:
-            # memcache lost it, go to the datastore
-            if self.no_datastore:
-                logging.info("can't find session data in memcache for sid=%s (using memcache only sessions)" % self.sid)
-                self.terminate(False) # we lost it; just kill the session
-                return
-            session_model_instance = db.get(self.db_key)
-            if session_model_instance:
-                pdump = session_model_instance.pdump
-            else:
-                logging.error("can't find session data in the datastore for sid=%s" % self.sid)
-                self.terminate(False) # we lost it; just kill the session
-                return
+            self.terminate(False) # we lost it; just kill the session
+            return
         self.data = self.__decode_data(pdump)
 
     def save(self, persist_even_if_using_cookie=False):
@@ -288,9 +394,8 @@ class Session(object):
         is called).
 
         If the data is small enough it will be sent back to the user in a cookie
-        instead of using memcache and the datastore.  If `persist_even_if_using_cookie`
-        evaluates to True, memcache and the datastore will also be used.  If the
-        no_datastore option is set, then the datastore will never be used.
+        instead of using the backend.  If `persist_even_if_using_cookie`
+        evaluates to True, the backend will also be used.
 
         Normally this method does not need to be called directly - a session is
         automatically saved at the end of the request if any changes were made.
@@ -304,8 +409,10 @@ class Session(object):
 
         # do the pickling ourselves b/c we need it for the datastore anyway
         pdump = self.__encode_data(self.data)
+        if self.compress:
+            pdump = self.__compress_data(pdump)
 
-        # persist via cookies if it is reasonably small
+        # persist via cookies if it is reasonably small (after compression)
         if len(pdump)*4/3 <= self.cookie_only_thresh: # 4/3 b/c base64 is ~33% bigger
             self.cookie_data = pdump
             if not persist_even_if_using_cookie:
@@ -314,15 +421,8 @@ class Session(object):
             # latest data will only be in the backend, so expire data cookies we set
             self.cookie_data = ''
 
-        memcache.set(self.sid, pdump, namespace='', time=self.get_expiration())  # may fail if memcache is down
-
-        # persist the session to the datastore
-        if dirty is Session.DIRTY_BUT_DONT_PERSIST_TO_DB or self.no_datastore:
-            return
-        try:
-            SessionModel(key_name=self.sid, pdump=pdump).put()
-        except Exception, e:
-            logging.warning("unable to persist session to datastore for sid=%s (%s)" % (self.sid,e))
+        durable = dirty is not Session.DIRTY_BUT_DONT_PERSIST_TO_DB
+        self.backend.set(self.sid, pdump, self.get_expiration(), durable)
 
     # Users may interact with the session through a dictionary-like interface.
     def clear(self):
@@ -422,13 +522,34 @@ class SessionMiddleware(object):
     ``cookie_only_threshold`` - A size in bytes.  If session data is less than this
     threshold, then session data is kept only in a secure cookie.  This avoids
     memcache/datastore latency which is critical for small sessions.  Larger
-    sessions are kept in memcache+datastore instead.  Defaults to 10KB.
+    sessions are kept in the backend instead.  Defaults to 10KB.
+
+    ``backend`` - A ``SessionBackend`` for sessions which don't fit in a cookie.
+    Defaults to ``MemcacheDatastoreBackend`` (or ``MemcacheBackend`` if
+    ``no_datastore`` is set).
+
+    ``cookie_path`` - The ``Path`` attribute of the session cookies.  Browsers
+    send a cookie with every request under its path, so an app whose pages
+    all live under a prefix should set it to keep the cookies off everything
+    else.  Defaults to "/".
+
+    ``no_session_paths`` - Request paths starting with one of these prefixes
+    never touch the session: the cookies aren't decoded and no cookies are
+    set.  Defaults to images and static files.
+
+    ``compress`` - Whether to zlib compress session data before it is signed
+    and stored.  The cookie-only threshold applies to the compressed size.
     """
-    def __init__(self, app, cookie_key, lifetime=DEFAULT_LIFETIME, no_datastore=False, cookie_only_threshold=DEFAULT_COOKIE_ONLY_THRESH):
+    def __init__(self, app, cookie_key, lifetime=DEFAULT_LIFETIME, no_datastore=False, cookie_only_threshold=DEFAULT_COOKIE_ONLY_THRESH, backend=None,
+                 cookie_path=COOKIE_PATH, no_session_paths=NO_SESSION_PATHS, compress=True):
         self.app = app
         self.lifetime = lifetime
         self.no_datastore = no_datastore
         self.cookie_only_thresh = cookie_only_threshold
+        self.backend = backend
+        self.cookie_path = cookie_path
+        self.no_session_paths = tuple(no_session_paths)
+        self.compress = compress
         self.cookie_key = cookie_key
         if not self.cookie_key:
             raise ValueError("cookie_key MUST be specified")
@@ -438,7 +559,11 @@ class SessionMiddleware(object):
     def __call__(self, environ, start_response):
         # initialize a session for the current user
         global _current_session
-        _current_session = Session(lifetime=self.lifetime, no_datastore=self.no_datastore, cookie_only_threshold=self.cookie_only_thresh, cookie_key=self.cookie_key)
+        if environ and self.no_session_paths and environ.get('PATH_INFO', '').startswith(self.no_session_paths):
+            _current_session = None
+            return self.app(environ, start_response)
+        _current_session = Session(lifetime=self.lifetime, no_datastore=self.no_datastore, cookie_only_threshold=self.cookie_only_thresh, cookie_key=self.cookie_key,
+                                   backend=self.backend, cookie_path=self.cookie_path, compress=self.compress)
 
         # create a hook for us to insert a cookie into the response headers
         def my_start_response(status, headers, exc_info=None):
@@ -23,26 +23,42 @@
 
 import logging
 import urllib
+from cgi import parse_qsl
+from google.appengine.api import taskqueue
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import util
 from google.appengine.ext import db
 from model import *
 from payment import *
+import reservation
+import salesrollup
+
+IPN_QUEUE = 'ipn'
+VERIFY_DEADLINE = 10
+
+# Statuses which need no work from us
+IGNORED_STATUSES = ['PENDING', 'PROCESSING', 'CREATED']
+
+# Entity groups one cross-group transaction may touch
+XG_GROUPS = 25
+XG_OPTIONS = db.create_transaction_options(xg=True)
 
 class IPNHandler(webapp.RequestHandler):
     """ Handle Paypal IPN updates """
 
     @staticmethod
     def update_cart_and_maker_transaction_record(cart_key, status, parameters):
-        """ We got paid or had an error make a note of it."""
+        """ We got paid or had an error make a note of it. Returns the
+        cart and its MakerTransactions, updated but not yet put, or None
+        if the cart already had this status. """
         cart = CartTransaction.get(cart_key)
+        if cart.transaction_status == status:
+            return None
         cart.transaction_status=status
-        cart.put()
 
         q = MakerTransaction.all()
         q.ancestor(cart)
         maker_transactions = q.fetch(6) # This can't be more than five according to paypal. Should it be a constant someplace?
-        num_maker_transactions = len(maker_transactions) # we should only get back as many as we sent
 
         maker_transaction_dict = {}
         for m in maker_transactions:
@@ -62,97 +78,108 @@ class IPNHandler(webapp.RequestHandler):
                 else:
                     m.status = 'Error'
                     m.messages = maker_status
-                m.put()
             i += 1
+        return (cart, maker_transactions)
 
     @staticmethod
-    def update_inventory(cart, status, parameters):
-        db.run_in_transaction(IPNHandler.update_cart_and_maker_transaction_record, cart.key(), status, parameters)
-    
-        # We have just touched the MakerTransactions above. Is there
-        # a way to just do this all once?
-        if status == 'COMPLETED':
-            transactions = MakerTransaction.all()
-            transactions.ancestor(cart)
-            for transaction in transactions:
-                for entry in transaction.detail:
-                    entry_fields = entry.split(':')
-                    if len(entry_fields) == 4:
-                        (product_key, items, amount, shipping) = entry_fields
-                    else:
-                        (product_key, items, amount) = entry_fields
-                    count = int(items)
-                    product = Product.get(product_key)                        
-                    db.run_in_transaction( Product.decrement_product_inventory, product.key(), count )
+    def products_sold(maker_transactions):
+        """ Add up the items sold per product key over a cart's details. """
+        sold = {}
+        for transaction in maker_transactions:
+            for entry in transaction.detail:
+                entry_fields = entry.split(':')
+                product_key = db.Key(entry_fields[0])
+                sold[product_key] = sold.get(product_key, 0) + int(entry_fields[1])
+        return sold
 
+    @staticmethod
+    def update_inventory(cart_key, status, parameters, response=None):
+        """
+        Record the IPN on the cart and, for a completed payment, take what
+        was sold out of inventory. The cart (with the response, if given)
+        and its first XG_GROUPS - 1 products are updated in one
+        cross-group transaction, so a normal cart settles in a single
+        commit. Any further products are listed on the cart and taken out
+        by finish_inventory. Returns True if this call changed the cart's
+        status, False if it already had it.
+        """
+        def settle():
+            updated = IPNHandler.update_cart_and_maker_transaction_record(cart_key, status, parameters)
+            if updated is None:
+                return False
+            (fresh, maker_transactions) = updated
+            sold = {}
+            if status == 'COMPLETED':
+                sold = IPNHandler.products_sold(maker_transactions)
+                salesrollup.queue_apply(cart_key)
+            first = dict(sold.items()[:XG_GROUPS - 1])
+            Product.decrement_product_inventories(first)
+            fresh.inventory_pending = ['%s:%d' % (product_key, count) for (product_key, count) in sold.items()[XG_GROUPS - 1:]]
+            entities = [fresh] + maker_transactions
+            if response:
+                entities.append(response)
+            db.put(entities)
+            return True
 
-    def ipn(self):
-        """ Handle IPN updates. """
-        community = Community.all().get()
-        if not community:
-            self.error(500)
-            logging.error('Failed to find Community while receiving a Paypal IPN: '+ str(self.request))
-            self.response.out.write("System not configured for Paypal IPN")
-            return
+        settled = db.run_in_transaction_options(XG_OPTIONS, settle)
+        # a retried task picks up here whether or not it settled the cart
+        IPNHandler.finish_inventory(cart_key)
+        return settled
 
-        if community.use_sandbox:
-            verification_url = SANDBOX_PP_URL
-            our_email = community.paypal_sandbox_email_address
-        else:
-            verification_url = PP_URL
-            our_email = community.paypal_email_address
+    @staticmethod
+    def finish_inventory(cart_key):
+        """
+        Take the products still listed on the cart out of inventory,
+        XG_GROUPS - 1 at a time, each batch with its removal from the
+        list. Then release the cart's holds, sold or not.
+        """
+        def take_batch():
+            cart = CartTransaction.get(cart_key)
+            batch = cart.inventory_pending[:XG_GROUPS - 1]
+            if not batch:
+                return False
+            sold = {}
+            for entry in batch:
+                (product_key, count) = entry.split(':')
+                sold[db.Key(product_key)] = int(count)
+            Product.decrement_product_inventories(sold)
+            cart.inventory_pending = cart.inventory_pending[len(batch):]
+            cart.put()
+            return True
 
-        parameters = None
+        while db.run_in_transaction_options(XG_OPTIONS, take_batch):
+            pass
+        reservation.release_cart(cart_key)
 
+    def ipn(self):
+        """ Store the IPN and queue it for processing, then acknowledge it. """
         status = self.request.get('status')
         
-        if status == 'PENDING' or status == 'PROCESSING' or status == 'CREATED':
+        if status in IGNORED_STATUSES:
             self.response.out.write('OK') # Nothing for us to do
             return
 
+        parameters = None
         if self.request.POST:
             parameters = self.request.POST.copy()
         if self.request.GET:
             parameters = self.request.GET.copy()
+        if not parameters:
+            self.response.out.write('OK')
+            return
 
-        # Check the IPN POST request came from real PayPal, 
-        # not from a fraudster.
-        if parameters:
-            parameters['cmd']='_notify-validate'
-            params = urllib.urlencode(parameters)
-            verification_status = urlfetch.fetch(
-                url = verification_url,
-                method = urlfetch.POST,  
-                payload = params,
-                ).content
-
-            if not verification_status == "VERIFIED":
-                self.response.out.write('Error. The request could not be verified, check for fraud.')
-                logging.error('UNVERIFIED IPN: ' + str(self.request));
-                return
-
-            if status == 'INCOMPLETE' or status == 'ERROR' or status == 'REVERSALERROR':
-                logging.error('ERROR: %s status reported by Paypal in IPN: request=%s' (status, str(self.request)))
-            elif status == 'COMPLETED':
-                # TBD
-                # much error handling and fraud checking
-                # email address, amounts, currency etc.
-                # sender_email = parameters['sender_email']
-
-                pay_key = parameters['pay_key']
-                q = CartTransaction.all()
-                q.filter('paypal_pay_key =', pay_key)
-                cart = q.get()
-                if not cart:
-                    logging.error('Unrecognized IPN: ' + pay_key + ': ' + (self.request))
-                    return
-                else:
-                    paypalPaymentResponse = PaypalPaymentResponse( parent=cart,
-                                                               response=str(parameters))
-                    paypalPaymentResponse.put();                    
-                    IPNHandler.update_inventory(cart, status, parameters)
-                    community.decrement_pending_score()
-
+        encoded = urllib.urlencode([(unicode(k).encode('utf-8'), unicode(v).encode('utf-8')) for (k, v) in parameters.items()])
+        def store():
+            ipn = PaypalIPN(parameters=encoded)
+            ipn.put()
+            taskqueue.add(queue_name=IPN_QUEUE,
+                          url='/ipn/process',
+                          params={'ipn':str(ipn.key()),
+                                  'pay_key':parameters.get('pay_key', ''),
+                                  'status':status},
+                          transactional=True)
+        db.run_in_transaction(store)
+        self.response.out.write('OK')
 
     def post(self):
         self.ipn()
@@ -160,6 +187,72 @@ class IPNHandler(webapp.RequestHandler):
     def get(self):
         self.ipn()
 
+class IPNWorker(webapp.RequestHandler):
+    """
+    Verify and process one stored IPN. Runs from the ipn task queue, so
+    raising makes the task retry. Each pay key and status is processed
+    once; later deliveries of it stop at the PaypalIPNProcessed get, and
+    a retry from before that marker was written doesn't settle the cart
+    again.
+    """
+    @staticmethod
+    def verify(community, parameters):
+        """ Ask Paypal whether it really sent this IPN. """
+        verification_url = community.ipn_verification_url
+        params = urllib.urlencode(parameters + [('cmd', '_notify-validate')])
+        response = urlfetch.fetch(url = verification_url,
+                                  method = urlfetch.POST,
+                                  payload = params,
+                                  deadline = VERIFY_DEADLINE)
+        if response.status_code != 200:
+            raise Exception('IPN verification returned HTTP %d' % response.status_code)
+        return response.content == "VERIFIED"
+
+    def post(self):
+        pay_key = self.request.get('pay_key')
+        status = self.request.get('status')
+        processed_key = PaypalIPNProcessed.key_for(pay_key, status)
+        (ipn, processed) = db.get([db.Key(self.request.get('ipn')), processed_key])
+        if processed:
+            logging.info('Duplicate IPN %s for %s' % (status, pay_key))
+            return
+        if not ipn:
+            logging.error('IPN task for a missing IPN: ' + self.request.get('ipn'))
+            return
+        parameters = parse_qsl(ipn.parameters)
+        fields = dict(parameters)
+
+        community = Community.all().get()
+        if not community:
+            logging.error('Failed to find Community while processing a Paypal IPN: ' + ipn.parameters)
+            raise Exception('System not configured for Paypal IPN')
+
+        # Check the IPN came from real PayPal, not from a fraudster.
+        if not IPNWorker.verify(community, parameters):
+            logging.error('UNVERIFIED IPN: ' + ipn.parameters)
+            return
+
+        if status == 'INCOMPLETE' or status == 'ERROR' or status == 'REVERSALERROR':
+            logging.error('ERROR: %s status reported by Paypal in IPN: %s' % (status, ipn.parameters))
+        elif status == 'COMPLETED':
+            # TBD
+            # much error handling and fraud checking
+            # email address, amounts, currency etc.
+            # sender_email = parameters['sender_email']
+
+            cart_key = PayKeyCart.get_cart_key(pay_key)
+            if not cart_key:
+                logging.error('Unrecognized IPN: %s: %s' % (pay_key, ipn.parameters))
+                return
+            else:
+                paypalPaymentResponse = PaypalPaymentResponse( parent=cart_key,
+                                                               source='IPN',
+                                                               response=str(fields))
+                if IPNHandler.update_inventory(cart_key, status, fields, paypalPaymentResponse):
+                    community.decrement_pending_score()
+
+        PaypalIPNProcessed(key=processed_key).put()
+
 class NotFoundErrorHandler(webapp.RequestHandler):
     """ A site root page """
     def handle(self):
@@ -175,6 +268,7 @@ class NotFoundErrorHandler(webapp.RequestHandler):
 def main():
     app = webapp.WSGIApplication([
         ('/ipn', IPNHandler),
+        ('/ipn/process', IPNWorker),
         (r'.*', NotFoundErrorHandler),
         ])
     util.run_wsgi_app(app)
@@ -0,0 +1,290 @@
+#  Copyright 2011 Bill Glover
+#
+#  This file is part of Creare.
+#
+#  Creare is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Creare is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Creare.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Walk every entity of a kind in task queue slices, for backfills and
+# other datastore maintenance too big for one request.
+#
+# Subclass Mapper, set KIND (and FILTERS, equality only), and have map()
+# return the entities to put and to delete for each entity. finish() is
+# called once, when the whole job is done. Then start
+# it from code with start(MyMapper, shards=4) or as an admin by POSTing
+# mapper=module.MyMapper&shards=4 to /mapper/start (GET it for a form).
+#
+# The kind's key space is split into shards which run concurrently.
+# Each shard works in slices of up to SLICE_SECONDS, writing its puts
+# and deletes in batches, then checkpoints its cursor and counts in its
+# MapperShard and queues the next slice in the same transaction. A
+# slice that fails is run again from the last checkpoint, so map()
+# must be safe to repeat. /mapper/status?job=<id> shows progress and
+# throughput as JSON.
+#
+import cgi
+import datetime
+import logging
+import time
+from django.utils import simplejson
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp import util
+
+MAPPER_QUEUE = 'mapper'
+BATCH_SIZE = 100
+SLICE_SECONDS = 20
+MAX_SHARDS = 32
+OVERSAMPLE = 32 # scatter samples per shard when splitting the key space
+
+class Mapper(object):
+    """ A job to run over every entity of KIND matching FILTERS. """
+    KIND = None
+    FILTERS = [] # (property, value) pairs
+
+    def map(self, entity):
+        """ Returns (entities to put, entities or keys to delete). """
+        return ([], [])
+
+    def finish(self, job):
+        """ Called once every shard of the job is done. """
+        pass
+
+    def query(self):
+        q = self.KIND.all()
+        for (name, value) in self.FILTERS:
+            q.filter('%s =' % name, value)
+        return q
+
+class MapperJob(db.Model):
+    """ One run of a mapper. key_name is the job id. """
+    mapper = db.StringProperty(required=True)
+    shards = db.IntegerProperty(required=True, default=1)
+    started = db.DateTimeProperty(auto_now_add=True)
+    finished = db.DateTimeProperty()
+
+    def get_shards(self):
+        return MapperShard.get_by_key_name([shard_name(self.key().name(), i) for i in range(self.shards)])
+
+    def progress(self):
+        """ Counts summed over the shards, and entities mapped per second. """
+        shards = [shard for shard in self.get_shards() if shard]
+        progress = {'job':self.key().name(),
+                    'mapper':self.mapper,
+                    'started':str(self.started),
+                    'finished':self.finished and str(self.finished) or None,
+                    'shards':len(shards),
+                    'shards_done':len([shard for shard in shards if shard.done]),
+                    'processed':sum([shard.processed for shard in shards]),
+                    'puts':sum([shard.puts for shard in shards]),
+                    'deletes':sum([shard.deletes for shard in shards])}
+        end = self.finished or datetime.datetime.now()
+        elapsed = (end - self.started).seconds + (end - self.started).days * 86400
+        progress['per_second'] = progress['processed'] / float(max(elapsed, 1))
+        return progress
+
+class MapperShard(db.Model):
+    """ A job's progress through one range of keys. key_name is job:number. """
+    job = db.StringProperty(required=True)
+    start_key = db.StringProperty()
+    end_key = db.StringProperty()
+    cursor = db.TextProperty()
+    slice = db.IntegerProperty(default=0)
+    processed = db.IntegerProperty(default=0)
+    puts = db.IntegerProperty(default=0)
+    deletes = db.IntegerProperty(default=0)
+    done = db.BooleanProperty(default=False)
+    updated = db.DateTimeProperty(auto_now=True)
+
+def shard_name(job_id, number):
+    return '%s:%d' % (job_id, number)
+
+def _load(path):
+    """ The Mapper subclass named by module.ClassName. """
+    (module_name, class_name) = path.rsplit('.', 1)
+    module = __import__(module_name, globals(), locals(), [class_name])
+    return getattr(module, class_name)
+
+def _split(mapper, shards):
+    """
+    Up to shards - 1 keys which split the mapper's kind into ranges of
+    about the same size, picked from a sample ordered by the datastore's
+    __scatter__ property. Fewer (or none) if the kind is small.
+    """
+    if shards < 2:
+        return []
+    q = db.Query(mapper.KIND, keys_only=True)
+    q.order('__scatter__')
+    sample = sorted(q.fetch(shards * OVERSAMPLE))
+    if len(sample) < shards:
+        return []
+    step = len(sample) / float(shards)
+    splits = []
+    for i in range(1, shards):
+        key = sample[int(i * step)]
+        if key not in splits:
+            splits.append(key)
+    return splits
+
+def start(mapper_class, shards=1):
+    """ Start a mapper job and return its id. """
+    path = '%s.%s' % (mapper_class.__module__, mapper_class.__name__)
+    splits = _split(mapper_class(), min(max(shards, 1), MAX_SHARDS))
+    bounds = [None] + splits + [None]
+    job_id = '%s-%d' % (mapper_class.__name__, int(time.time() * 1000))
+    job = MapperJob(key_name=job_id, mapper=path, shards=len(bounds) - 1)
+    entities = [job]
+    for i in range(len(bounds) - 1):
+        entities.append(MapperShard(key_name=shard_name(job_id, i),
+                                    job=job_id,
+                                    start_key=bounds[i] and str(bounds[i]) or None,
+                                    end_key=bounds[i + 1] and str(bounds[i + 1]) or None))
+    db.put(entities)
+    for i in range(len(bounds) - 1):
+        _queue_slice(job_id, i, 0)
+    logging.info('mapper: started %s with %d shards' % (job_id, len(bounds) - 1))
+    return job_id
+
+def _queue_slice(job_id, number, slice_number):
+    taskqueue.add(queue_name=MAPPER_QUEUE,
+                  url='/mapper/slice',
+                  params={'job':job_id, 'shard':number, 'slice':slice_number},
+                  transactional=db.is_in_transaction())
+
+def run_slice(job_id, number, slice_number):
+    """ Map one slice of a shard, then checkpoint it. """
+    job = MapperJob.get_by_key_name(job_id)
+    shard = MapperShard.get_by_key_name(shard_name(job_id, number))
+    if not job or not shard or shard.done or shard.slice != slice_number:
+        # finished, or a repeat of a slice that already checkpointed
+        return
+    mapper = _load(job.mapper)()
+
+    q = mapper.query()
+    if shard.start_key:
+        q.filter('__key__ >=', db.Key(shard.start_key))
+    if shard.end_key:
+        q.filter('__key__ <', db.Key(shard.end_key))
+    q.order('__key__')
+    if shard.cursor:
+        q.with_cursor(shard.cursor)
+
+    counts = {'processed':0, 'puts':0, 'deletes':0}
+    done = False
+    started = time.time()
+    while True:
+        entities = q.fetch(BATCH_SIZE)
+        to_put = []
+        to_delete = []
+        for entity in entities:
+            (puts, deletes) = mapper.map(entity)
+            to_put.extend(puts)
+            to_delete.extend(deletes)
+        db.put(to_put)
+        db.delete(to_delete)
+        counts['processed'] += len(entities)
+        counts['puts'] += len(to_put)
+        counts['deletes'] += len(to_delete)
+        cursor = q.cursor()
+        if len(entities) < BATCH_SIZE:
+            done = True
+            break
+        if time.time() - started >= SLICE_SECONDS:
+            break
+        q.with_cursor(cursor)
+
+    def txn():
+        fresh = MapperShard.get(shard.key())
+        if fresh.slice != slice_number:
+            return False
+        fresh.cursor = cursor
+        fresh.slice += 1
+        fresh.processed += counts['processed']
+        fresh.puts += counts['puts']
+        fresh.deletes += counts['deletes']
+        fresh.done = done
+        fresh.put()
+        if not done:
+            _queue_slice(job_id, number, fresh.slice)
+        return True
+    if db.run_in_transaction(txn) and done:
+        _finish(job)
+
+def _finish(job):
+    """ Mark the job finished once every shard is done. """
+    if [shard for shard in job.get_shards() if not shard.done]:
+        return
+    def txn():
+        fresh = MapperJob.get(job.key())
+        if fresh.finished:
+            return False
+        fresh.finished = datetime.datetime.now()
+        fresh.put()
+        return True
+    if db.run_in_transaction(txn):
+        _load(job.mapper)().finish(job)
+        logging.info('mapper: %s finished' % job.key().name())
+
+class StartMapper(webapp.RequestHandler):
+    """
+    Start the mapper named by mapper=module.ClassName. Only a POST starts
+    one, so a prefetch or a reload can't start it twice.
+    """
+    def get(self):
+        self.response.out.write("""<form method="post" action="/mapper/start">
+<p>Mapper (module.ClassName): <input type="text" name="mapper" value="%s"/></p>
+<p>Shards: <input type="text" name="shards" value="1"/></p>
+<p><input type="submit" value="Start"/></p>
+</form>""" % cgi.escape(self.request.get('mapper'), True))
+
+    def post(self):
+        try:
+            mapper_class = _load(self.request.get('mapper'))
+        except (ValueError, ImportError, AttributeError), e:
+            self.error(404)
+            self.response.out.write("I don't know that mapper: %s" % e)
+            return
+        job_id = start(mapper_class, int(self.request.get('shards') or 1))
+        self.redirect('/mapper/status?job=' + job_id)
+
+class MapperSlice(webapp.RequestHandler):
+    """ Task: run one slice of one shard. """
+    def post(self):
+        run_slice(self.request.get('job'), int(self.request.get('shard')), int(self.request.get('slice')))
+
+class MapperStatus(webapp.RequestHandler):
+    """ Progress of one job, or of the most recent ones. """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        job_id = self.request.get('job')
+        if job_id:
+            job = MapperJob.get_by_key_name(job_id)
+            if not job:
+                self.error(404)
+                return
+            self.response.out.write(simplejson.dumps(job.progress()))
+        else:
+            jobs = MapperJob.all().order('-started').fetch(10)
+            self.response.out.write(simplejson.dumps([job.progress() for job in jobs]))
+
+def main():
+    app = webapp.WSGIApplication([
+        ('/mapper/start', StartMapper),
+        ('/mapper/slice', MapperSlice),
+        ('/mapper/status', MapperStatus),
+        ])
+    util.run_wsgi_app(app)
+
+if __name__ == '__main__':
+    main()
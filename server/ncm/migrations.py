@@ -0,0 +1,81 @@
+#  Copyright 2011 Bill Glover
+#
+#  This file is part of Creare.
+#
+#  Creare is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Creare is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Creare.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Data migrations, run with the mapper by POSTing to /mapper/start, e.g.
+#
+#   mapper=migrations.ProductWhenTime
+#
+# The when_time backfills walk the whole kind: an entity without a
+# when_time isn't in its index, so filtering on when_time = None would
+# find nothing. Listings switch to when_time once a backfill finishes,
+# and new entities stop getting a when stamp then too. Once both
+# WhenTimeBackfill markers exist, take the 'when' indexes out of
+# index.yaml, deploy, and run appcfg.py vacuum_indexes to drop them.
+#
+import datetime
+import logging
+from mapper import Mapper
+from model import Product, MakerTransaction, WhenTimeBackfill
+
+def parse_when_stamp(stamp):
+    """
+    The datetime in an old "2011-06-14 09:30:00.123456|<md5>" sort stamp,
+    or None if it doesn't have one.
+    """
+    try:
+        value = stamp.split('|')[0]
+        microseconds = 0
+        if '.' in value:
+            (value, fraction) = value.split('.')
+            microseconds = int(fraction.ljust(6, '0')[:6])
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S').replace(microsecond=microseconds)
+    except (AttributeError, ValueError):
+        return None
+
+class ProductWhenTime(Mapper):
+    """ Fill in Product.when_time from the when stamp. """
+    KIND = Product
+
+    def map(self, product):
+        if product.when_time:
+            return ([], [])
+        product.when_time = parse_when_stamp(product.when)
+        if product.when_time is None:
+            logging.warning('migrations: no date in when stamp %r for product %s' % (product.when, product.key()))
+            product.when_time = datetime.datetime(2011, 1, 1)
+        return ([product], [])
+
+    def finish(self, job):
+        WhenTimeBackfill.mark_done('Product')
+
+class MakerTransactionWhenTime(Mapper):
+    """ Fill in MakerTransaction.when_time from the when stamp. """
+    KIND = MakerTransaction
+
+    def map(self, transaction):
+        if transaction.when_time:
+            return ([], [])
+        transaction.when_time = parse_when_stamp(transaction.when)
+        if transaction.when_time is None:
+            # when was required and always stamped, so this is rare enough
+            # not to fetch the cart for its timestamp
+            logging.warning('migrations: no date in when stamp %r for transaction %s' % (transaction.when, transaction.key()))
+            transaction.when_time = datetime.datetime(2011, 1, 1)
+        return ([transaction], [])
+
+    def finish(self, job):
+        WhenTimeBackfill.mark_done('MakerTransaction')
@@ -17,18 +17,22 @@
 #
 import re
 from unicodedata import normalize
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import db
 from gaesessions import get_current_session
 import logging
 import shardedcounter
 import hashlib
 import datetime as datetime_module
-from operator import attrgetter
 
 png_image_white_pixel = '\x89\x50\x4e\x47\x0d\x0a\x1a\x0a\x00\x00\x00\x0d\x49\x48\x44\x52\x00\x00\x00\x01\x00\x00\x00\x01\x08\x02\x00\x00\x00\x90\x77\x53\xde\x00\x00\x00\x01\x73\x52\x47\x42\x00\xae\xce\x1c\xe9\x00\x00\x00\x0c\x49\x44\x41\x54\x08\xd7\x63\xf8\xff\xff\x3f\x00\x05\xfe\x02\xfe\xdc\xcc\x59\xe7\x00\x00\x00\x00\x49\x45\x4e\x44\xae\x42\x60\x82'
 
 _default_categories = ['Unclassifiable', 'Bags & Totes', 'Jewelry', 'Clothing', 'Food', 'Furniture', 'Napkins & Linens & The Like', 'Soap & Skin Care', 'Pictures (Fine Art & Photographs)', 'Sculptures & Pottery', 'Toys & Games', 'Gears & Gadgets', 'Wellness & Therapeutic', 'Metalwork', 'Woodwork', 'Cards & Papercraft', 'Accessories', 'Baskets', 'Bears, Dolls & Miniatures']
 
+# Maker approval statuses, in the order the admin maker list shows them
+_maker_statuses = ['Review', 'Approved', 'Rejected_Location', 'Rejected_Other']
+
 _punct_re = re.compile(r'[\t !"#$%&\()*\-/<=>?@\[\\\]^_`{|},.]+')
 _word_re = re.compile('[\W]+')
 
@@ -111,6 +115,8 @@ class Community(db.Model):
     paypal_sandbox_api_password = db.StringProperty()
     paypal_sandbox_api_signature = db.StringProperty()
     paypal_sandbox_application_id = db.StringProperty()
+    # e.g. http://localhost:8090 to use server/tools/paypal_simulator.py
+    paypal_simulator_url = db.StringProperty(verbose_name="Paypal simulator URL (sandbox only)")
 
     # Live Stuff
     paypal_business_id = db.StringProperty()
@@ -167,6 +173,41 @@ class Community(db.Model):
         else:
             return self.paypal_application_id
 
+    @property
+    def simulator_url(self):
+        """ The Paypal simulator to use instead of the sandbox, if any. """
+        if self.use_sandbox and self.paypal_simulator_url:
+            return self.paypal_simulator_url.rstrip('/')
+        return None
+
+    @property
+    def pay_api_url(self):
+        if self.simulator_url:
+            return self.simulator_url + '/AdaptivePayments/Pay'
+        elif self.use_sandbox:
+            return 'https://svcs.sandbox.paypal.com/AdaptivePayments/Pay'
+        else:
+            return 'https://svcs.paypal.com/AdaptivePayments/Pay'
+
+    @property
+    def approval_url_template(self):
+        """ Where to send the shopper to approve a payment, less the pay key. """
+        if self.simulator_url:
+            return self.simulator_url + '/webscr?cmd=_ap-payment&paykey='
+        elif self.use_sandbox:
+            return 'https://www.sandbox.paypal.com/webscr?cmd=_ap-payment&paykey='
+        else:
+            return 'https://www.paypal.com/webscr?cmd=_ap-payment&paykey='
+
+    @property
+    def ipn_verification_url(self):
+        if self.simulator_url:
+            return self.simulator_url + '/cgi-bin/webscr'
+        elif self.use_sandbox:
+            return 'https://www.sandbox.paypal.com/cgi-bin/webscr'
+        else:
+            return 'https://www.paypal.com/cgi-bin/webscr'
+
     @property
     def photo(self):
         return Image.all(keys_only=True).filter('category =', 'Portrait').ancestor(self).get()
@@ -222,6 +263,11 @@ class Community(db.Model):
 
         return community
 
+    @property
+    def scores(self):
+        """ All three scores, read together. """
+        return shardedcounter.get_counts(['maker_score', 'product_score', 'pending_score'])
+
     @property
     def maker_score(self):
         return shardedcounter.get_count('maker_score')
@@ -235,16 +281,16 @@ class Community(db.Model):
         return shardedcounter.get_count('pending_score')
     
     def increment_maker_score(self):
-        shardedcounter.increment('maker_score', 1)
+        shardedcounter.increment('maker_score', 1, buffered=True)
 
     def increment_product_score(self):
-        shardedcounter.increment('product_score', 1)
+        shardedcounter.increment('product_score', 1, buffered=True)
 
     def increment_pending_score(self):
-        shardedcounter.increment('pending_score', 1)
+        shardedcounter.increment('pending_score', 1, buffered=True)
 
     def decrement_pending_score(self):
-        shardedcounter.decrement('pending_score')
+        shardedcounter.decrement('pending_score', buffered=True)
 
 class Page(db.Model):
     """ A miscellaneous content page like About, Privacy Policy, etc.  """
@@ -261,7 +307,7 @@ class Maker(db.Model):
     """ Someone who sells products  """
     user = db.UserProperty()
     joined = db.DateTimeProperty(auto_now_add=True)
-    approval_status = db.StringProperty(choices=set(['Review','Approved','Rejected_Location', 'Rejected_Other']), default='Review')
+    approval_status = db.StringProperty(choices=set(_maker_statuses), default='Review')
     community = db.ReferenceProperty(Community, collection_name='makers')
     store_name = db.StringProperty(required=True, verbose_name="Your store name")
     slug = db.StringProperty()
@@ -307,6 +353,59 @@ class Maker(db.Model):
     def get_slug_for_store_name(store_name):
         return slugify(store_name)
 
+    STATUSES = _maker_statuses
+
+    @staticmethod
+    def status_counter(status):
+        return 'makers:' + status
+
+    @staticmethod
+    def count_status_changes(deltas):
+        """ Adjust the per status maker counts by a dict of status to change. """
+        shardedcounter.increment_multi(dict([(Maker.status_counter(status), delta)
+                                             for (status, delta) in deltas.items()]))
+
+    @staticmethod
+    def get_status_counts():
+        """ The number of makers with each status as (status, count) pairs. """
+        names = [Maker.status_counter(status) for status in Maker.STATUSES]
+        counts = shardedcounter.get_counts(names)
+        return [(status, counts[name]) for (status, name) in zip(Maker.STATUSES, names)]
+
+    @staticmethod
+    def set_approval_statuses(keys, status):
+        """
+        Give several makers a new approval status with one batch get and
+        one batch put. Returns the makers which changed.
+        """
+        if status not in Maker.STATUSES:
+            raise db.BadValueError('Unknown approval status: %s' % status)
+        changed = []
+        deltas = {}
+        for maker in db.get(keys):
+            if maker and maker.approval_status != status:
+                deltas[maker.approval_status] = deltas.get(maker.approval_status, 0) - 1
+                deltas[status] = deltas.get(status, 0) + 1
+                maker.approval_status = status
+                changed.append(maker)
+        db.put(changed)
+        Maker.count_status_changes(deltas)
+        return changed
+
+    @staticmethod
+    def recount_statuses():
+        """ Correct the per status counts by counting the makers' keys. """
+        deltas = {}
+        for (status, count) in Maker.get_status_counts():
+            q = Maker.all(keys_only=True).filter('approval_status =', status)
+            keys = q.fetch(1000)
+            while keys:
+                count -= len(keys)
+                q.with_cursor(q.cursor())
+                keys = q.fetch(1000)
+            deltas[status] = -count
+        Maker.count_status_changes(deltas)
+
     @staticmethod
     def getMakerForUser(user):
         """ get the Maker if any associated with this user """
@@ -332,6 +431,46 @@ class Maker(db.Model):
                     logging.info("email: %s nickname: %s user_id: %s auth_domain: %s " % (str(user.email()), str(user.nickname()), str(user.user_id()), str(user.auth_domain())))
         return maker;
 
+def when_stamp(when_time, salt):
+    """
+    The old "<datetime>|<md5>" sort stamp. Only written while
+    WhenTimeBackfill.needs_stamp for the kind, after that when_time alone.
+    """
+    return "%s|%s" % (when_time, hashlib.md5(salt).hexdigest())
+
+class WhenTimeBackfill(db.Model):
+    """
+    Present once every entity of a kind has a when_time; key_name is the
+    kind. An entity without a when_time isn't in the when_time indexes,
+    so until then the kind is still listed by its when stamps.
+    """
+    finished = db.DateTimeProperty(auto_now_add=True)
+
+    @staticmethod
+    def cache_key(kind):
+        return 'when_time_backfill:%s' % kind
+
+    @staticmethod
+    def mark_done(kind):
+        WhenTimeBackfill(key_name=kind).put()
+        memcache.set(WhenTimeBackfill.cache_key(kind), True)
+
+    @staticmethod
+    def newest_first(kind):
+        """ The order for listing kind newest first. """
+        done = memcache.get(WhenTimeBackfill.cache_key(kind))
+        if done is None:
+            done = WhenTimeBackfill.get_by_key_name(kind) is not None
+            memcache.set(WhenTimeBackfill.cache_key(kind), done, time=60)
+        if done:
+            return '-when_time'
+        return '-when'
+
+    @staticmethod
+    def needs_stamp(kind):
+        """ True while new entities of kind still need a when stamp to be listed. """
+        return WhenTimeBackfill.newest_first(kind) == '-when'
+
 class Product(db.Model):
     """ Something a Maker can sell to a Shopper """
     maker = db.ReferenceProperty(Maker, collection_name='products')
@@ -347,7 +486,8 @@ class Product(db.Model):
     inventory = db.IntegerProperty(required=True, verbose_name="Number of items you have to sell", default=1)
     show = db.BooleanProperty(default=True, verbose_name="Show this item to shoppers")
     disable = db.BooleanProperty(default=False)
-    when = db.StringProperty()
+    when = db.StringProperty() # the old string sort stamp, see when_time
+    when_time = db.DateTimeProperty() # newest first; ties are ordered by key
     pickup_only = db.BooleanProperty(default=False, verbose_name="Pick-up only")
     category = db.StringProperty(choices=set(_default_categories), default=_default_categories[0], required=True)
     video_link = db.StringProperty(verbose_name="Embedded Video Link")
@@ -408,6 +548,22 @@ class Product(db.Model):
             product.inventory = 0
         product.put()
 
+    @staticmethod
+    def decrement_product_inventories(sold):
+        """
+        Take several products' sales out of inventory with one batch get
+        and one batch put. Run it in a (cross-group) transaction.
+        Parameters:
+          sold - A dict of product key to the number sold
+        """
+        keys = sold.keys()
+        products = [product for product in db.get(keys) if product]
+        for product in products:
+            product.inventory -= sold[product.key()]
+            if product.inventory < 0:
+                product.inventory = 0
+        db.put(products)
+
     @staticmethod
     def findProductsByTag(tag):
         """ Finds products by a single tag. """
@@ -437,14 +593,41 @@ class Product(db.Model):
         p.filter('disable = ', False)
         if category:
             p.filter('category = ', category)
-        p.order('-when')
+        p.order(WhenTimeBackfill.newest_first('Product'))
         return p.fetch(number_to_return, where_to_start)
     
+    @staticmethod
+    def findProductsForMaker(maker, number_to_return, cursor=None, for_shoppers=True):
+        """
+        One page of a maker's products, newest first. Shoppers only see
+        products which are shown and not disabled. Returns (products,
+        next_cursor), next_cursor being None on the last page. The maker
+        is set on each product so the grid doesn't fetch it again.
+        """
+        p = Product.all()
+        p.filter('maker =', maker)
+        if for_shoppers:
+            p.filter('show =', True)
+            p.filter('disable =', False)
+        p.order(WhenTimeBackfill.newest_first('Product'))
+        if cursor:
+            try:
+                p.with_cursor(cursor)
+            except (db.BadValueError, db.BadRequestError):
+                pass
+        products = p.fetch(number_to_return)
+        for product in products:
+            product.maker = maker
+        next_cursor = None
+        if len(products) == number_to_return:
+            next_cursor = p.cursor()
+        return (products, next_cursor)
+
     @staticmethod
     def getLatest(number_to_return):
         """ Get one item from the four stores with the most recent updates """
         stuff = Product.all()
-        stuff.order('-when')
+        stuff.order(WhenTimeBackfill.newest_first('Product'))
         latest = []
         makers = set([])
         count = 0;
@@ -457,26 +640,69 @@ class Product(db.Model):
                     break;
         return latest;
 
+class FeaturedSnapshot(db.Model):
+    """
+    The featured maker and their newest products, chosen by the
+    update_featured cron. key_name is the community's key. The entities
+    themselves are cached for CACHE_TTL so the home page usually reads
+    them with one memcache get, and otherwise with two datastore gets.
+    """
+    maker = db.ReferenceProperty(Maker, collection_name='featured_snapshots')
+    products = db.ListProperty(db.Key)
+    updated = db.DateTimeProperty(auto_now=True)
+
+    SIZE = 4
+    CACHE_TTL = 600
+
     @staticmethod
-    def getFeatured(number_to_return, community):
-        """ Get four products from the featured Maker """
-        if community.featured_maker:
-            maker = Maker.get(community.featured_maker)
-            stuff = maker.products 
-            products = []
-            count = 0
-            for product in stuff:
-                if product.show and not product.disable:
-                    products.append(product)
-            products = sorted(products, key=attrgetter('when'), reverse=True)[0:number_to_return]
-            return (maker, products)
-        else:
-            return (None, None)
+    def cache_key(community):
+        return 'featured:%s' % community.key()
+
+    @staticmethod
+    def take(community, maker, products):
+        """ Store a new featured maker and products, and prime the cache. """
+        snapshot = FeaturedSnapshot(key_name=str(community.key()),
+                                    maker=maker,
+                                    products=[product.key() for product in products])
+        snapshot.put()
+        FeaturedSnapshot.prime(community, maker, products)
+        return snapshot
+
+    @staticmethod
+    def prime(community, maker, products):
+        memcache.set(FeaturedSnapshot.cache_key(community),
+                     [db.model_to_protobuf(entity).Encode() for entity in [maker] + products],
+                     time=FeaturedSnapshot.CACHE_TTL)
 
     @staticmethod
-    def buildWhenStamp(maker):
-        """ Build a when stamp for sorting based on the Maker's key."""
-        return "%s|%s" % (datetime_module.datetime.now(), hashlib.md5(str(maker.key())).hexdigest())
+    def get_featured(community):
+        """ The featured (maker, products), or (None, None) if there isn't one. """
+        cached = memcache.get(FeaturedSnapshot.cache_key(community))
+        if cached:
+            entities = [db.model_from_protobuf(entity_pb.EntityProto(data)) for data in cached]
+            maker = entities[0]
+            products = entities[1:]
+        else:
+            snapshot = FeaturedSnapshot.get_by_key_name(str(community.key()))
+            if snapshot:
+                entities = db.get([FeaturedSnapshot.maker.get_value_for_datastore(snapshot)] + snapshot.products)
+                maker = entities[0]
+                products = [product for product in entities[1:] if product and product.show and not product.disable]
+            elif community.featured_maker:
+                # no snapshot until the cron first runs
+                maker = Maker.get(community.featured_maker)
+                products = []
+                if maker:
+                    (products, next_cursor) = Product.findProductsForMaker(maker, FeaturedSnapshot.SIZE)
+            else:
+                maker = None
+            if not maker:
+                return (None, None)
+            FeaturedSnapshot.prime(community, maker, products)
+
+        for product in products:
+            product.maker = maker
+        return (maker, products)
 
 class ShoppingCartItem():
     """ This is not a db.Model and does not persist! """
@@ -495,24 +721,54 @@ class ShoppingCartItem():
         return (self.price + self.shipping) * self.count
 
     @staticmethod
-    def createReceiverList(community, shopping_cart_items):
+    def loadProducts(shopping_cart_items):
+        """
+        Load the products in a cart and their makers with two batch gets.
+        Returns a dict of product key string to Product, with each maker
+        already resolved, leaving out products which no longer exist.
+        """
+        product_keys = []
+        for item in shopping_cart_items:
+            if item.product_key not in product_keys:
+                product_keys.append(item.product_key)
+        products = {}
+        for (product_key, product) in zip(product_keys, db.get(product_keys)):
+            if product:
+                products[product_key] = product
+
+        maker_keys = []
+        for product in products.values():
+            maker_key = Product.maker.get_value_for_datastore(product)
+            if maker_key not in maker_keys:
+                maker_keys.append(maker_key)
+        makers = dict(zip(maker_keys, db.get(maker_keys)))
+        for product in products.values():
+            # set the reference so product.maker doesn't fetch it again
+            product.maker = makers[Product.maker.get_value_for_datastore(product)]
+        return products
+
+    @staticmethod
+    def createReceiverList(community, shopping_cart_items, products=None):
         """
         Build a dict of recipients and amounts from a shopping cart. The dict contains
         one entry containing a tuple which in turn contains the payment id and amount
         for the primary recipient and one entry which is a list of tuples of payment ids
-        and amounts for all other recipients.
+        and amounts for all other recipients. Pass the result of loadProducts
+        as products if you have it.
         """
+        if products is None:
+            products = ShoppingCartItem.loadProducts(shopping_cart_items)
         total_amount = 0.0
         makers = {}
         for item in shopping_cart_items:
             subtotal = item.subtotal
             total_amount += subtotal
-            product = Product.get(item.product_key)
-            if product.maker.key() in makers:
-                (email, amount) = makers[product.maker.key()]
-                makers[product.maker.key()] = (email, amount + subtotal)
+            maker = products[item.product_key].maker
+            if maker.key() in makers:
+                (email, amount) = makers[maker.key()]
+                makers[maker.key()] = (email, amount + subtotal)
             else:
-                makers[product.maker.key()] = (product.maker.paypal_business_account_email, subtotal)
+                makers[maker.key()] = (maker.paypal_business_account_email, subtotal)
 
         combined_fee_factor = (community.fee_percentage + community.paypal_fee_percentage) * 0.01
         combined_fee_minimum = community.fee_minimum + community.paypal_fee_minimum
@@ -544,6 +800,76 @@ class CartTransaction(db.Model):
     shopper_shipping = db.PostalAddressProperty()
     note = db.StringProperty()
     transaction_history = db.TextProperty()
+    inventory_pending = db.StringListProperty() # product_key:count still to take out of inventory
+
+    @staticmethod
+    def createForCart(shopping_cart_items, products, local_pickup):
+        """
+        Build an unsaved CartTransaction, with its key already allocated,
+        and one MakerTransaction child per maker in the cart. Shipping is
+        zeroed on the items for makers who don't charge for local pickup.
+        Parameters:
+          shopping_cart_items - The cart
+          products - From ShoppingCartItem.loadProducts
+          local_pickup - True if the shopper will pick up the order
+        Returns (cart_transaction, maker_transactions)
+        """
+        cart_id = db.allocate_ids(db.Key.from_path('CartTransaction', 1), 1)[0]
+        cart_transaction = CartTransaction(key=db.Key.from_path('CartTransaction', cart_id),
+                                           transaction_type='Sale')
+
+        now = datetime_module.datetime.now()
+        stamped = WhenTimeBackfill.needs_stamp('MakerTransaction')
+        maker_transactions = {}
+        ordered = []
+        for item in shopping_cart_items:
+            product = products[item.product_key]
+            maker = product.maker
+            if local_pickup and maker.handling_charge_for_pickup is False:
+                item.shipping = 0.0
+
+            maker_transaction = maker_transactions.get(maker.key())
+            if maker_transaction is None:
+                maker_transaction = MakerTransaction(parent=cart_transaction.key(),
+                                                     maker=maker,
+                                                     email=maker.paypal_business_account_email,
+                                                     when=stamped and when_stamp(now, str(maker.key()) + str(cart_transaction.key())) or None,
+                                                     when_time=now)
+                maker_transactions[maker.key()] = maker_transaction
+                ordered.append(maker_transaction)
+
+            entry = "%s:%s:%s:%s" % (str(product.key()),
+                                     str(item.count),
+                                     str(item.price),
+                                     str(item.shipping))
+            maker_transaction.detail.append(entry)
+        return (cart_transaction, ordered)
+
+class PayKeyCart(db.Model):
+    """ Points a Paypal pay key at its CartTransaction, key_name is the pay key. """
+    cart = db.ReferenceProperty(CartTransaction, required=True)
+
+    @staticmethod
+    def get_cart_key(pay_key):
+        """
+        The key of the CartTransaction for a pay key, or None, with one
+        get. Carts from before there were PayKeyCarts are found with a
+        keys only query.
+        """
+        if not pay_key:
+            return None
+        mapping = PayKeyCart.get_by_key_name(pay_key)
+        if mapping:
+            return PayKeyCart.cart.get_value_for_datastore(mapping)
+        return CartTransaction.all(keys_only=True).filter('paypal_pay_key =', pay_key).get()
+
+    @staticmethod
+    def get_cart(pay_key):
+        """ The CartTransaction for a pay key, or None. """
+        cart_key = PayKeyCart.get_cart_key(pay_key)
+        if cart_key:
+            return db.get(cart_key)
+        return None
 
 class MakerTransaction(db.Model):
     """ Represents a single Maker's portion of a transaction. """
@@ -553,9 +879,11 @@ class MakerTransaction(db.Model):
     email = db.EmailProperty() #de-normalize for transactions in IPN handling
     detail = db.StringListProperty()
     shipped = db.BooleanProperty(required=True, default=False)
-    when = db.StringProperty(required=True)
+    when = db.StringProperty() # the old string sort stamp, see when_time
+    when_time = db.DateTimeProperty() # newest first; ties are ordered by key
     status = db.StringProperty(choices=set(['Pending', 'Paid', 'Error']), default='Pending', required=True)
     messages = db.StringProperty()
+    rolled_up = db.BooleanProperty(default=False) # counted in the maker's sales rollups
 
 # NewsItems, EventNotices and TipItems  are similar
 # but they are never logically managed together
@@ -645,8 +973,5 @@ class Advertisement(db.Model):
     def remaining_impressions(self):
         return shardedcounter.get_count(str(self.key()))
 
-    def decrement_impressions(self):
-        shardedcounter.decrement(str(self.key()))
-
     def refill_impressions(self, impressions):
         shardedcounter.increment(str(self.key()), impressions)
@@ -21,12 +21,14 @@ from google.appengine.dist import use_library
 use_library('django', '0.96')
 
 import logging
+import csv
+import time
 from datetime import datetime
-import hashlib
 import urllib
-from operator import attrgetter
+import uuid
 
-from django.utils import simplejson
+import rpcjson
+from rpcjson import simplejson
 
 from google.appengine.api import images
 from google.appengine.ext import webapp
@@ -43,6 +45,10 @@ from model import *
 from forms import *
 from payment import *
 from authentication import Authenticator
+import analytics
+import adscheduler
+import reservation
+import salesrollup
 
 template.register_template_library('common.catalog_tag')
 
@@ -50,6 +56,7 @@ template.register_template_library('common.catalog_tag')
 # some settings
 MAX_PRODUCT_IMAGE_HEIGHT=320
 MAX_PRODUCT_IMAGE_WIDTH=320
+CART_CACHE_TTL=300 # seconds a hydrated cart stays in memcache; bounds changes made outside the app
 
 
 # These two methods are from an article at
@@ -104,6 +111,17 @@ def add_base_values(template_values):
     template_values['cartItems'] = count
     return template_values;
 
+def cart_changed(session):
+    """ Give the session's cart a new version, so a cached copy of it isn't used. """
+    session['CartVersion'] = uuid.uuid4().hex
+
+def version_key(key):
+    return 'version:%s' % key
+
+def entity_changed(key):
+    """ Give a product or maker a new version, so cached carts holding it are rebuilt. """
+    memcache.set(version_key(key), uuid.uuid4().hex)
+
 def buildImageUploadForm(prompt="Upload Image: (PNG or JPG, %(height)sx%(width)s, less then 1MB)", name="img", height=MAX_PRODUCT_IMAGE_HEIGHT, width=MAX_PRODUCT_IMAGE_WIDTH, count=1):
     """ Build a form to upload images with a configurable prompt message. """
     new_prompt = prompt % {'height':height, 'width':width}
@@ -203,6 +221,7 @@ class MakerPage(webapp.RequestHandler):
             for tag in tags:
                 entity.tags.append(tag.strip().lower())
             entity.put()
+            Maker.count_status_changes({entity.approval_status:1})
             if photo:
                 Image( 
                     parent=entity, 
@@ -324,6 +343,7 @@ class EditMakerPage(webapp.RequestHandler):
                 for tag in tags:
                     entity.tags.append(tag.strip().lower())
                 entity.put()
+                entity_changed(entity.key())
                 if photo:
                     if maker.photo:
                         db.delete(maker.photo)
@@ -411,7 +431,9 @@ class ProductPage(webapp.RequestHandler):
                 entity = data.save(commit=False)
                 entity.maker = maker
                 entity.slug = Product.get_slug_for_name(entity.name)
-                entity.when = Product.buildWhenStamp(maker)
+                entity.when_time = datetime.now()
+                if WhenTimeBackfill.needs_stamp('Product'):
+                    entity.when = when_stamp(entity.when_time, str(maker.key()))
                 if entity.unique:
                     entity.inventory = 1
                 tags = self.request.get("tags").split(',')
@@ -536,6 +558,7 @@ class EditProductPage(webapp.RequestHandler):
                   temp_image.delete()
                   entity.primary_image = primary_image
               entity.put()
+              entity_changed(entity.key())
               self.redirect('/maker_dashboard/' + maker.slug)
           else:
               messages = []
@@ -572,6 +595,8 @@ class ViewProductPage(webapp.RequestHandler):
             self.response.out.write("I don't recognize that product.")
             return
 
+        analytics.record('view', str(product.key()))
+
         template_values = { 
             'title' : product.name,
             'store' : product.maker,
@@ -628,13 +653,7 @@ class CommunityHomePage(webapp.RequestHandler):
 
         session['community'] = community.slug
 
-        featured_maker = deserialize_entities(memcache.get("featured_maker"))
-        featured_products = deserialize_entities(memcache.get("featured_products"))
-        if not featured_maker:
-            (featured_maker, featured_products) = Product.getFeatured(4, community)
-            cache_map = { "featured_maker" : serialize_entities(featured_maker),
-                          "featured_products" : serialize_entities(featured_products)}
-            memcache.set_multi(cache_map, time=3600)
+        (featured_maker, featured_products) = FeaturedSnapshot.get_featured(community)
 
         template_values = { 
             'title': community.name,
@@ -669,53 +688,140 @@ class MakerDashboard(webapp.RequestHandler):
             self.redirect("/maker_store/" + maker_slug)
             return
         else:
-            q = db.Query(Advertisement)
-            q.filter('show =', True).order('last_shown')
-
-            ad = None
-            for a in q:
-                if a.PSA or a.remaining_impressions() > 0:
-                    ad = a
-                    break;
-                else:
-                    a.show = False
-                    a.put()
-
+            ad = adscheduler.next_ad()
             if ad:
-                if not ad.PSA:
-                    ad.decrement_impressions()
-                ad.put() # to update the last_shown
-                ad.img = '/images/' + str(ad.image)
                 ad.width = AdvertisementPage.photo_width
                 ad.height = AdvertisementPage.photo_height
 
-            products = maker.products
+            (products, next_cursor) = Product.findProductsForMaker(maker, MakerStorePage.page_size,
+                                                                  self.request.get('cursor'), for_shoppers=False)
             template_values = { 
                 'title':'Maker Dashboard',
                 'ad':ad,
                 'store':maker,
-                'products': sorted(products, key=attrgetter('when'), reverse=True),
+                'products':products,
+                'next_cursor':next_cursor,
                 }
             path = os.path.join(os.path.dirname(__file__), "templates/maker_dashboard.html")
             self.response.out.write(template.render(path, add_base_values(template_values)))
 
+class MakerSalesExport(webapp.RequestHandler):
+    """
+    A CSV of every transaction for a maker, one line per product sold.
+    Transactions are read EXPORT_PAGE at a time with a cursor and written
+    out page by page. If the export runs for EXPORT_SECONDS it stops at
+    a page boundary and its last line is a link to download the rest,
+    which is this export again with ?cursor= (without the header line).
+    The cursor is also in the X-Export-Next-Cursor header.
+    """
+    EXPORT_PAGE = 100
+    EXPORT_SECONDS = 20
+    COLUMNS = ['date', 'transaction', 'status', 'shipped', 'shopper_name', 'shopper_email',
+               'shopper_phone', 'shopper_shipping', 'product', 'items', 'price', 'shipping', 'total']
+    FORMULA_PREFIXES = ('=', '+', '-', '@') # spreadsheets run cells starting with these
+
+    def get(self, maker_slug):
+        authenticator = Authenticator(self)
+
+        try:
+            (user, maker) = authenticator.authenticate()
+        except:
+            # Return immediately
+            return
+
+        if not maker or not maker.slug == maker_slug:
+            self.error(403)
+            self.response.out.write("You do not have permission to export those sales.")
+            return
+
+        community = Community.get_current_community()
+        time_zone = community.timeZone
+        cursor = self.request.get('cursor')
+
+        q = db.Query(MakerTransaction)
+        q.filter('maker =', maker.key())
+        q.order(WhenTimeBackfill.newest_first('MakerTransaction'))
+        if cursor and not self.withCursor(q, cursor):
+            return
+
+        self.response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+        self.response.headers['Content-Disposition'] = 'attachment; filename="%s-sales.csv"' % str(maker.slug)
+        writer = csv.writer(self.response.out)
+        if not cursor:
+            writer.writerow(MakerSalesExport.COLUMNS)
+
+        started = time.time()
+        while True:
+            transactions = q.fetch(MakerSalesExport.EXPORT_PAGE)
+            if not transactions:
+                break
+            (carts, product_names) = _loadTransactionRowData(transactions)
+            for transaction in transactions:
+                MakerSalesExport.writeTransaction(writer, transaction, carts[transaction.parent_key()], product_names, time_zone)
+            if len(transactions) < MakerSalesExport.EXPORT_PAGE:
+                break
+            cursor = q.cursor()
+            if time.time() - started > MakerSalesExport.EXPORT_SECONDS:
+                self.response.headers['X-Export-Next-Cursor'] = str(cursor)
+                more = '%s%s?cursor=%s' % (self.request.host_url, self.request.path, urllib.quote(cursor))
+                writer.writerow(['More sales follow, download them from', more])
+                break
+            if not self.withCursor(q, cursor):
+                return
+
+    def withCursor(self, q, cursor):
+        """ Continue q from cursor, or answer 400 and return False if it's not one. """
+        try:
+            q.with_cursor(cursor)
+            return True
+        except (db.BadValueError, db.BadRequestError):
+            self.error(400)
+            self.response.out.write("Can't continue the export from there, please download it again.")
+            return False
+
+    @staticmethod
+    def csvCell(value):
+        """ A value as a UTF-8 CSV cell. Text that looks like a formula is quoted. """
+        if value is None:
+            value = ''
+        value = unicode(value)
+        if value.startswith(MakerSalesExport.FORMULA_PREFIXES):
+            value = "'" + value
+        return value.encode('utf-8')
+
+    @staticmethod
+    def writeTransaction(writer, transaction, cart, product_names, time_zone):
+        date = str(cart.timestamp.replace(tzinfo=Utc_tzinfo()).astimezone(time_zone).date())
+        for entry in transaction.detail:
+            entry_fields = entry.split(':')
+            if len(entry_fields) == 4:
+                (product_key, items, amount, shipping) = entry_fields
+            else:
+                (product_key, items, amount) = entry_fields
+                shipping = 0.0
+            total = (float(amount) + float(shipping)) * int(items)
+            row = [date, str(transaction.key()), transaction.status, transaction.shipped and "yes" or "no",
+                   cart.shopper_name, cart.shopper_email, cart.shopper_phone, cart.shopper_shipping,
+                   product_names[product_key], items, amount, shipping, "%.2f" % total]
+            writer.writerow([MakerSalesExport.csvCell(value) for value in row])
+
 class MakerStorePage(webapp.RequestHandler):
-    """ Renders a store page for a particular maker. """
+    """ Renders a store page for a particular maker, a page of products at a time. """
+    page_size = 24
+
     def get(self, maker_slug):
         maker = Maker.get_maker_for_slug(maker_slug)
-        products = []
-        if maker:
-            for product in maker.products:
-                if product.show and not product.disable:
-                    products.append(product)
-        else:
+        if not maker:
             write_error_page(self, "I don't recognize that store.")
             return
-        
+
+        (products, next_cursor) = Product.findProductsForMaker(maker, MakerStorePage.page_size,
+                                                              self.request.get('cursor'))
         template_values = { 
             'title':maker.store_name,
             'store':maker,
-            'products':sorted(products, key=attrgetter('when'), reverse=True),
+            'products':products,
+            'next_cursor':next_cursor,
             'user':users.get_current_user()
             }
         path = os.path.join(os.path.dirname(__file__), "templates/maker_store.html")
@@ -1209,6 +1315,7 @@ class AdvertisementPage(webapp.RequestHandler):
                 impressions = int(self.request.get("impressions"))
                 if impressions:
                     entity.refill_impressions(impressions)
+                adscheduler.invalidate()
                 self.redirect('/advertisement/'+entity.slug)
             else:
                 # Reprint the form
@@ -1270,6 +1377,7 @@ class EditAdvertisementPage(webapp.RequestHandler):
               impressions = int(self.request.get("impressions"))
               if impressions:
                   entity.refill_impressions(impressions)
+              adscheduler.invalidate()
               self.redirect('/advertisements')
           else:
               # Reprint the form
@@ -1318,7 +1426,9 @@ class ListAdvertisements(webapp.RequestHandler):
         self.response.out.write(template.render(path, add_base_values(template_values)))
 
 class ListMakers(webapp.RequestHandler):
-    """ List makers. """
+    """ List makers with a given approval status, a page at a time. """
+    page_size = 50
+
     def get(self):
         authenticator = Authenticator(self)
 
@@ -1331,22 +1441,42 @@ class ListMakers(webapp.RequestHandler):
         if not users.is_current_user_admin():
             self.error(403)
             self.response.out.write("You don't have permission to coordinate Makers.")
-            
+            return
+
         session = get_current_session()
         community = Community.get_current_community()
-        
+
         if not community:
             self.error(404)
             self.response.out.write("I don't recognize that community")
             return
 
-        makers = Maker.all()
-        makers.order('-joined')
+        status = self.request.get('status', 'Review')
+        q = Maker.all()
+        if status in Maker.STATUSES:
+            q.filter('approval_status =', status)
+        else:
+            status = 'All'
+        q.order('-joined')
 
-        template_values = { 
-            'title':'Makers', 
+        cursor = self.request.get('cursor')
+        if cursor:
+            try:
+                q.with_cursor(cursor)
+            except (db.BadValueError, db.BadRequestError):
+                cursor = None
+        makers = q.fetch(ListMakers.page_size)
+        next_cursor = None
+        if len(makers) == ListMakers.page_size:
+            next_cursor = q.cursor()
+
+        template_values = {
+            'title':'Makers',
             'makers':makers,
-            'statusList':Maker.approval_status.choices,
+            'status':status,
+            'statusCounts':Maker.get_status_counts(),
+            'statusList':Maker.STATUSES,
+            'next_cursor':next_cursor,
             }
         path = os.path.join(os.path.dirname(__file__), "templates/makers.html")
         self.response.out.write(template.render(path, add_base_values(template_values)))
@@ -1356,6 +1486,9 @@ class CompletePurchase(webapp.RequestHandler):
     def handle(self):
         if self.request.uri.count('cancel') > 0:
             Community.get_current_community().decrement_pending_score()
+            cart = PayKeyCart.get_cart(self.request.get('payKey'))
+            if cart and cart.transaction_status == 'CREATED':
+                reservation.release_cart(cart.key())
             message = "Checkout cancelled.";
         else:
             message = "Thank you for supporting local makers, crafters and artists.";
@@ -1385,54 +1518,156 @@ class RenderContentPage(webapp.RequestHandler):
         path = os.path.join(os.path.dirname(__file__), "templates/content_page.html")
         self.response.out.write(template.render(path, add_base_values(template_values)))
 
+class EntityCache:
+    """
+    Entities read while handling one request, so that several RPCs in a
+    batch fetch each of them only once.
+    """
+    def __init__(self):
+        self.entities = {}
+
+    def get(self, keys):
+        """ Like db.get for a list of keys, fetching only ones not already read. """
+        keys = [str(key) for key in keys]
+        missing = []
+        for key in keys:
+            if key not in self.entities and key not in missing:
+                missing.append(key)
+        if missing:
+            self.entities.update(zip(missing, db.get(missing)))
+        return [self.entities[key] for key in keys]
+
 class RPCHandler(webapp.RequestHandler):
     """ Allows the functions defined in the RPCMethods class to be RPCed."""
     def __init__(self):
         webapp.RequestHandler.__init__(self)
-        self.getMethods = RPCGetMethods()
-        self.postMethods = RPCPostMethods()
+        cache = EntityCache()
+        self.getMethods = RPCGetMethods(cache)
+        self.postMethods = RPCPostMethods(cache)
 
-    def handle(self, action, handlers):
-        func = None
+    def lookup(self, action, handlers):
+        """ The RPC method for action, or None. Private methods are never RPCed. """
+        if not action or action[0] == '_':
+            return None
+        return getattr(handlers, action, None)
 
-        if action:
-            if action[0] == '_':
-                self.error(403) # access denied
-                return
-            else:
-                func = getattr(handlers, action, None)
+    def handle(self, action, handlers):
+        if action and action[0] == '_':
+            self.error(403) # access denied
+            return
 
+        func = self.lookup(action, handlers)
         if not func:
             self.error(404) # file not found
             return
 
-        args = ()
-        while True:
-            key = 'arg%d' % len(args)
-            val = self.request.get(key)
-            if val:
-                args += (simplejson.loads(val),)
-            else:
-                break
+        try:
+            args = rpcjson.decode_args(self.request)
+        except ValueError:
+            self.error(400) # bad request
+            return
 
         result = func(self.request, *args)
-        self.response.out.write(simplejson.dumps(result))
+        rpcjson.write_result(result, self.response.out)
 
     def get(self, action):
         self.handle(action, self.getMethods)
 
     def post(self, action):
         self.handle(action, self.postMethods)
-   
 
-def _buildTransactionRow(community, transaction, fee_percentage, fee_minimum):
-    """ Put together information for a single row in the maker activity table  """
+class RPCBatchHandler(RPCHandler):
+    """
+    Runs several RPCs in order in one request, sharing the session and
+    the entity cache. Post a JSON list of up to MAX_BATCH_CALLS [method,
+    [args]] pairs, as the body or in the calls field; the response is the
+    JSON list of their results. A batch isn't atomic: a call that fails
+    gets an alert as its result, and the calls around it still run.
+    """
+    MAX_BATCH_CALLS = 10
+
+    def post(self):
+        try:
+            if rpcjson.is_json_body(self.request):
+                calls = simplejson.loads(self.request.body)
+            else:
+                calls = simplejson.loads(self.request.get('calls'))
+        except ValueError:
+            self.error(400)
+            return
+        if not RPCBatchHandler.valid_calls(calls):
+            self.error(400)
+            self.response.out.write("Post a list of [method, [args]] pairs.")
+            return
+        if len(calls) > RPCBatchHandler.MAX_BATCH_CALLS:
+            self.error(400)
+            self.response.out.write("Send at most %d calls at a time." % RPCBatchHandler.MAX_BATCH_CALLS)
+            return
+
+        results = []
+        for (action, args) in calls:
+            func = self.lookup(action, self.postMethods) or self.lookup(action, self.getMethods)
+            if func:
+                try:
+                    results.append(func(self.request, *args))
+                except Exception, e:
+                    logging.exception('Batch RPC %s failed' % action)
+                    results.append({"alert1":"Sorry, %s didn't work, please try again." % action})
+            else:
+                results.append({"alert1":"I don't know how to %s" % action})
+        rpcjson.write_result(results, self.response.out)
+
+    @staticmethod
+    def valid_calls(calls):
+        """ True if calls is a list of [method name, [args]] pairs. """
+        if not isinstance(calls, list):
+            return False
+        for call in calls:
+            if not isinstance(call, list) or len(call) != 2:
+                return False
+            if not isinstance(call[0], basestring) or not isinstance(call[1], list):
+                return False
+        return True
+
+def _loadTransactionRowData(transactions):
+    """
+    Fetch what _buildTransactionRow needs for several transactions with
+    two batch gets. Returns (carts, product_names), a dict of cart key to
+    CartTransaction and one of product key string to product name.
+    """
+    cart_keys = []
+    product_keys = []
+    for transaction in transactions:
+        if transaction.parent_key() not in cart_keys:
+            cart_keys.append(transaction.parent_key())
+        for entry in transaction.detail:
+            product_key = entry.split(':')[0]
+            if product_key not in product_keys:
+                product_keys.append(product_key)
+
+    carts = dict(zip(cart_keys, db.get(cart_keys)))
+    product_names = {}
+    for (product_key, product) in zip(product_keys, db.get(product_keys)):
+        if product:
+            product_names[product_key] = product.name
+        else:
+            product_names[product_key] = 'Deleted product'
+    return (carts, product_names)
+
+def _buildTransactionRow(community, transaction, fee_percentage, fee_minimum, cart=None, product_names=None, time_zone=None):
+    """
+    Put together information for a single row in the maker activity table.
+    When building many rows pass the cart and product names from
+    _loadTransactionRowData and one time_zone, otherwise they are fetched.
+    """
     sale = {}
-    cart = transaction.parent()
+    if cart is None:
+        cart = transaction.parent()
+    if time_zone is None:
+        time_zone = community.timeZone
     sale['transaction'] = str(transaction.key())
     sale['transaction_status'] = transaction.status
-    sale['when'] = transaction.when
-    sale['date'] = str(cart.timestamp.replace(tzinfo=Utc_tzinfo()).astimezone(community.timeZone).date())
+    sale['date'] = str(cart.timestamp.replace(tzinfo=Utc_tzinfo()).astimezone(time_zone).date())
     sale['shipped'] = transaction.shipped        
     sale['shopper_name'] = cart.shopper_name
     sale['shopper_email'] = cart.shopper_email
@@ -1458,7 +1693,10 @@ def _buildTransactionRow(community, transaction, fee_percentage, fee_minimum):
         sale_items += product_items
         sale_amount += product_amount * product_items
         sale_shipping += float(shipping) * product_items
-        product['product_name'] = Product.get(product_key).name
+        if product_names is None:
+            product['product_name'] = Product.get(product_key).name
+        else:
+            product['product_name'] = product_names[product_key]
         product['items'] = product_items
         products.append(product)
 
@@ -1477,18 +1715,54 @@ class RPCGetMethods:
     """ Defines the methods that can be RPCed.
     NOTE: Do not allow remote callers access to private/protected "_*" methods.
     """
+    def __init__(self, cache=None):
+        self.cache = cache or EntityCache()
+
     def GetShoppingCart(self, request, *args):
-        """ Returns the items currently in the shopping cart. """
+        """
+        Returns the items currently in the shopping cart. The products,
+        and for local pickup their makers, are read with one batch get
+        each. The result is cached by cart version, along with the
+        versions of the products and makers it was built from, and used
+        until the cart or one of those changes.
+        """
         session = get_current_session()
-        results = {}
+        version = session.get('CartVersion')
         items = session.get('ShoppingCartItems', [])
+        read = [version_key(item.product_key) for item in items]
+        current = {}
+        if version:
+            current = memcache.get_multi(['cart:' + version] + read)
+            entry = current.get('cart:' + version)
+            if entry is not None:
+                missing = [key for key in entry['versions'] if key not in read]
+                if missing:
+                    current.update(memcache.get_multi(missing))
+                    read += missing
+                if [key for key in entry['versions'] if current.get(key) != entry['versions'][key]] == []:
+                    return entry['results']
+
         delivery_option = session.get('DeliveryOption', "")
+        found = dict(zip([item.product_key for item in items],
+                         self.cache.get([item.product_key for item in items])))
+        makers = {}
+        if delivery_option == 'local':
+            maker_keys = [Product.maker.get_value_for_datastore(product) for product in found.values() if product]
+            if version:
+                # read before the makers are, so a change meanwhile isn't missed
+                missing = [version_key(key) for key in maker_keys if version_key(key) not in read]
+                if missing:
+                    current.update(memcache.get_multi(missing))
+                    read += missing
+            makers = dict(zip(maker_keys, self.cache.get(maker_keys)))
+
         products = []
         amount = 0.0
         for item in items:
-            product = Product.get(item.product_key)
+            product = found[item.product_key]
             if product:
-                if delivery_option == 'local' and product.maker.handling_charge_for_pickup is False:
+                maker = makers.get(Product.maker.get_value_for_datastore(product))
+                if maker and maker.handling_charge_for_pickup is False:
                     item.shipping = 0.0
                 p = { "count": str(item.count),
                       "name": product.name,
@@ -1503,6 +1777,11 @@ class RPCGetMethods:
                 amount += item.subtotal
             
         results = {'products':products, 'amount':"%.2f" % amount}
+        if version:
+            # every version here was read before its entity was
+            keys = [version_key(key) for key in found.keys() + makers.keys()]
+            versions = dict([(key, current.get(key)) for key in keys])
+            memcache.set('cart:' + version, {'results':results, 'versions':versions}, time=CART_CACHE_TTL)
         return results
 
     def GetMakerActivityTable(self, request, *args):
@@ -1519,15 +1798,16 @@ class RPCGetMethods:
         direction = args[2]
         q = db.Query(MakerTransaction)
         q.filter('maker =', maker.key())
-        
-        if cursor and cursor != '':
-            if direction and direction == 'older':
-                q.order('-when')
-                q.filter('when <', cursor)
-        else:
-            q.order('-when')
+        q.filter('status =', 'Paid')
+        q.order(WhenTimeBackfill.newest_first('MakerTransaction'))
+        if cursor and direction == 'older':
+            try:
+                q.with_cursor(cursor)
+            except (db.BadValueError, db.BadRequestError):
+                return {"alert1":"Can't find those sales, try the latest."}
 
         maker_transactions = q.fetch(15)
+        next_cursor = q.cursor()
         sales = []
         total_sales = 0.0
         total_items = 0
@@ -1537,43 +1817,62 @@ class RPCGetMethods:
         fee_percentage = (community.paypal_fee_percentage + community.fee_percentage)*0.01
         fee_minimum = community.paypal_fee_minimum + community.fee_minimum
 
+        (carts, product_names) = _loadTransactionRowData(maker_transactions)
+        time_zone = community.timeZone
         for transaction in maker_transactions:
-            if transaction.status == 'Paid':
-                (sale, sale_items, sale_amount) = _buildTransactionRow(community, transaction, fee_percentage, fee_minimum)
-                total_items += sale_items
-                total_sales += sale_amount
-                sales.append(sale)
-
-        sales.sort(key=lambda sale: sale['when'], reverse=True)
+            (sale, sale_items, sale_amount) = _buildTransactionRow(community, transaction, fee_percentage, fee_minimum,
+                                                                   cart=carts[transaction.parent_key()],
+                                                                   product_names=product_names,
+                                                                   time_zone=time_zone)
+            total_items += sale_items
+            total_sales += sale_amount
+            sales.append(sale)
+
+        today = datetime.now(Utc_tzinfo()).astimezone(time_zone).date()
+        month = salesrollup.get_totals(maker.key(), today.replace(day=1), today)
+        lifetime = salesrollup.get_lifetime_totals(maker.key())
 
         return { 
             'sales':sales,
+            'cursor':next_cursor,
             'total_sales': "%.2f" % total_sales,
-            'total_items':total_items
+            'total_items':total_items,
+            'month_sales': "%.2f" % month['gross'],
+            'month_items': month['units'],
+            'month_net': "%.2f" % month['net'],
+            'lifetime_sales': "%.2f" % lifetime['gross'],
+            'lifetime_items': lifetime['units'],
+            'lifetime_net': "%.2f" % lifetime['net'],
             }
 
     def GetScore(self, request, *args):
         community = Community.get_current_community()
+        scores = community.scores
         return {
-            'makers':community.maker_score,
-            'product':community.product_score,
-            'pending':community.pending_score,
+            'makers':scores['maker_score'],
+            'product':scores['product_score'],
+            'pending':scores['pending_score'],
             }
 
 
 class RPCPostMethods:
     """ Handle any RPC request that change the state of the sytem. """
+    def __init__(self, cache=None):
+        self.cache = cache or EntityCache()
 
     def AddProductToCart(self, request, *args):
         """ Add a product to the shopping cart by key. """
         results = {}
         product_id = args[0]
         try:
-            product = Product.get(product_id)
+            product = self.cache.get([product_id])[0]
         except:
+            product = None
+        if not isinstance(product, Product):
             results["alert1"]="Product Not Found"
             return results
-        if product.inventory < 1:
+        available = reservation.available(product)
+        if available < 1:
             results["alert1"]='No More ' + product.name + ' in stock'
             return results
 
@@ -1584,7 +1883,7 @@ class RPCPostMethods:
 
         for item in items:
             if item.product_key == product_id:
-                if item.count + 1 > product.inventory:
+                if item.count + 1 > available:
                     results["alert1"]='No More ' + product.name + ' in stock'
                     return results
                 else:
@@ -1598,6 +1897,8 @@ class RPCPostMethods:
         for item in items:
             total += item.count
         session['ShoppingCartItems'] = items
+        cart_changed(session)
+        analytics.record('cart_add', product_id)
         count = str(total) + ' items'
         results["count"] = count 
         return results
@@ -1619,6 +1920,7 @@ class RPCPostMethods:
                 break
 
         session['ShoppingCartItems'] = items
+        cart_changed(session)
         return {"result":"success"}
 
     def RemoveAllProductFromCart(self, request, *args):
@@ -1635,6 +1937,7 @@ class RPCPostMethods:
                 break
 
         session['ShoppingCartItems'] = items
+        cart_changed(session)
         return {"result":"success"}
 
     def SetDeliveryOption(self, request, *args):
@@ -1644,6 +1947,7 @@ class RPCPostMethods:
         if not session.is_active():
             session.regenerate_id()
         session['DeliveryOption'] = delivery_option;
+        cart_changed(session)
         return {"result":"success"};
 
     def SetMakerTransactionShipped(self, request, *args):
@@ -1682,7 +1986,19 @@ class RPCPostMethods:
         else:
             items = session.get('ShoppingCartItems', [])
             delivery_option = session.get('DeliveryOption', "")
-            cart_transaction = CartTransaction(transaction_type='Sale')
+
+            products = ShoppingCartItem.loadProducts(items)
+            for item in items:
+                product = products.get(item.product_key)
+                if not product:
+                    return {"alert1":"A product in your cart is no longer available - please remove it"}
+                if product.inventory - item.count < 0:
+                    return{"alert1":"%d %s in stock, but %d in your cart - please remove %d" 
+                           % (product.inventory, product.name, item.count, item.count - product.inventory) }
+
+            (cart_transaction, maker_transactions) = CartTransaction.createForCart(items,
+                                                                                  products,
+                                                                                  delivery_option == 'local')
             cart_transaction.shopper_name = sanitizeHtml(args[0])
             cart_transaction.shopper_email = sanitizeHtml(args[1])
             cart_transaction.shopper_phone = sanitizeHtml(args[2])
@@ -1691,65 +2007,23 @@ class RPCPostMethods:
             logging.info(cart_transaction.shopper_name + " : " +cart_transaction.shopper_email + " : " + shipping_info)
 
             cart_transaction.shopper_shipping = shipping_info
-            cart_transaction.put()
 
-            maker_transactions = []
-            products = []
-            maker_business_ids = []
-            adjusted_items = []
+            # hold the items while the shopper is at Paypal
+            sold = {}
             for item in items:
-                product = Product.get(item.product_key)
-                if product.inventory - item.count < 0:
-                    return{"alert1":"%d %s in stock, but %d in your cart - please remove %d" 
-                           % (product.inventory, product.name, item.count, item.count - product.inventory) }
-                else:
-                    product.sold = item.count
-
-                products.append(product)
-
-                if delivery_option == 'local' and product.maker.handling_charge_for_pickup is False:
-                    item.shipping = 0.0
-
-                for maker_transaction in maker_transactions:
-                    if maker_transaction.maker.key() == product.maker.key():
-
-                        entry = "%s:%s:%s:%s" % (str(product.key()),
-                                              str(item.count),
-                                              str(item.price),
-                                              str(item.shipping))
-                        maker_transaction.detail.append(entry)
-                        break
-                    else:
-                        logging.info(str(maker_transaction.maker.key()) + "!=" + str(product.maker.key()))
-                else:
-                    when = "%s|%s" % (datetime.now(), hashlib.md5(str(product.maker.key())+get_current_session().sid).hexdigest())
-                    maker_transaction = MakerTransaction(parent=cart_transaction,
-                                                         maker=product.maker,
-                                                         email=product.maker.paypal_business_account_email,
-                                                         when=when)
-
-                    entry = "%s:%s:%s:%s" % (str(product.key()),
-                                          str(item.count),
-                                          str(item.price),
-                                          str(item.shipping))
-                    maker_transaction.detail.append(entry)
-                    maker_transactions.append(maker_transaction)
-                    maker_business_ids.append((product.maker.paypal_business_account_email, 1.00))
-
-                adjusted_items.append(item)
+                sold[item.product_key] = sold.get(item.product_key, 0) + item.count
+            (holds, short) = reservation.place_holds(cart_transaction.key(), products, sold)
+            if short:
+                return {"alert1":"Someone else is checking out with the last of %s. Please try again in a few minutes." % short.name}
 
             community = Community.get_current_community()
             base_url = request.url.replace(request.path, '')
 
             receivers = ShoppingCartItem.createReceiverList(community=community,
-                                                            shopping_cart_items=adjusted_items)
+                                                            shopping_cart_items=items,
+                                                            products=products)
 
             try:
-                if community.use_sandbox:
-                    action_url='https://svcs.sandbox.paypal.com/AdaptivePayments/Pay'
-                else:
-                    action_url='https://svcs.paypal.com/AdaptivePayments/Pay'
-
                 payment = PaypalChainedPayment( 
                     primary_recipient=receivers['primary'],
                     additional_recipients=receivers['others'],
@@ -1760,35 +2034,51 @@ class RPCPostMethods:
                     client_ip=request.remote_addr,
                     cancel_url=base_url+'/cancel?payKey=${payKey}',
                     return_url=base_url+'/return?payKey=${payKey}',
-                    action_url = action_url,
+                    action_url = community.pay_api_url,
                     ipn_url=base_url+'/ipn',
                     sandbox_email=community.paypal_email_address,
+                    redirect_url_template=community.approval_url_template,
                     )
             except TooManyRecipientsException:
-                cart_transaction.delete()
+                reservation.release(holds)
                 return {"message":"Paypal allows no more than five different Makers' products in a cart. Please divide your purchase."}
+
             try:
-                response = payment.execute()
-                paypalPaymentResponse = PaypalPaymentResponse( parent=cart_transaction, response=response.content)
-                paypalPaymentResponse.put();
-                confirmation_url = payment.buildRedirectURL(response=response, sandbox=community.use_sandbox)
+                payment.start()
+            except PaypalUnavailableException:
+                reservation.release(holds)
+                return {"message":"Paypal isn't answering right now. Please try again in a few minutes. Your account has not been charged."}
+
+            # record the cart while Paypal works on the payment, the rest
+            # goes out in one batch put once it answers
+            cart_put = db.put_async([cart_transaction] + holds)
+            entities = [cart_transaction]
+            confirmation_url = None
+            try:
+                response = payment.get_result()
+                if response:
+                    entities.append(PaypalPaymentResponse( parent=cart_transaction.key(), response=response.content))
+                    confirmation_url = payment.buildRedirectURL(response=response, sandbox=community.use_sandbox)
             except Exception, e:
                 logging.error('Exception handling Paypal transaction: %s',  str(e));
                 response = None
+            cart_put.get_result()
 
             if response and confirmation_url:
                 cart_transaction.transaction_status = 'CREATED';
                 cart_transaction.paypal_pay_key = payment.pay_key
-                cart_transaction.put()
-                db.put(maker_transactions)
+                entities.append(PayKeyCart(key_name=payment.pay_key, cart=cart_transaction))
+                db.put(entities + maker_transactions)
                 session.pop('ShoppingCartItems')
+                cart_changed(session)
                 community.increment_pending_score()
                 return {"redirect":"%s" % confirmation_url} 
             else:
                 logging.error("A Paypal checkout failed! Here's the cart: " + str(items))
                 cart_transaction.transaction_status = 'ERROR'
                 cart_transaction.error_details = 'Error Talking to Paypal.'
-                cart_transaction.put()
+                db.put(entities)
+                reservation.release(holds)
                 # TBD Generate email alert?
                 return{"message":"An error occured talking to Paypal. Please try again later. You can also call us or email. We have logged the error and will be looking into it right away. Your account has not been charged."}
 
@@ -1804,13 +2094,33 @@ class RPCPostMethods:
             return {"alert1":"Maker not found."}
         if maker:
             status = args[1]
-            maker.approval_status = status
-            maker.put()
+            Maker.set_approval_statuses([maker.key()], status)
             return{"key":str(maker.key()), "approval_status":status}
         else:
             logging.error("Attempt to change approval status of a maker which doesn't exist: %s\n", maker_id)
             self.error(404)
 
+    def SetApprovalStatuses(self, request, *args):
+        """ Change the approval status of several makers at once. """
+        if not users.is_current_user_admin():
+            self.error(403)
+            return {"alert1":"You do not have permission to do that."}
+
+        try:
+            keys = [db.Key(key) for key in args[0]]
+            changed = Maker.set_approval_statuses(keys, args[1])
+        except (db.BadKeyError, db.BadValueError), e:
+            return {"alert1":"Can't change those makers: %s" % e}
+        return {"keys":[str(maker.key()) for maker in changed], "approval_status":args[1]}
+
+    def RecountMakerStatuses(self, request, *args):
+        """ Recount the makers with each approval status, for the admin maker list. """
+        if not users.is_current_user_admin():
+            self.error(403)
+            return {"alert1":"You do not have permission to do that."}
+        Maker.recount_statuses()
+        return {"statusCounts":Maker.get_status_counts()}
+
     def EditContent(self, request, *args):
         """ Change content for a content page. """
         if not users.is_current_user_admin():
@@ -1971,9 +2281,11 @@ class AboutPage(webapp.RequestHandler):
 
 def main():
     app = webapp.WSGIApplication([
+        (r'/rpc/batch', RPCBatchHandler),
         (r'/rpc/(GetShoppingCart)', RPCHandler),
         (r'/rpc/(GetMakerActivityTable)', RPCHandler),
         (r'/rpc/(SetApprovalStatus)', RPCHandler),
+        (r'/rpc/(SetApprovalStatuses)', RPCHandler),
         (r'/rpc/(AddProductToCart)', RPCHandler),
         (r'/rpc/(RemoveProductFromCart)', RPCHandler),
         (r'/rpc/(RemoveAllProductFromCart)', RPCHandler),
@@ -1995,6 +2307,7 @@ def main():
         ('/logout', Logout),
         ('/makers', ListMakers),
         (r'/maker_store/(.*)', MakerStorePage),
+        (r'/maker_dashboard/(.*)/export.csv', MakerSalesExport),
         (r'/maker_dashboard/(.*)', MakerDashboard),
         ('/community/add', CommunityPage),
         ('/community/edit', EditCommunityPage),
@@ -16,21 +16,63 @@
 #  along with Creare.  If not, see <http://www.gnu.org/licenses/>.
 #
 import logging
+import random
+import time
 from cgi import parse_qs
 from google.appengine.ext import webapp
 from google.appengine.ext import db
 import urllib
 from google.appengine.api import urlfetch
+from google.appengine.api import memcache
+from google.appengine.runtime import apiproxy_errors
 
 SANDBOX_PP_URL = "https://www.sandbox.paypal.com/cgi-bin/webscr"
 PP_URL = "https://www.paypal.com/cgi-bin/webscr"
 
+PAY_DEADLINE = 8          # seconds to wait for one Pay call
+PAY_ATTEMPTS = 3
+RETRY_BACKOFF = 0.25      # seconds, doubled on each retry and jittered
+
+# Circuit breaker: after CIRCUIT_FAILURES failed calls within
+# CIRCUIT_WINDOW seconds we stop calling Paypal for CIRCUIT_OPEN_SECONDS
+CIRCUIT_FAILURES = 5
+CIRCUIT_WINDOW = 60
+CIRCUIT_OPEN_SECONDS = 30
+CIRCUIT_FAILURES_KEY = 'paypal:failures'
+CIRCUIT_OPEN_KEY = 'paypal:circuit_open'
+
+def paypal_circuit_open():
+    """ True while Paypal has been failing and we are not calling it. """
+    return memcache.get(CIRCUIT_OPEN_KEY) is not None
+
+def _record_paypal_failure():
+    memcache.add(CIRCUIT_FAILURES_KEY, 0, time=CIRCUIT_WINDOW)
+    failures = memcache.incr(CIRCUIT_FAILURES_KEY)
+    if failures is not None and failures >= CIRCUIT_FAILURES:
+        logging.error('Paypal failed %d times in %d seconds, not calling it for %d seconds'
+                      % (failures, CIRCUIT_WINDOW, CIRCUIT_OPEN_SECONDS))
+        memcache.set(CIRCUIT_OPEN_KEY, 1, time=CIRCUIT_OPEN_SECONDS)
+        memcache.delete(CIRCUIT_FAILURES_KEY)
+
 class PaypalPaymentResponse(db.Model):
     """ parent will be a CartTransaction """
     source = db.StringProperty(choices=set(['IPN','Pay_API']), default='Pay_API', required=True)
     response=db.TextProperty(required=True)
     timestamp = db.DateTimeProperty(auto_now_add=True)
 
+class PaypalIPN(db.Model):
+    """ An IPN as Paypal sent it, stored before we acknowledge it. """
+    parameters = db.TextProperty(required=True) # urlencoded
+    received = db.DateTimeProperty(auto_now_add=True)
+
+class PaypalIPNProcessed(db.Model):
+    """ Marks an IPN as processed, key_name is pay_key:status """
+    timestamp = db.DateTimeProperty(auto_now_add=True)
+
+    @staticmethod
+    def key_for(pay_key, status):
+        return db.Key.from_path('PaypalIPNProcessed', '%s:%s' % (pay_key, status))
+
 class PaypalExpressCheckoutButton:
     """ A simple unencrypted Paypal Express Checkout form generator. """    
     def __init__(self):
@@ -50,6 +92,12 @@ class TooManyRecipientsException (Exception):
     def __str__(self):
         return 'Paypal only allows 5 additional recipients. This Payment requests: ' + repr(self.number)
 
+class PaypalUnavailableException (Exception):
+    """ Paypal has been failing, so we fail fast instead of calling it. """
+
+    def __str__(self):
+        return 'Paypal is unavailable, try again in a little while'
+
 class PaypalChainedPayment:
     """ 
     Knows how to make a single chained payment and fetch an approval URL. 
@@ -57,7 +105,7 @@ class PaypalChainedPayment:
     """
     def __init__(self, primary_recipient, additional_recipients, api_username, api_password, 
                  api_signature, application_id, client_ip, cancel_url, return_url, action_url, 
-                 ipn_url, sandbox_email=""):
+                 ipn_url, sandbox_email="", redirect_url_template=None):
         """
         Must have at least a primary receiver, additional receivers are optional. 
         Paypal does not currently support chained payments with more than five additional receivers.
@@ -83,6 +131,8 @@ class PaypalChainedPayment:
             self.redirect_url_template = 'https://www.sandbox.paypal.com/webscr?cmd=_ap-payment&paykey='
         else:
             self.redirect_url_template = 'https://www.paypal.com/webscr?cmd=_ap-payment&paykey='
+        if redirect_url_template:
+            self.redirect_url_template = redirect_url_template
 
         self.form_fields = []
         self.form_fields.append(('actionType','PAY'))
@@ -101,6 +151,7 @@ class PaypalChainedPayment:
             self.form_fields.append(("receiverList.receiver(%d).email" % i, email))
             self.form_fields.append(("receiverList.receiver(%d).amount" % i, '%.2f' % amount))
             i += 1
+        self.num_receivers = i
 
         self.form_fields.append(('feesPayer', 'PRIMARYRECEIVER'))
         self.form_fields.append(('ipnNotificationUrl', ipn_url))
@@ -121,25 +172,57 @@ class PaypalChainedPayment:
 
         return url
 
-    def execute(self):
-        result = None
-        try:
-            form_data = urllib.urlencode(self.form_fields)
-            logging.info(form_data)
-            response = urlfetch.fetch(url=self.action_url,
-                                    payload=form_data,
-                                    method=urlfetch.POST,
-                                    headers=self.headers)
-
-        except Exception, e:
-            logging.error("PaypalChainedPayment.execute(): Unexpected Exception %s\n" % str(e))
-
-        if not response:
-            logging.error("PaypalChainedPayment.execute(): No Response from Paypal \n")
-        if response.status_code != 200:
-            logging.error("PaypalChainedPayment.execute(): Unexpected HTTP Error %d\n" % response.status_code)
-        else:
-            logging.info("PaypalChainedPayment.execute(): response = %s\n" % str(response.content));
-            logging.info("redirect: %s\n" % self.buildRedirectURL(response))
+    def _send(self):
+        rpc = urlfetch.create_rpc(deadline=self.deadline)
+        urlfetch.make_fetch_call(rpc,
+                                 url=self.action_url,
+                                 payload=self.form_data,
+                                 method=urlfetch.POST,
+                                 headers=self.headers)
+        return rpc
 
-        return response
+    def start(self, deadline=PAY_DEADLINE):
+        """
+        Send the Pay request without waiting for the answer, so the caller
+        can do other work meanwhile. Call get_result() for the response.
+        Throws a PaypalUnavailableException while the circuit is open.
+        """
+        if paypal_circuit_open():
+            raise PaypalUnavailableException()
+        self.deadline = deadline
+        self.form_data = urllib.urlencode(self.form_fields)
+        self.attempt = 1
+        logging.info("PaypalChainedPayment: paying %d receivers via %s" % (self.num_receivers, self.action_url))
+        self.rpc = self._send()
+
+    def get_result(self):
+        """
+        Wait for the call made by start(). Transport errors, timeouts and
+        5xx answers are retried with jittered backoff: an unused pay key
+        simply expires, so a repeated Pay request can't charge anyone
+        twice. Returns the response, or None if Paypal never answered.
+        """
+        while True:
+            try:
+                response = self.rpc.get_result()
+                if response.status_code < 500:
+                    if response.status_code != 200:
+                        logging.error("PaypalChainedPayment: unexpected HTTP status %d" % response.status_code)
+                    return response
+                error = 'HTTP status %d' % response.status_code
+            except (urlfetch.Error, apiproxy_errors.DeadlineExceededError), e:
+                error = '%s %s' % (e.__class__.__name__, str(e))
+
+            logging.warning("PaypalChainedPayment: attempt %d failed: %s" % (self.attempt, error))
+            _record_paypal_failure()
+            if self.attempt >= PAY_ATTEMPTS or paypal_circuit_open():
+                logging.error("PaypalChainedPayment: giving up after %d attempts" % self.attempt)
+                return None
+            time.sleep(random.uniform(0, RETRY_BACKOFF * (2 ** self.attempt)))
+            self.attempt += 1
+            self.rpc = self._send()
+
+    def execute(self, deadline=PAY_DEADLINE):
+        """ Make the Pay call and wait for it. Returns the response or None. """
+        self.start(deadline)
+        return self.get_result()
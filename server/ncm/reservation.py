@@ -0,0 +1,139 @@
+#  Copyright 2011 Bill Glover
+#
+#  This file is part of Creare.
+#
+#  Creare is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Creare is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Creare.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Inventory holds for carts in checkout.
+#
+# Inventory only goes down when Paypal tells us a payment completed, so
+# while a shopper is off at Paypal the items are held for their cart
+# for HOLD_MINUTES. What a shopper can still buy is the product's
+# inventory less the active holds on it.
+#
+# The holds themselves are InventoryHold entities, children of the
+# CartTransaction. The number held per product is kept in memcache and
+# adjusted with offset_multi, so placing a hold never writes to the
+# Product and a rush on one item doesn't queue up on its entity group.
+# If memcache loses a count it is rebuilt from the active holds.
+#
+# Holds are released when the IPN for the cart is processed, when the
+# shopper cancels at Paypal, when the Paypal call fails, or by the
+# release_holds cron once they expire.
+#
+import datetime
+import logging
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+HOLD_MINUTES = 20
+HELD_KEY_PREFIX = 'held:'
+HELD_CACHE_TTL = 3600
+RELEASE_BATCH = 200
+
+class InventoryHold(db.Model):
+    """ Items of one product held for a cart in checkout. Parent is the CartTransaction. """
+    product = db.StringProperty(required=True) # the product's key
+    count = db.IntegerProperty(required=True)
+    expires = db.DateTimeProperty(required=True)
+    released = db.BooleanProperty(default=False)
+
+def _held_key(product_key):
+    return HELD_KEY_PREFIX + str(product_key)
+
+def held(product_keys):
+    """ A dict of product key string to the number of items held. """
+    names = [str(key) for key in product_keys]
+    cached = memcache.get_multi([_held_key(name) for name in names])
+    result = {}
+    missing = {}
+    for name in names:
+        value = cached.get(_held_key(name))
+        if value is None:
+            total = 0
+            q = InventoryHold.all()
+            q.filter('product =', name)
+            q.filter('released =', False)
+            q.filter('expires >', datetime.datetime.now())
+            for hold in q:
+                total += hold.count
+            missing[_held_key(name)] = str(total)
+            result[name] = total
+        else:
+            result[name] = int(value)
+    if missing:
+        # stored as strings so offset_multi can adjust them
+        memcache.add_multi(missing, time=HELD_CACHE_TTL)
+    return result
+
+def available(product):
+    """ How many of product a shopper can still put in a cart. """
+    return max(product.inventory - held([product.key()])[str(product.key())], 0)
+
+def place_holds(cart_key, products, sold):
+    """
+    Hold what a cart is about to buy.
+    Parameters:
+      cart_key - The CartTransaction's key, which may not be saved yet
+      products - A dict of product key string to Product
+      sold - A dict of product key string to the number to hold
+    Returns (holds, None) with the unsaved InventoryHold entities for the
+    caller to put, or (None, product) naming a product there isn't enough
+    of, in which case nothing is held.
+    """
+    held(sold.keys()) # make sure every count is in memcache
+    counts = memcache.offset_multi(dict([(_held_key(key), count) for (key, count) in sold.items()]),
+                                   initial_value=0)
+    for (key, count) in sold.items():
+        now_held = counts.get(_held_key(key))
+        if now_held is not None and now_held > products[key].inventory:
+            memcache.offset_multi(dict([(_held_key(k), -c) for (k, c) in sold.items()]))
+            return (None, products[key])
+
+    expires = datetime.datetime.now() + datetime.timedelta(minutes=HOLD_MINUTES)
+    holds = [InventoryHold(parent=cart_key, product=str(key), count=count, expires=expires)
+             for (key, count) in sold.items()]
+    return (holds, None)
+
+def release(holds):
+    """ Release holds, saved or not, and put the saved ones. """
+    holds = [hold for hold in holds if not hold.released]
+    if not holds:
+        return
+    deltas = {}
+    for hold in holds:
+        hold.released = True
+        deltas[_held_key(hold.product)] = deltas.get(_held_key(hold.product), 0) - hold.count
+    saved = [hold for hold in holds if hold.is_saved()]
+    if saved:
+        db.put(saved)
+    memcache.offset_multi(deltas)
+
+def release_cart(cart_key):
+    """ Release every hold a cart still has. """
+    q = InventoryHold.all()
+    q.ancestor(cart_key)
+    q.filter('released =', False)
+    release(q.fetch(100))
+
+def release_expired():
+    """ Release holds which have run out. Returns how many. """
+    q = InventoryHold.all()
+    q.filter('released =', False)
+    q.filter('expires <', datetime.datetime.now())
+    expired = q.fetch(RELEASE_BATCH)
+    release(expired)
+    if expired:
+        logging.info('reservation: released %d expired holds' % len(expired))
+    return len(expired)
@@ -0,0 +1,79 @@
+#  Copyright 2011 Bill Glover
+#
+#  This file is part of Creare.
+#
+#  Creare is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Creare is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Creare.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Decoding RPC arguments and encoding RPC results.
+#
+# An RPC's arguments come either as one JSON body (Content-Type
+# application/json) holding a list of them or an object naming them
+# arg0, arg1, ..., or as form fields arg0, arg1, ... each holding one
+# JSON value. Results are encoded compactly in one dumps call, which is
+# the one that uses simplejson's C encoder when it is built; dump goes
+# through the pure Python iterencode, and webapp buffers the whole
+# response anyway, so streaming gains nothing. /bench/rpc compares them.
+#
+# simplejson is the fastest JSON we can get: the standalone package
+# (which has C speedups when built with them), else Python's json,
+# else the pure Python copy that comes with Django.
+#
+try:
+    import simplejson
+    ENCODER = 'simplejson'
+except ImportError:
+    try:
+        import json as simplejson
+        ENCODER = 'json'
+    except ImportError:
+        from django.utils import simplejson
+        ENCODER = 'django.utils.simplejson'
+
+JSON_CONTENT_TYPE = 'application/json'
+
+def is_json_body(request):
+    return request.headers.get('Content-Type', '').startswith(JSON_CONTENT_TYPE)
+
+def decode_args(request):
+    """
+    The positional arguments of an RPC request as a tuple. Raises
+    ValueError for a JSON body that isn't a list or an object.
+    """
+    if is_json_body(request):
+        params = simplejson.loads(request.body)
+        if isinstance(params, dict):
+            args = []
+            while 'arg%d' % len(args) in params:
+                args.append(params['arg%d' % len(args)])
+            return tuple(args)
+        elif isinstance(params, list):
+            return tuple(params)
+        raise ValueError('RPC params must be a list or an object')
+
+    args = ()
+    while True:
+        val = request.get('arg%d' % len(args))
+        if val:
+            args += (simplejson.loads(val),)
+        else:
+            break
+    return args
+
+def write_result(result, out):
+    """ Encode a result as compact JSON and write it to out. """
+    out.write(simplejson.dumps(result, separators=(',', ':')))
+
+def stream_result(result, out):
+    """ Encode a result as compact JSON onto out, a chunk at a time. """
+    simplejson.dump(result, out, separators=(',', ':'))
@@ -0,0 +1,253 @@
+#  Copyright 2011 Bill Glover
+#
+#  This file is part of Creare.
+#
+#  Creare is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Creare is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Creare.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Per maker sales totals by day and by month.
+#
+# A MakerSalesRollup is a child of its Maker with key_name d20110614 or
+# m201106, so the rollups for any range are found with one batch get.
+# Paid MakerTransactions are added in when the IPN for their cart is
+# processed: the IPN transaction queues /rollup/apply for the cart,
+# which adds each transaction in a cross-group transaction that also
+# marks it rolled_up, so nothing is ever counted twice. /rollup/rebuild
+# recomputes a maker's rollups from scratch. While it runs it holds a
+# MakerRollupRebuild lock in the maker's entity group, and applies for
+# that maker fail (and their tasks retry) rather than race it.
+#
+import datetime
+import logging
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp import util
+
+from model import Community, Maker, MakerTransaction, Utc_tzinfo
+
+ROLLUP_QUEUE = 'default'
+XG_OPTIONS = db.create_transaction_options(xg=True)
+PUT_BATCH = 500 # the most entities one datastore put or delete takes
+REBUILD_TIMEOUT = datetime.timedelta(minutes=10) # a lock older than this was left by a failed rebuild
+
+class MakerSalesRollup(db.Model):
+    """ A maker's sales for one day or month. Parent is the Maker. """
+    period = db.StringProperty(choices=set(['day', 'month']), required=True)
+    start = db.DateProperty(required=True)
+    transactions = db.IntegerProperty(default=0)
+    units = db.IntegerProperty(default=0)
+    gross = db.FloatProperty(default=0.0)
+    shipping = db.FloatProperty(default=0.0)
+    fees = db.FloatProperty(default=0.0)
+    net = db.FloatProperty(default=0.0)
+
+    def add(self, sale):
+        self.transactions += sale['transactions']
+        self.units += sale['units']
+        self.gross += sale['gross']
+        self.shipping += sale['shipping']
+        self.fees += sale['fees']
+        self.net += sale['net']
+
+class MakerRollupRebuild(db.Model):
+    """ Held while a maker's rollups are rebuilt. Parent is the Maker. """
+    started = db.DateTimeProperty(auto_now_add=True)
+
+class RebuildInProgress(Exception):
+    pass
+
+def rebuild_lock_key(maker_key):
+    return db.Key.from_path('MakerRollupRebuild', 'rebuild', parent=maker_key)
+
+def _in_batches(function, entities):
+    for i in xrange(0, len(entities), PUT_BATCH):
+        function(entities[i:i + PUT_BATCH])
+
+def _day_name(day):
+    return day.strftime('d%Y%m%d')
+
+def _month_name(day):
+    return day.strftime('m%Y%m')
+
+def rollup_key(maker_key, period, day):
+    if period == 'day':
+        return db.Key.from_path('MakerSalesRollup', _day_name(day), parent=maker_key)
+    return db.Key.from_path('MakerSalesRollup', _month_name(day), parent=maker_key)
+
+def sale_for(community, transaction, cart):
+    """ What one MakerTransaction adds to its maker's rollups. """
+    fee_percentage = (community.paypal_fee_percentage + community.fee_percentage) * 0.01
+    fee_minimum = community.paypal_fee_minimum + community.fee_minimum
+    sale = {'transactions':1, 'units':0, 'gross':0.0, 'shipping':0.0}
+    for entry in transaction.detail:
+        entry_fields = entry.split(':')
+        items = int(entry_fields[1])
+        sale['units'] += items
+        sale['gross'] += float(entry_fields[2]) * items
+        if len(entry_fields) == 4:
+            sale['shipping'] += float(entry_fields[3]) * items
+    sale['fees'] = (sale['gross'] + sale['shipping']) * fee_percentage + fee_minimum
+    sale['net'] = sale['gross'] + sale['shipping'] - sale['fees']
+    sale['day'] = cart.timestamp.replace(tzinfo=Utc_tzinfo()).astimezone(community.timeZone).date()
+    return sale
+
+def _get_or_new(rollups, maker_key, period, day):
+    key = rollup_key(maker_key, period, day)
+    if key not in rollups:
+        rollups[key] = MakerSalesRollup(key=key, period=period, start=day)
+    return rollups[key]
+
+def _add_sale(rollups, maker_key, sale):
+    """ Add a sale into the day and month rollups in the rollups dict. """
+    day = sale['day']
+    _get_or_new(rollups, maker_key, 'day', day).add(sale)
+    _get_or_new(rollups, maker_key, 'month', day.replace(day=1)).add(sale)
+
+def queue_apply(cart_key):
+    """ Queue adding a cart's paid transactions, transactionally if in one. """
+    taskqueue.add(queue_name=ROLLUP_QUEUE,
+                  url='/rollup/apply',
+                  params={'cart':str(cart_key)},
+                  transactional=db.is_in_transaction())
+
+def apply_cart(community, cart):
+    """
+    Add a cart's paid transactions that haven't been counted yet. Raises
+    RebuildInProgress if a maker's rollups are being rebuilt.
+    """
+    q = MakerTransaction.all()
+    q.ancestor(cart)
+    q.filter('status =', 'Paid')
+    for transaction in q.fetch(6):
+        if transaction.rolled_up:
+            continue
+        maker_key = MakerTransaction.maker.get_value_for_datastore(transaction)
+        sale = sale_for(community, transaction, cart)
+
+        def txn():
+            fresh = MakerTransaction.get(transaction.key())
+            if fresh.rolled_up:
+                return
+            (lock, day, month) = db.get([rebuild_lock_key(maker_key),
+                                         rollup_key(maker_key, 'day', sale['day']),
+                                         rollup_key(maker_key, 'month', sale['day'])])
+            if lock and datetime.datetime.now() - lock.started < REBUILD_TIMEOUT:
+                raise RebuildInProgress('Rollups for %s are being rebuilt' % maker_key)
+            rollups = dict([(r.key(), r) for r in [day, month] if r])
+            _add_sale(rollups, maker_key, sale)
+            fresh.rolled_up = True
+            db.put(rollups.values() + [fresh])
+        db.run_in_transaction_options(XG_OPTIONS, txn)
+
+def rebuild_maker(community, maker_key):
+    """
+    Recompute a maker's rollups from their paid transactions, holding the
+    rebuild lock so no apply_cart for the maker commits meanwhile. The
+    new rollups are put over the old ones before any stale ones go.
+    """
+    db.put(MakerRollupRebuild(key=rebuild_lock_key(maker_key)))
+    rollups = {}
+    counted = []
+    q = MakerTransaction.all()
+    q.filter('maker =', maker_key)
+    q.filter('status =', 'Paid')
+    transactions = q.fetch(1000)
+    while transactions:
+        carts = dict(zip([t.parent_key() for t in transactions], db.get([t.parent_key() for t in transactions])))
+        for transaction in transactions:
+            _add_sale(rollups, maker_key, sale_for(community, transaction, carts[transaction.parent_key()]))
+            if not transaction.rolled_up:
+                transaction.rolled_up = True
+                counted.append(transaction)
+        q.with_cursor(q.cursor())
+        transactions = q.fetch(1000)
+    _in_batches(db.put, counted)
+    _in_batches(db.put, rollups.values())
+    stale = [key for key in MakerSalesRollup.all(keys_only=True).ancestor(maker_key) if key not in rollups]
+    _in_batches(db.delete, stale)
+    db.delete(rebuild_lock_key(maker_key))
+    return len(rollups)
+
+def get_totals(maker_key, start, end):
+    """
+    A maker's totals from start to end inclusive (dates), read from whole
+    month rollups where they fit and day rollups at the edges. Returns a
+    dict with transactions, units, gross, shipping, fees and net.
+    """
+    keys = []
+    day = start
+    while day <= end:
+        next_month = (day.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+        if day.day == 1 and next_month - datetime.timedelta(days=1) <= end:
+            keys.append(rollup_key(maker_key, 'month', day))
+            day = next_month
+        else:
+            keys.append(rollup_key(maker_key, 'day', day))
+            day += datetime.timedelta(days=1)
+
+    totals = _no_sales()
+    for rollup in db.get(keys):
+        if rollup:
+            _add_to(totals, rollup)
+    return totals
+
+def get_lifetime_totals(maker_key):
+    """ A maker's totals over every month. """
+    totals = _no_sales()
+    for rollup in MakerSalesRollup.all().ancestor(maker_key).filter('period =', 'month'):
+        _add_to(totals, rollup)
+    return totals
+
+def _no_sales():
+    return {'transactions':0, 'units':0, 'gross':0.0, 'shipping':0.0, 'fees':0.0, 'net':0.0}
+
+def _add_to(totals, rollup):
+    for name in totals:
+        totals[name] += getattr(rollup, name)
+
+class ApplyRollups(webapp.RequestHandler):
+    """ Task: add a cart's paid transactions to the rollups. """
+    def post(self):
+        cart = db.get(self.request.get('cart'))
+        if cart:
+            try:
+                apply_cart(Community.all().get(), cart)
+            except RebuildInProgress, e:
+                logging.info('salesrollup: %s, retrying later' % e)
+                self.error(503) # the task is retried
+
+class RebuildRollups(webapp.RequestHandler):
+    """ Rebuild one maker's rollups, or queue a rebuild for every maker. """
+    def get(self):
+        self.post()
+
+    def post(self):
+        maker = self.request.get('maker')
+        if maker:
+            count = rebuild_maker(Community.all().get(), db.Key(maker))
+            logging.info('salesrollup: rebuilt %d rollups for %s' % (count, maker))
+        else:
+            for maker_key in Maker.all(keys_only=True):
+                taskqueue.add(queue_name=ROLLUP_QUEUE, url='/rollup/rebuild', params={'maker':str(maker_key)})
+            self.response.out.write('Queued rollup rebuilds')
+
+def main():
+    app = webapp.WSGIApplication([
+        ('/rollup/apply', ApplyRollups),
+        ('/rollup/rebuild', RebuildRollups),
+        ])
+    util.run_wsgi_app(app)
+
+if __name__ == '__main__':
+    main()
@@ -21,12 +21,46 @@
 #
 from google.appengine.api import memcache
 from google.appengine.ext import db
+import datetime
+import logging
 import random
+import time
+
+# Buffered (write-behind) updates collect in memcache and are moved into
+# the shards by flush(), which cron runs every minute. Memcache can't
+# go below zero, so pending deltas are stored offset by PENDING_BIAS.
+PENDING_BIAS = 2**31
+PENDING_KEY_PREFIX = 'shardedcounter:pending:'
+FLUSH_LOCK_PREFIX = 'shardedcounter:flushing:'
+MAX_PENDING = 100        # flush a counter inline once this much is waiting
+REGISTRATION_TTL = 60    # seconds an instance trusts a counter is registered
+FLUSH_BATCH = 100
+RETIRE_GRACE = datetime.timedelta(minutes=10)
+
+# Shard configuration is cached in the instance and in memcache. Every
+# CONTENTION_SAMPLE writes the collision rate of a counter is recorded
+# on its config, and the shards are doubled (up to MAX_SHARDS) when
+# it is over CONTENTION_THRESHOLD collisions per write.
+CONFIG_KEY_PREFIX = 'shardedcounter:config:'
+WRITES_KEY_PREFIX = 'shardedcounter:writes:'
+COLLISIONS_KEY_PREFIX = 'shardedcounter:collisions:'
+CONFIG_CACHE_TTL = 600
+CONTENTION_SAMPLE = 50
+CONTENTION_THRESHOLD = 0.1
+MAX_SHARDS = 320
+MAX_WRITE_ATTEMPTS = 5
+
+_registered = {} # counter name -> when this instance last checked it
+_config_cache = {} # counter name -> (num_shards, expires)
 
 class GeneralCounterShardConfig(db.Model):
     """Tracks the number of shards for each named counter."""
     name = db.StringProperty(required=True)
     num_shards = db.IntegerProperty(required=True, default=20)
+    buffered = db.BooleanProperty(default=False)
+    buffered_until = db.DateTimeProperty()
+    collision_rate = db.FloatProperty(default=0.0)
+    sampled = db.DateTimeProperty()
 
 
 class GeneralCounterShard(db.Model):
@@ -35,59 +69,282 @@ class GeneralCounterShard(db.Model):
     count = db.IntegerProperty(required=True, default=0)
 
 
+def _pending_key(name):
+    return PENDING_KEY_PREFIX + name
+
 def get_count(name):
-    """Retrieve the value for a given sharded counter.
+    """Retrieve the value for a given sharded counter, including any
+    buffered changes which haven't been flushed to the shards yet.
 
     Parameters:
       name - The name of the counter
     """
-    total = memcache.get(name)
-    if total is None:
-        total = 0
-        for counter in GeneralCounterShard.all().filter('name = ', name):
-            total += counter.count
-        memcache.add(name, str(total), 60)
-    return int(total)
-
-def increment(name, count):
+    return get_counts([name])[name]
+
+def get_counts(names):
+    """Retrieve the values of several sharded counters in as few round
+    trips as possible: one memcache get for the cached totals, pending
+    changes and shard configs, then (for totals memcache didn't have)
+    one batch get of any missing configs and one of the shards by key
+    name.
+
+    Parameters:
+      names - The names of the counters
+    Returns a dict of name to value.
+    """
+    keys = []
+    for name in names:
+        keys.extend([name, _pending_key(name), CONFIG_KEY_PREFIX + name])
+    cached = memcache.get_multi(keys)
+
+    missing = [name for name in names if name not in cached]
+    if missing:
+        num_shards = {}
+        unknown = []
+        for name in missing:
+            if CONFIG_KEY_PREFIX + name in cached:
+                num_shards[name] = cached[CONFIG_KEY_PREFIX + name]
+            else:
+                unknown.append(name)
+        if unknown:
+            for (name, config) in zip(unknown, GeneralCounterShardConfig.get_by_key_name(unknown)):
+                if config:
+                    num_shards[name] = config.num_shards
+                # otherwise nothing has ever been written to the counter
+
+        shard_keys = []
+        for name in missing:
+            for i in xrange(num_shards.get(name, 0)):
+                shard_keys.append(db.Key.from_path(GeneralCounterShard.kind(), name + str(i)))
+        totals = dict([(name, 0) for name in missing])
+        for shard in db.get(shard_keys):
+            if shard:
+                totals[shard.name] += shard.count
+
+        memcache.add_multi(dict([(name, str(total)) for (name, total) in totals.items()]), time=60)
+        cached.update(totals)
+
+    counts = {}
+    for name in names:
+        pending = cached.get(_pending_key(name))
+        if pending is None:
+            pending = PENDING_BIAS
+        counts[name] = int(cached[name]) + int(pending) - PENDING_BIAS
+    return counts
+
+def _cache_num_shards(name, num_shards):
+    _config_cache[name] = (num_shards, time.time() + CONFIG_CACHE_TTL)
+    memcache.set(CONFIG_KEY_PREFIX + name, num_shards, CONFIG_CACHE_TTL)
+
+def get_num_shards(name):
+    """How many shards a counter has, from the instance cache, memcache or
+    (creating the config if needed) the datastore."""
+    cached = _config_cache.get(name)
+    if cached and cached[1] > time.time():
+        return cached[0]
+    num_shards = memcache.get(CONFIG_KEY_PREFIX + name)
+    if num_shards is None:
+        num_shards = GeneralCounterShardConfig.get_or_insert(name, name=name).num_shards
+        _cache_num_shards(name, num_shards)
+    else:
+        _config_cache[name] = (num_shards, time.time() + CONFIG_CACHE_TTL)
+    return num_shards
+
+def _write_shard(name, delta):
+    """Add delta to a random shard of the counter in a transaction. A
+    collision is retried on a different random shard."""
+    num_shards = get_num_shards(name)
+    def txn(shard_name):
+        counter = GeneralCounterShard.get_by_key_name(shard_name)
+        if counter is None:
+            counter = GeneralCounterShard(key_name=shard_name, name=name)
+        counter.count += delta
+        counter.put()
+
+    attempts = 0
+    while True:
+        attempts += 1
+        shard_name = name + str(random.randint(0, num_shards - 1))
+        try:
+            db.run_in_transaction_custom_retries(0, txn, shard_name)
+            break
+        except db.TransactionFailedError:
+            if attempts >= MAX_WRITE_ATTEMPTS:
+                _record_contention(name, attempts)
+                raise
+    _record_contention(name, attempts)
+
+def _record_contention(name, attempts):
+    """Count a write and its collisions, and act on a full sample."""
+    counts = memcache.offset_multi({WRITES_KEY_PREFIX + name:1,
+                                    COLLISIONS_KEY_PREFIX + name:attempts - 1},
+                                   initial_value=0)
+    writes = counts.get(WRITES_KEY_PREFIX + name)
+    if writes == CONTENTION_SAMPLE:
+        memcache.delete_multi([WRITES_KEY_PREFIX + name, COLLISIONS_KEY_PREFIX + name])
+        collisions = counts.get(COLLISIONS_KEY_PREFIX + name) or 0
+        _update_contention(name, float(collisions) / writes)
+
+def _update_contention(name, collision_rate):
+    """Record a counter's collision rate and add shards if it is hot."""
+    def txn():
+        config = GeneralCounterShardConfig.get_by_key_name(name)
+        if config is None:
+            config = GeneralCounterShardConfig(key_name=name, name=name)
+        config.collision_rate = collision_rate
+        config.sampled = datetime.datetime.now()
+        config.put()
+        return config.num_shards
+    num_shards = db.run_in_transaction(txn)
+    if collision_rate > CONTENTION_THRESHOLD and num_shards < MAX_SHARDS:
+        logging.info('shardedcounter: %s has %.2f collisions per write, adding shards' % (name, collision_rate))
+        increase_shards(name, min(num_shards * 2, MAX_SHARDS))
+
+def hot_counters(limit=10):
+    """The configs of the counters with the highest recorded collision rates."""
+    return GeneralCounterShardConfig.all().order('-collision_rate').fetch(limit)
+
+def _register(names, until=None, num_shards=None):
+    """Make sure flush() knows about buffered counters. Checked at most
+    once every REGISTRATION_TTL seconds per instance, with one batch get
+    and (for new counters) one batch put."""
+    now = time.time()
+    names = [name for name in names if now - _registered.get(name, 0) >= REGISTRATION_TTL]
+    if not names:
+        return
+    changed = []
+    for (name, config) in zip(names, GeneralCounterShardConfig.get_by_key_name(names)):
+        if config is None:
+            config = GeneralCounterShardConfig(key_name=name, name=name)
+            if num_shards:
+                config.num_shards = num_shards
+        elif config.buffered:
+            continue
+        config.buffered = True
+        config.buffered_until = until
+        changed.append(config)
+    # Not transactional: two instances registering the same counter at
+    # once write the same thing.
+    db.put(changed)
+    for name in names:
+        _registered[name] = now
+
+def increment_multi(deltas, until=None, num_shards=None):
+    """Buffer changes to several counters with one memcache call. Falls
+    back to writing the shards directly if memcache isn't working.
+
+    Parameters:
+      deltas - A dict of counter name to the amount to add (may be negative)
+      until - When the counters stop changing. flush() stops looking at
+              them RETIRE_GRACE after that.
+      num_shards - How many shards a new counter starts with
+    """
+    deltas = dict([(name, delta) for (name, delta) in deltas.items() if delta])
+    if not deltas:
+        return
+    _register(deltas.keys(), until, num_shards)
+    results = memcache.offset_multi(dict([(_pending_key(name), delta) for (name, delta) in deltas.items()]),
+                                    initial_value=PENDING_BIAS)
+    overflowing = []
+    for (name, delta) in deltas.items():
+        pending = results.get(_pending_key(name))
+        if pending is None:
+            logging.warning('shardedcounter: memcache unavailable, writing %s directly' % name)
+            _write_shard(name, delta)
+            memcache.delete(name)
+        elif abs(pending - PENDING_BIAS) >= MAX_PENDING:
+            overflowing.append(name)
+    if overflowing:
+        flush(overflowing)
+
+def increment(name, count, buffered=False):
     """Increase the value for a given sharded counter by count.
     
     Parameters:
     name - The name of the counter
     count - The amount to add (always positive)
+    buffered - Collect the change in memcache and let flush() write it
     """
     if count < 1:
         return
 
-    config = GeneralCounterShardConfig.get_or_insert(name, name=name)
-    def txn(count):
-        index = random.randint(0, config.num_shards - 1)
-        shard_name = name + str(index)
-        counter = GeneralCounterShard.get_by_key_name(shard_name)
-        if counter is None:
-            counter = GeneralCounterShard(key_name=shard_name, name=name)
-        counter.count += count
-        counter.put()
-    db.run_in_transaction(txn, count)
-    memcache.incr(key=name, delta=count)
+    if buffered:
+        increment_multi({name:count})
+    else:
+        _write_shard(name, count)
+        memcache.incr(key=name, delta=count)
 
-def decrement(name):
+def decrement(name, buffered=False):
     """Decrement the value for a given sharded counter.
     
     Parameters:
     name - The name of the counter
+    buffered - Collect the change in memcache and let flush() write it
     """
-    config = GeneralCounterShardConfig.get_or_insert(name, name=name)
-    def txn():
-        index = random.randint(0, config.num_shards - 1)
-        shard_name = name + str(index)
-        counter = GeneralCounterShard.get_by_key_name(shard_name)
-        if counter is None:
-            counter = GeneralCounterShard(key_name=shard_name, name=name)
-        counter.count -= 1
-        counter.put()
-    db.run_in_transaction(txn)
-    memcache.decr(name)
+    if buffered:
+        increment_multi({name:-1})
+    else:
+        _write_shard(name, -1)
+        memcache.decr(name)
+
+def flush(names=None):
+    """Move buffered changes from memcache into the shards.
+
+    Each counter is locked while it is flushed, and its pending delta is
+    taken out of memcache before the shard is written (and put back if
+    the write fails), so a change is never counted twice. Changes are
+    lost only if memcache evicts them first, which the MAX_PENDING
+    inline flush and the once a minute cron keep small.
+
+    Flushing every buffered counter also retires the ones which have
+    been past their buffered_until for RETIRE_GRACE.
+
+    Parameters:
+      names - The counters to flush. Defaults to every buffered counter.
+    Returns the number of counters written.
+    """
+    retire = names is None
+    if retire:
+        q = GeneralCounterShardConfig.all(keys_only=True).filter('buffered =', True)
+        names = [key.name() for key in q]
+
+    written = 0
+    for i in xrange(0, len(names), FLUSH_BATCH):
+        batch = names[i:i+FLUSH_BATCH]
+        locks = dict([(FLUSH_LOCK_PREFIX + name, name) for name in batch])
+        busy = memcache.add_multi(dict([(lock, 1) for lock in locks]), time=60)
+        batch = [locks[lock] for lock in locks if lock not in busy]
+
+        pending = memcache.get_multi([_pending_key(name) for name in batch])
+        deltas = {}
+        for name in batch:
+            value = pending.get(_pending_key(name))
+            if value is not None and int(value) != PENDING_BIAS:
+                deltas[name] = int(value) - PENDING_BIAS
+
+        # claim the deltas before writing them
+        if deltas:
+            memcache.offset_multi(dict([(_pending_key(name), -delta) for (name, delta) in deltas.items()]))
+        for (name, delta) in deltas.items():
+            try:
+                _write_shard(name, delta)
+                memcache.offset_multi({name:delta})
+                written += 1
+            except Exception, e:
+                logging.error('shardedcounter: flush of %s failed, keeping it pending (%s)' % (name, e))
+                memcache.offset_multi({_pending_key(name):delta}, initial_value=PENDING_BIAS)
+
+        memcache.delete_multi([FLUSH_LOCK_PREFIX + name for name in batch])
+
+    if retire:
+        q = GeneralCounterShardConfig.all()
+        q.filter('buffered =', True)
+        q.filter('buffered_until <', datetime.datetime.now() - RETIRE_GRACE)
+        retired = q.fetch(500)
+        for config in retired:
+            config.buffered = False
+        db.put(retired)
+    return written
 
 def increase_shards(name, num):
     """Increase the number of shards for a given sharded counter.
@@ -98,10 +355,12 @@ def increase_shards(name, num):
       num - How many shards to use
 
     """
-    config = GeneralCounterShardConfig.get_or_insert(name, name=name)
     def txn():
-        if config.num_shards < num:
-            config.num_shards = num
+        config = GeneralCounterShardConfig.get_by_key_name(name)
+        if config is None:
+            config = GeneralCounterShardConfig(key_name=name, name=name)
+        if config.num_shards < num or not config.is_saved():
+            config.num_shards = max(config.num_shards, num)
             config.put()
-    db.run_in_transaction(txn)
-
+        return config.num_shards
+    _cache_num_shards(name, db.run_in_transaction(txn))
@@ -48,21 +48,26 @@ function Request(idempotent, function_name, opt_argv) {
 	}
 	var async = (callback != null);
 
-	// Encode the arguments in to a URI
-	var query = '';
-	for (var i = 0; i < opt_argv.length; i++) {
-        var key = 'arg' + i;
-        var val = JSON.stringify(opt_argv[i]);
-        query += '&' + key + '=' + encodeURIComponent(val);
-	}
-	query += '&time=' + new Date().getTime(); // IE cache workaround
-      
 	var req = new XMLHttpRequest();
+	var query = '';
 	if(idempotent){
+        // Encode the arguments in to a URI
+        for (var i = 0; i < opt_argv.length; i++) {
+            var key = 'arg' + i;
+            var val = JSON.stringify(opt_argv[i]);
+            query += '&' + key + '=' + encodeURIComponent(val);
+        }
+        query += '&time=' + new Date().getTime(); // IE cache workaround
         req.open('GET', '/rpc/'+encodeURIComponent(function_name)+'?' + query, async);
 	}else{
+        // Send the arguments as one JSON list
+        var args = [];
+        for (var i = 0; i < opt_argv.length; i++) {
+            args.push(opt_argv[i]);
+        }
+        query = JSON.stringify(args);
         req.open('POST', '/rpc/'+encodeURIComponent(function_name), async);
-        req.setRequestHeader("Content-type", "application/x-www-form-urlencoded");
+        req.setRequestHeader("Content-type", "application/json");
         req.setRequestHeader("Content-length", query.length);
         req.setRequestHeader("Connection", "close");        
 	}
@@ -96,6 +101,44 @@ function Request(idempotent, function_name, opt_argv) {
 	}
 }
 
+//
+// Makes several server calls in one request, run in order on the server
+//
+// calls: an Array of [function_name, [arguments]] pairs
+// callback: called with the Array of their responses
+//
+function BatchRequest(calls, callback) {
+	var query = JSON.stringify(calls);
+
+	var req = new XMLHttpRequest();
+	req.open('POST', '/rpc/batch', true);
+	req.setRequestHeader("Content-type", "application/json");
+	req.setRequestHeader("Content-length", query.length);
+	req.setRequestHeader("Connection", "close");
+
+	req.onreadystatechange = function() {
+		if(req.readyState == 4 && req.status == 200) {
+			var responses = [];
+			try {
+				responses = JSON.parse(req.responseText);
+			} catch (e) {
+				$('alert1').innerHTML = "Error: " + e + req.responseText;
+			}
+			for (var i = 0; i < responses.length; i++) {
+				if (responses[i] && 'alert1' in responses[i]){
+					$('alert1').innerHTML = responses[i]['alert1'];
+				}
+			}
+			callback(responses);
+		}
+
+		if(req.status != 200){
+			$('alert1').innerHTML = "Server Error: " + req.status;
+		}
+	}
+	req.send(query);
+}
+
 // Adds a stub function that will pass the arguments to the AJAX call
 function InstallFunction(obj, functionName, idempotent) {
 	obj[functionName] = function() { Request(idempotent, functionName, arguments); }
@@ -0,0 +1,49 @@
+import unittest
+from google.appengine.api import memcache
+from google.appengine.ext import db
+import adscheduler
+import shardedcounter
+from model import Advertisement
+
+class TestAdScheduler(unittest.TestCase):
+    """ Test in-memory ad rotation and impression reconciliation. """
+
+    def setUp(self):
+        memcache.flush_all()
+        self.paid = Advertisement(name='Paid', show=True)
+        self.paid.put()
+        self.paid.refill_impressions(3)
+        self.psa = Advertisement(name='PSA', show=True, PSA=True)
+        self.psa.put()
+        adscheduler.invalidate()
+
+    def tearDown(self):
+        adscheduler._unreconciled.clear()
+        adscheduler.invalidate()
+        memcache.flush_all()
+        shardedcounter._registered.clear()
+        shardedcounter._config_cache.clear()
+        for ad in [self.paid, self.psa]:
+            name = str(ad.key())
+            db.delete(shardedcounter.GeneralCounterShard.all(keys_only=True).filter('name =', name).fetch(100))
+            db.delete(shardedcounter.GeneralCounterShardConfig.get_by_key_name(name))
+        db.delete([self.paid, self.psa])
+
+    def testRotation(self):
+        shown = [adscheduler.next_ad().name for i in xrange(8)]
+        # the paid ad runs out after its three impressions, the PSA fills in
+        self.assertTrue(shown.count('Paid') == 3)
+        self.assertTrue(shown.count('PSA') == 5)
+        self.assertTrue(shown[-1] == 'PSA')
+
+    def testReconcile(self):
+        adscheduler.next_ad()
+        adscheduler.next_ad()
+        adscheduler.reconcile()
+        self.assertTrue(self.paid.remaining_impressions() <= 2)
+
+        # once the counter is empty the next refresh stops showing the ad
+        shardedcounter.increment_multi({str(self.paid.key()): -self.paid.remaining_impressions()})
+        adscheduler.refresh()
+        self.assertTrue(Advertisement.get(self.paid.key()).show == False)
+        self.assertTrue(adscheduler.next_ad().name == 'PSA')
@@ -0,0 +1,54 @@
+import unittest
+import datetime
+from google.appengine.api import memcache
+from google.appengine.ext import db
+import analytics
+import shardedcounter
+from shardedcounter import GeneralCounterShard, GeneralCounterShardConfig
+
+class TestAnalytics(unittest.TestCase):
+    """ Test time-bucketed analytics counters. """
+
+    def setUp(self):
+        self.when = datetime.datetime(2011, 6, 14, 9, 30)
+
+    def tearDown(self):
+        analytics._pending.clear()
+        memcache.flush_all()
+        shardedcounter._registered.clear()
+        shardedcounter._config_cache.clear()
+        configs = GeneralCounterShardConfig.all().fetch(1000)
+        names = [config.name for config in configs if config.name.startswith('analytics:')]
+        for name in names:
+            db.delete(GeneralCounterShard.all(keys_only=True).filter('name =', name).fetch(100))
+            db.delete(GeneralCounterShardConfig.get_by_key_name(name))
+
+    def testBuckets(self):
+        start = datetime.datetime(2011, 6, 13, 22, 15)
+        end = datetime.datetime(2011, 6, 15, 1, 0)
+        buckets = analytics.buckets(start, end)
+        self.assertTrue(buckets[0] == (datetime.datetime(2011, 6, 13, 22), analytics.HOUR))
+        self.assertTrue(buckets[1] == (datetime.datetime(2011, 6, 13, 23), analytics.HOUR))
+        self.assertTrue(buckets[2] == (datetime.datetime(2011, 6, 14), analytics.DAY))
+        self.assertTrue(buckets[3] == (datetime.datetime(2011, 6, 15, 0), analytics.HOUR))
+        self.assertTrue(len(buckets) == 4)
+
+    def testRecordAndTotals(self):
+        analytics.record('view', 'p1', when=self.when)
+        analytics.record('view', 'p1', when=self.when)
+        analytics.record('view', 'p2', when=self.when)
+        analytics.record('view', 'p1', when=self.when - datetime.timedelta(days=1))
+        # nothing is counted until the instance flushes
+        day = datetime.datetime(2011, 6, 14)
+        self.assertTrue(analytics.get_total('view', 'p1', day, day + analytics.DAY) == 0)
+
+        analytics.flush()
+        totals = analytics.get_totals('view', ['p1', 'p2'], day, day + analytics.DAY)
+        self.assertTrue(totals == {'p1':2, 'p2':1})
+        hour = datetime.datetime(2011, 6, 14, 9)
+        self.assertTrue(analytics.get_total('view', 'p1', hour, hour + analytics.HOUR) == 2)
+        self.assertTrue(analytics.get_total('view', 'p1', day - analytics.DAY, day + analytics.DAY) == 3)
+
+        # the buckets are written on the next counter flush
+        shardedcounter.flush()
+        self.assertTrue(analytics.get_total('view', 'p1', day, day + analytics.DAY) == 2)
@@ -1,7 +1,9 @@
 import logging
 import unittest
+import datetime
 from google.appengine.api import memcache
-from model import Community, Advertisement
+from google.appengine.ext import db
+from model import Community, Advertisement, Maker, Product, FeaturedSnapshot, when_stamp
 
 class TestCommunity(unittest.TestCase):
     """ Test the Community model. """
@@ -45,9 +47,6 @@ class TestCommunity(unittest.TestCase):
         self.assertTrue(advertisement.remaining_impressions() == 0)
         advertisement.refill_impressions(10000)
         self.assertTrue(advertisement.remaining_impressions() == 10000)
-        advertisement.decrement_impressions()
-        advertisement.decrement_impressions()
-        self.assertTrue(advertisement.remaining_impressions() == 9998)
 
     def testCredentials(self):
         self.community.use_sandbox = True
@@ -65,3 +64,41 @@ class TestCommunity(unittest.TestCase):
         self.assertTrue(self.community.api_password == self.community.paypal_api_password)
         self.assertTrue(self.community.api_signature == self.community.paypal_api_signature)
         self.assertTrue(self.community.application_id == self.community.paypal_application_id)
+
+    def testFeaturedSnapshot(self):
+        self.assertTrue(FeaturedSnapshot.get_featured(self.community) == (None, None))
+        maker = Maker(community=self.community,
+                      store_name='Featured Store',
+                      store_description='A test store',
+                      full_name='Fay Tured',
+                      email='test@example.com',
+                      paypal_business_account_email='maker@gmail.com',
+                      phone_number='5301111212',
+                      location='Right Here',
+                      mailing_address='111 Test Lane, Testable, CA 95945',
+                      tags=['test'])
+        maker.put()
+        product = Product(maker=maker,
+                          name='Featured Thing',
+                          short_description='a test thing',
+                          description='For testing',
+                          price=10.0,
+                          tags=['test'],
+                          when=when_stamp(datetime.datetime(2011, 6, 1), 'test'),
+                          when_time=datetime.datetime(2011, 6, 1))
+        product.put()
+        try:
+            FeaturedSnapshot.take(self.community, maker, [product])
+            (featured_maker, featured_products) = FeaturedSnapshot.get_featured(self.community)
+            self.assertTrue(featured_maker.key() == maker.key())
+            self.assertTrue([p.key() for p in featured_products] == [product.key()])
+
+            # read from the snapshot when the cache is empty, leaving out hidden products
+            memcache.flush_all()
+            product.show = False
+            product.put()
+            (featured_maker, featured_products) = FeaturedSnapshot.get_featured(self.community)
+            self.assertTrue(featured_maker.key() == maker.key())
+            self.assertTrue(featured_products == [])
+        finally:
+            db.delete([FeaturedSnapshot.get_by_key_name(str(self.community.key())), product, maker])
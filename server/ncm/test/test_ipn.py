@@ -1,6 +1,9 @@
 import logging
 import unittest
+import datetime
+import urllib
 from google.appengine.ext import db
+from google.appengine.ext import webapp
 from model import *
 from ipn import *
 
@@ -52,7 +55,7 @@ class TestSandboxPayment(unittest.TestCase):
                 parent=self.cart,
                 maker=maker,
                 email=maker.paypal_business_account_email,
-                when='now-ish%d' % i,
+                when_time=datetime.datetime.now(),
                 detail=[entry],
                 )
             transaction.put()
@@ -77,7 +80,7 @@ class TestSandboxPayment(unittest.TestCase):
 
         status = 'COMPLETED'
         
-        IPNHandler.update_inventory(self.cart, status, parameters)
+        IPNHandler.update_inventory(self.cart.key(), status, parameters)
 
         cart = CartTransaction.get(self.cart.key())
         self.assertTrue(cart.transaction_status == status)
@@ -108,7 +111,7 @@ class TestSandboxPayment(unittest.TestCase):
 
         status = 'ERROR'
 
-        IPNHandler.update_inventory(self.cart, status, parameters)
+        IPNHandler.update_inventory(self.cart.key(), status, parameters)
 
         cart = CartTransaction.get(self.cart.key())
         self.assertTrue(cart.transaction_status == status)
@@ -123,3 +126,107 @@ class TestSandboxPayment(unittest.TestCase):
                 product = Product.get(product_key)
                 self.assertTrue(product is not None)
                 self.assertTrue(product.inventory == 10)
+
+    def test_update_inventory_twice(self):
+        """ A retried IPN task must not take the items out of inventory again. """
+        parameters = {'pay_key':'test_key'}
+        for i in range(5):
+            parameters['transaction[%d].status_for_sender_txn' % i] = 'Completed'
+            parameters['transaction[%d].receiver' % i] = self.makers[i].paypal_business_account_email
+
+        IPNHandler.update_inventory(self.cart.key(), 'COMPLETED', parameters)
+        IPNHandler.update_inventory(self.cart.key(), 'COMPLETED', parameters)
+        for i in range(5):
+            product = Product.get(self.products[i].key())
+            self.assertTrue(product.inventory == 10-(i+1))
+
+    def test_update_inventory_large_cart(self):
+        """ A cart of more products than one XG transaction takes still settles. """
+        extra = []
+        for i in range(XG_GROUPS):
+            extra.append(Product(maker=self.makers[0],
+                                 name='Extra Product #%d' % i,
+                                 short_description='Extra #%d' % i,
+                                 description='One of many',
+                                 price=1.00,
+                                 tags=['Test'],
+                                 inventory=10))
+        db.put(extra)
+        transaction = self.maker_transactions[0]
+        transaction.detail += ['%s:1:1.00' % product.key() for product in extra]
+        transaction.put()
+
+        parameters = {'pay_key':'test_key'}
+        for i in range(5):
+            parameters['transaction[%d].status_for_sender_txn' % i] = 'Completed'
+            parameters['transaction[%d].receiver' % i] = self.makers[i].paypal_business_account_email
+        self.assertTrue(IPNHandler.update_inventory(self.cart.key(), 'COMPLETED', parameters))
+
+        cart = CartTransaction.get(self.cart.key())
+        self.assertTrue(cart.transaction_status == 'COMPLETED')
+        self.assertTrue(cart.inventory_pending == [])
+        for product in db.get([product.key() for product in extra]):
+            self.assertTrue(product.inventory == 9)
+        for i in range(5):
+            self.assertTrue(Product.get(self.products[i].key()).inventory == 10-(i+1))
+        db.delete(extra)
+
+    def test_worker_retry(self):
+        """ A worker retried after settling, before its marker, changes nothing. """
+        community = Community(name='Test Community')
+        community.put()
+        fields = {'pay_key':'test_key', 'status':'COMPLETED'}
+        for i in range(5):
+            fields['transaction[%d].status_for_sender_txn' % i] = 'Completed'
+            fields['transaction[%d].receiver' % i] = self.makers[i].paypal_business_account_email
+        ipn = PaypalIPN(parameters=urllib.urlencode(fields.items()))
+        ipn.put()
+        processed_key = PaypalIPNProcessed.key_for('test_key', 'COMPLETED')
+
+        verify = IPNWorker.verify
+        IPNWorker.verify = staticmethod(lambda community, parameters: True)
+        try:
+            for attempt in range(2):
+                db.delete(processed_key)
+                params = urllib.urlencode({'ipn':str(ipn.key()), 'pay_key':'test_key', 'status':'COMPLETED'})
+                request = webapp.Request.blank('/ipn/process?' + params, environ={'REQUEST_METHOD':'POST'})
+                worker = IPNWorker()
+                worker.initialize(request, webapp.Response())
+                worker.post()
+        finally:
+            IPNWorker.verify = verify
+
+        responses = PaypalPaymentResponse.all().ancestor(self.cart).fetch(10)
+        self.assertTrue(len(responses) == 1)
+        for i in range(5):
+            product = Product.get(self.products[i].key())
+            self.assertTrue(product.inventory == 10-(i+1))
+        db.delete(responses + [ipn, community])
+        db.delete(processed_key)
+
+    def test_finish_inventory(self):
+        """ Products listed on the cart are taken out of inventory once. """
+        self.cart.inventory_pending = ['%s:%d' % (product.key(), 2) for product in self.products]
+        self.cart.put()
+        IPNHandler.finish_inventory(self.cart.key())
+        IPNHandler.finish_inventory(self.cart.key())
+        self.assertTrue(CartTransaction.get(self.cart.key()).inventory_pending == [])
+        for product in self.products:
+            self.assertTrue(Product.get(product.key()).inventory == 8)
+
+    def test_processed_key(self):
+        key = PaypalIPNProcessed.key_for('AP-123', 'COMPLETED')
+        self.assertTrue(key.name() == 'AP-123:COMPLETED')
+        self.assertTrue(db.get(key) is None)
+
+    def test_pay_key_cart(self):
+        mapping = PayKeyCart(key_name='AP-456', cart=self.cart)
+        mapping.put()
+        self.assertTrue(PayKeyCart.get_cart('AP-456').key() == self.cart.key())
+        # carts from before the mapping are still found by their pay key
+        self.assertTrue(PayKeyCart.get_cart('test_key').key() == self.cart.key())
+        self.assertTrue(PayKeyCart.get_cart('') is None)
+        self.assertTrue(PayKeyCart.get_cart_key('AP-456') == self.cart.key())
+        self.assertTrue(PayKeyCart.get_cart_key('test_key') == self.cart.key())
+        self.assertTrue(PayKeyCart.get_cart_key('AP-none') is None)
+        mapping.delete()
@@ -1,7 +1,8 @@
 import logging
 import unittest
+import datetime
 from google.appengine.ext import db
-from model import Community, Maker
+from model import Community, Maker, Product, when_stamp
 
 class TestCommunity(unittest.TestCase):
     """ Test the Maker model. """
@@ -62,3 +63,51 @@ class TestCommunity(unittest.TestCase):
             return
 
         self.fail('Failed to throw exception for bad email address: ' + self.maker.paypal_business_account_email)
+
+    def testSetApprovalStatuses(self):
+        Maker.recount_statuses()
+        counts = dict(Maker.get_status_counts())
+        self.assertTrue(counts['Approved'] >= 1)
+
+        changed = Maker.set_approval_statuses([self.maker.key()], 'Review')
+        self.assertTrue(len(changed) == 1)
+        self.assertTrue(Maker.get(self.maker.key()).approval_status == 'Review')
+        after = dict(Maker.get_status_counts())
+        self.assertTrue(after['Approved'] == counts['Approved'] - 1)
+        self.assertTrue(after['Review'] == counts['Review'] + 1)
+
+        # nothing changes if the status is already right
+        self.assertTrue(Maker.set_approval_statuses([self.maker.key()], 'Review') == [])
+        try:
+            Maker.set_approval_statuses([self.maker.key()], 'Nonsense')
+        except db.BadValueError:
+            return
+        self.fail('Accepted an unknown approval status')
+
+    def testFindProductsForMaker(self):
+        products = []
+        for i in range(5):
+            products.append(Product(maker=self.maker,
+                                    name='Thing %d' % i,
+                                    short_description='a test thing',
+                                    description='For testing',
+                                    price=10.0,
+                                    tags=['test'],
+                                    show=(i != 0),
+                                    when=when_stamp(datetime.datetime(2011, 6, i + 1), 'test'),
+                                    when_time=datetime.datetime(2011, 6, i + 1)))
+        db.put(products)
+        try:
+            (page, cursor) = Product.findProductsForMaker(self.maker, 2)
+            self.assertTrue([p.name for p in page] == ['Thing 4', 'Thing 3'])
+            self.assertTrue(cursor is not None)
+            (page, cursor) = Product.findProductsForMaker(self.maker, 2, cursor)
+            self.assertTrue([p.name for p in page] == ['Thing 2', 'Thing 1'])
+            (page, cursor) = Product.findProductsForMaker(self.maker, 2, cursor)
+            self.assertTrue(page == [] and cursor is None)
+
+            # the maker sees hidden products too
+            (page, cursor) = Product.findProductsForMaker(self.maker, 10, for_shoppers=False)
+            self.assertTrue(len(page) == 5 and cursor is None)
+        finally:
+            db.delete(products)
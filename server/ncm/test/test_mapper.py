@@ -0,0 +1,65 @@
+import unittest
+from google.appengine.ext import db
+import mapper
+from mapper import Mapper, MapperJob, MapperShard
+
+class Thing(db.Model):
+    name = db.StringProperty()
+    group = db.StringProperty()
+    touched = db.BooleanProperty(default=False)
+
+class TouchMapper(Mapper):
+    KIND = Thing
+    FILTERS = [('group', 'a')]
+
+    def map(self, thing):
+        if thing.name == 'doomed':
+            return ([], [thing])
+        thing.touched = True
+        return ([thing], [])
+
+class TestMapper(unittest.TestCase):
+    """ Test the batch mapper. """
+
+    def setUp(self):
+        self.things = [Thing(name='thing%d' % i, group='a') for i in range(5)]
+        self.things.append(Thing(name='doomed', group='a'))
+        self.things.append(Thing(name='other', group='b'))
+        db.put(self.things)
+
+    def tearDown(self):
+        db.delete(Thing.all(keys_only=True).fetch(100))
+        db.delete(MapperShard.all(keys_only=True).fetch(100))
+        db.delete(MapperJob.all(keys_only=True).fetch(100))
+
+    def testRun(self):
+        job_id = mapper.start(TouchMapper)
+        mapper.run_slice(job_id, 0, 0)
+        # a repeated task for the same slice does nothing
+        mapper.run_slice(job_id, 0, 0)
+
+        progress = MapperJob.get_by_key_name(job_id).progress()
+        self.assertTrue(progress['finished'] is not None)
+        self.assertTrue(progress['processed'] == 6)
+        self.assertTrue(progress['puts'] == 5 and progress['deletes'] == 1)
+
+        self.assertTrue(Thing.all().filter('touched =', True).count() == 5)
+        self.assertTrue(Thing.all().filter('name =', 'doomed').count() == 0)
+        self.assertTrue(Thing.all().filter('name =', 'other').get().touched == False)
+
+    def testCheckpoint(self):
+        mapper.BATCH_SIZE = 2
+        saved = mapper.SLICE_SECONDS
+        mapper.SLICE_SECONDS = 0
+        try:
+            job_id = mapper.start(TouchMapper)
+            mapper.run_slice(job_id, 0, 0)
+            shard = MapperShard.get_by_key_name(mapper.shard_name(job_id, 0))
+            self.assertTrue(shard.processed == 2 and shard.slice == 1 and not shard.done)
+            for slice_number in range(1, 4):
+                mapper.run_slice(job_id, 0, slice_number)
+            shard = MapperShard.get_by_key_name(mapper.shard_name(job_id, 0))
+            self.assertTrue(shard.done and shard.processed == 6)
+        finally:
+            mapper.BATCH_SIZE = 100
+            mapper.SLICE_SECONDS = saved
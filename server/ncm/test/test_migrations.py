@@ -0,0 +1,90 @@
+import unittest
+import datetime
+from google.appengine.api import datastore
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from model import *
+import mapper
+import migrations
+
+class TestMigrations(unittest.TestCase):
+    """ Test data migrations. """
+
+    def setUp(self):
+        memcache.delete(WhenTimeBackfill.cache_key('Product'))
+        self.maker = Maker(store_name='Test Store',
+                           store_description='Nothing',
+                           full_name='Maker',
+                           email='maker@example.com',
+                           paypal_business_account_email='maker@example.com',
+                           phone_number='5305551212',
+                           location='Test Place',
+                           mailing_address='111 Test Ave, Tester CA, 95945',
+                           tags=['tests'])
+        self.maker.put()
+        # stored before when_time existed, so without the property at all
+        self.legacy = []
+        for when in ['2011-06-14 09:30:00.000120|0123456789abcdef', '2011-06-15 10:00:00|fedcba9876543210', 'junk']:
+            entity = datastore.Entity('Product')
+            entity.update({'maker':self.maker.key(),
+                           'name':'Thing',
+                           'short_description':'a test thing',
+                           'description':db.Text('For testing'),
+                           'price':10.0,
+                           'tags':['test'],
+                           'inventory':1,
+                           'show':True,
+                           'disable':False,
+                           'category':'Unclassifiable',
+                           'when':when})
+            self.legacy.append(datastore.Put(entity))
+        now = datetime.datetime.now()
+        self.new = Product(maker=self.maker,
+                           name='New Thing',
+                           short_description='a test thing',
+                           description='For testing',
+                           price=10.0,
+                           tags=['test'],
+                           when=when_stamp(now, str(self.maker.key())),
+                           when_time=now)
+        self.new.put()
+
+    def tearDown(self):
+        db.delete(mapper.MapperShard.all(keys_only=True).fetch(100))
+        db.delete(mapper.MapperJob.all(keys_only=True).fetch(100))
+        db.delete(WhenTimeBackfill.all(keys_only=True).fetch(100))
+        memcache.delete(WhenTimeBackfill.cache_key('Product'))
+        db.delete(self.legacy + [self.new.key(), self.maker.key()])
+
+    def testParseWhenStamp(self):
+        self.assertTrue(migrations.parse_when_stamp('2011-06-14 09:30:00.000120|abc') ==
+                        datetime.datetime(2011, 6, 14, 9, 30, 0, 120))
+        self.assertTrue(migrations.parse_when_stamp('2011-06-14 09:30:00|abc') ==
+                        datetime.datetime(2011, 6, 14, 9, 30))
+        self.assertTrue(migrations.parse_when_stamp('now-ish') is None)
+        self.assertTrue(migrations.parse_when_stamp(None) is None)
+
+    def testProductWhenTime(self):
+        # listed by the old stamps until the backfill is done
+        self.assertTrue(WhenTimeBackfill.newest_first('Product') == '-when')
+        self.assertTrue(WhenTimeBackfill.needs_stamp('Product'))
+        (page, cursor) = Product.findProductsForMaker(self.maker, 10)
+        self.assertTrue(len(page) == 4)
+
+        job_id = mapper.start(migrations.ProductWhenTime)
+        mapper.run_slice(job_id, 0, 0)
+        progress = mapper.MapperJob.get_by_key_name(job_id).progress()
+        self.assertTrue(progress['processed'] == 4 and progress['puts'] == 3)
+
+        products = db.get(self.legacy)
+        self.assertTrue(products[0].when_time == datetime.datetime(2011, 6, 14, 9, 30, 0, 120))
+        self.assertTrue(products[1].when_time == datetime.datetime(2011, 6, 15, 10))
+        self.assertTrue(products[2].when_time is not None)
+
+        # newest first, by when_time now
+        self.assertTrue(WhenTimeBackfill.newest_first('Product') == '-when_time')
+        self.assertTrue(not WhenTimeBackfill.needs_stamp('Product'))
+        (page, cursor) = Product.findProductsForMaker(self.maker, 10)
+        self.assertTrue(len(page) == 4)
+        self.assertTrue(page[0].key() == self.new.key())
+        self.assertTrue(page[1].key() == self.legacy[1])
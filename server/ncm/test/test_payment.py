@@ -1,6 +1,8 @@
 import unittest
 from google.appengine.api import users
+from google.appengine.api import memcache
 from payment import *
+import payment
 
 class TestPayment(unittest.TestCase):
     """ Test payment (currently only via Paypal) """
@@ -10,7 +12,7 @@ class TestPayment(unittest.TestCase):
         pass
 
     def tearDown(self):
-        pass
+        memcache.delete_multi([payment.CIRCUIT_FAILURES_KEY, payment.CIRCUIT_OPEN_KEY])
 
     def testDummyChainedPayment(self):
         amounts = [1.00,2.00,3.00,4.00,5.00]
@@ -69,4 +71,30 @@ class TestPayment(unittest.TestCase):
             exceptionThrown = True;
 
         self.assertTrue(exceptionThrown)
-            
+
+    def testCircuitBreaker(self):
+        for i in range(payment.CIRCUIT_FAILURES - 1):
+            payment._record_paypal_failure()
+        self.assertTrue(not paypal_circuit_open())
+        payment._record_paypal_failure()
+        self.assertTrue(paypal_circuit_open())
+
+        chained = PaypalChainedPayment(
+            primary_recipient=('test@example.com', 0.50),
+            additional_recipients=[('test1@example.com', 1.00)],
+            api_username='test@example.com',
+            api_password='fake_pass',
+            api_signature='fake_sig',
+            application_id='fake_id',
+            client_ip='127.0.0.1',
+            cancel_url='http://example.com/cancel',
+            return_url='http://example.com/return',
+            action_url='http://notreally.sandbox.paypal.com',
+            ipn_url='http://example.com/ipn',
+            )
+        exceptionThrown = False
+        try:
+            chained.start()
+        except PaypalUnavailableException:
+            exceptionThrown = True
+        self.assertTrue(exceptionThrown)
@@ -0,0 +1,69 @@
+import unittest
+import datetime
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from model import *
+import reservation
+from reservation import InventoryHold
+
+class TestReservation(unittest.TestCase):
+    """ Test inventory holds for carts in checkout. """
+
+    def setUp(self):
+        memcache.flush_all()
+        self.maker = Maker(store_name='Test Store',
+                           store_description='Nothing',
+                           full_name='Maker',
+                           email='maker@example.com',
+                           paypal_business_account_email='maker@example.com',
+                           phone_number='5305551212',
+                           location='Test Place',
+                           mailing_address='111 Test Ave, Tester CA, 95945',
+                           tags=['tests'])
+        self.maker.put()
+        self.product = Product(maker=self.maker,
+                               name='Unique Thing',
+                               short_description='one of a kind',
+                               description='Only two of these',
+                               price=50.0,
+                               tags=['Test'],
+                               inventory=2)
+        self.product.put()
+        self.key = str(self.product.key())
+        self.products = {self.key:self.product}
+
+    def tearDown(self):
+        memcache.flush_all()
+        db.delete(InventoryHold.all(keys_only=True).fetch(100))
+        db.delete([self.product, self.maker])
+
+    def cart_key(self):
+        return db.Key.from_path('CartTransaction', db.allocate_ids(db.Key.from_path('CartTransaction', 1), 1)[0])
+
+    def testHoldAndRelease(self):
+        (holds, short) = reservation.place_holds(self.cart_key(), self.products, {self.key:2})
+        self.assertTrue(short is None)
+        db.put(holds)
+        self.assertTrue(reservation.available(self.product) == 0)
+
+        # a second shopper can't check out the same items
+        (others, short) = reservation.place_holds(self.cart_key(), self.products, {self.key:1})
+        self.assertTrue(others is None)
+        self.assertTrue(short.key() == self.product.key())
+        self.assertTrue(reservation.available(self.product) == 0)
+
+        reservation.release_cart(holds[0].parent_key())
+        self.assertTrue(reservation.available(self.product) == 2)
+
+    def testHeldRebuiltFromHolds(self):
+        (holds, short) = reservation.place_holds(self.cart_key(), self.products, {self.key:1})
+        db.put(holds)
+        memcache.flush_all()
+        self.assertTrue(reservation.held([self.key])[self.key] == 1)
+
+    def testReleaseExpired(self):
+        (holds, short) = reservation.place_holds(self.cart_key(), self.products, {self.key:2})
+        holds[0].expires = datetime.datetime.now() - datetime.timedelta(minutes=1)
+        db.put(holds)
+        self.assertTrue(reservation.release_expired() == 1)
+        self.assertTrue(reservation.available(self.product) == 2)
@@ -1,8 +1,14 @@
 import unittest
+import os
 import logging
+import datetime
+from google.appengine.api import memcache
 from google.appengine.ext import db
+from google.appengine.ext import webapp
 from model import *
+import gaesessions
 import ncm
+import rpcjson
 
 class TestRPCHandlers(unittest.TestCase):
     """ Test RPC call handlers. """
@@ -64,7 +70,7 @@ class TestRPCHandlers(unittest.TestCase):
             email=self.maker.email,
             detail=details,
             shipped=False,
-            when='1',
+            when_time=datetime.datetime.now(),
             status='Paid',
             )
         self.makerTransaction.put()
@@ -91,3 +97,133 @@ class TestRPCHandlers(unittest.TestCase):
         self.assertTrue(sale['amount'] == '26.00')
         self.assertTrue(sale['fee'] == '3.95')
         self.assertTrue(sale['net'] == '22.05')
+
+    def test_buildTransactionRowBatched(self):
+        """ Rows built from batch loaded carts and names match the plain ones. """
+        fee_percentage = (self.community.paypal_fee_percentage + self.community.fee_percentage)*0.01
+        fee_minimum = self.community.paypal_fee_minimum + self.community.fee_minimum
+        (plain, items, sales) = ncm._buildTransactionRow(self.community, self.makerTransaction, fee_percentage, fee_minimum)
+        (carts, product_names) = ncm._loadTransactionRowData([self.makerTransaction])
+        self.assertTrue(self.cartTransaction.key() in carts)
+        (batched, items, sales) = ncm._buildTransactionRow(self.community, self.makerTransaction, fee_percentage, fee_minimum,
+                                                            cart=carts[self.makerTransaction.parent_key()],
+                                                            product_names=product_names,
+                                                            time_zone=self.community.timeZone)
+        self.assertTrue(batched == plain)
+
+    def test_entityCache(self):
+        """ RPC methods sharing a cache read each entity once. """
+        cache = ncm.EntityCache()
+        (maker, missing) = cache.get([self.maker.key(), db.Key.from_path('Maker', 'no-such-maker')])
+        self.assertTrue(maker.key() == self.maker.key())
+        self.assertTrue(missing is None)
+        self.assertTrue(cache.get([str(self.maker.key())])[0] is maker)
+
+        getMethods = ncm.RPCGetMethods(cache)
+        postMethods = ncm.RPCPostMethods(cache)
+        self.assertTrue(getMethods.cache is postMethods.cache)
+        result = postMethods.AddProductToCart(None, str(self.maker.key()))
+        self.assertTrue(result["alert1"] == "Product Not Found")
+
+    def test_decodeArgs(self):
+        """ Positional, named and form field arguments decode the same way. """
+        def request(body, content_type):
+            r = webapp.Request.blank('/rpc/Test', environ={'REQUEST_METHOD':'POST'})
+            r.headers['Content-Type'] = content_type
+            r.body = body
+            return r
+        expected = (u'name', [1, 2], None)
+        self.assertTrue(rpcjson.decode_args(request('["name", [1, 2], null]', 'application/json')) == expected)
+        self.assertTrue(rpcjson.decode_args(request('{"arg0":"name", "arg1":[1, 2], "arg2":null}',
+                                                    'application/json; charset=utf-8')) == expected)
+        self.assertTrue(rpcjson.decode_args(request('arg0=%22name%22&arg1=%5B1%2C2%5D',
+                                                    'application/x-www-form-urlencoded')) == expected[:2])
+        try:
+            rpcjson.decode_args(request('"name"', 'application/json'))
+        except ValueError:
+            return
+        self.fail('Accepted a JSON body that is not a list or an object')
+
+    def test_getShoppingCartCached(self):
+        """ An unchanged cart is served from memcache until it changes. """
+        saved_session = gaesessions._current_session
+        saved_cookie = os.environ.get('HTTP_COOKIE')
+        os.environ['HTTP_COOKIE'] = ''
+        gaesessions._current_session = gaesessions.Session(cookie_key='a test key which is long enough for RFC2104 0123456789',
+                                                           backend=gaesessions.InProcessBackend())
+        try:
+            methods = ncm.RPCPostMethods()
+            methods.AddProductToCart(None, str(self.products[0].key()))
+            methods.AddProductToCart(None, str(self.products[1].key()))
+            cart = ncm.RPCGetMethods().GetShoppingCart(None)
+            self.assertTrue(len(cart['products']) == 2)
+            self.assertTrue(cart['amount'] == '13.00')
+
+            version = gaesessions._current_session['CartVersion']
+            self.assertTrue(memcache.get('cart:' + version)['results'] == cart)
+
+            # editing a product in the cart rebuilds it
+            product = Product.get(self.products[0].key())
+            product.name = 'Renamed'
+            product.put()
+            ncm.entity_changed(product.key())
+            cart = ncm.RPCGetMethods().GetShoppingCart(None)
+            self.assertTrue('Renamed' in [p['name'] for p in cart['products']])
+            self.assertTrue(gaesessions._current_session['CartVersion'] == version)
+
+            methods.RemoveAllProductFromCart(None, str(self.products[0].key()))
+            self.assertTrue(gaesessions._current_session['CartVersion'] != version)
+            cart = ncm.RPCGetMethods().GetShoppingCart(None)
+            self.assertTrue(len(cart['products']) == 1)
+        finally:
+            gaesessions._current_session = saved_session
+            if saved_cookie is None:
+                os.environ.pop('HTTP_COOKIE', None)
+            else:
+                os.environ['HTTP_COOKIE'] = saved_cookie
+            memcache.flush_all()
+
+    def test_exportCells(self):
+        """ Export cells keep zeros and can't start a formula. """
+        cell = ncm.MakerSalesExport.csvCell
+        self.assertTrue(cell(None) == '')
+        self.assertTrue(cell(0.0) == '0.0')
+        self.assertTrue(cell('=HYPERLINK("http://example.com")') == '\'=HYPERLINK("http://example.com")')
+        self.assertTrue(cell('@SUM(A1)') == "'@SUM(A1)")
+        self.assertTrue(cell(u'Caf\xe9') == 'Caf\xc3\xa9')
+
+    def test_batchCallsValidated(self):
+        """ A batch must be [method, [args]] pairs, or none of it runs. """
+        valid = ncm.RPCBatchHandler.valid_calls
+        self.assertTrue(valid([["GetShoppingCart", []], ["AddProductToCart", ["key"]]]))
+        self.assertTrue(valid([]))
+        self.assertTrue(not valid({"GetShoppingCart":[]}))
+        self.assertTrue(not valid([["GetShoppingCart"]]))
+        self.assertTrue(not valid([["GetShoppingCart", "key"]]))
+        self.assertTrue(not valid([[1, []]]))
+        self.assertTrue(not valid([["GetShoppingCart", []], "RemoveAll"]))
+
+    def test_batchLimitsAndFailures(self):
+        """ Long batches are refused, and a failing call doesn't fail the batch. """
+        def post(calls):
+            handler = ncm.RPCBatchHandler()
+            request = webapp.Request.blank('/rpc/batch', environ={'REQUEST_METHOD':'POST'})
+            request.headers['Content-Type'] = 'application/json'
+            request.body = rpcjson.simplejson.dumps(calls)
+            handler.initialize(request, webapp.Response())
+            handler.post()
+            return handler.response
+
+        response = post([["GetShoppingCart", []]] * (ncm.RPCBatchHandler.MAX_BATCH_CALLS + 1))
+        self.assertTrue(response.status == 400)
+
+        def broken(request, *args):
+            raise ValueError('broken')
+        ncm.RPCGetMethods.Broken = staticmethod(broken)
+        try:
+            response = post([["Broken", []], ["Unknown", []]])
+        finally:
+            del ncm.RPCGetMethods.Broken
+        self.assertTrue(response.status == 200)
+        results = rpcjson.simplejson.loads(response.out.getvalue())
+        self.assertTrue(len(results) == 2 and "alert1" in results[0] and "alert1" in results[1])
@@ -0,0 +1,88 @@
+import unittest
+import datetime
+from google.appengine.ext import db
+from model import *
+import salesrollup
+from salesrollup import MakerSalesRollup
+
+def withinDelta(x, y, d=0.005):
+    return x - y < d and y - x < d
+
+class TestSalesRollup(unittest.TestCase):
+    """ Test per maker day and month sales rollups. """
+
+    def setUp(self):
+        self.community = Community(name='Test Community')
+        self.community.put()
+        self.maker = Maker(store_name='Test Store',
+                           store_description='Nothing',
+                           full_name='Maker',
+                           email='maker@example.com',
+                           paypal_business_account_email='maker@example.com',
+                           phone_number='5305551212',
+                           location='Test Place',
+                           mailing_address='111 Test Ave, Tester CA, 95945',
+                           tags=['tests'])
+        self.maker.put()
+        self.cart = CartTransaction(transaction_status='COMPLETED')
+        self.cart.put()
+        self.transaction = MakerTransaction(parent=self.cart,
+                                            maker=self.maker,
+                                            email=self.maker.paypal_business_account_email,
+                                            when_time=datetime.datetime.now(),
+                                            status='Paid',
+                                            detail=['product1:2:10.00:1.00', 'product2:1:5.00'])
+        self.transaction.put()
+        self.day = salesrollup.sale_for(self.community, self.transaction, self.cart)['day']
+
+    def tearDown(self):
+        db.delete(MakerSalesRollup.all(keys_only=True).ancestor(self.maker).fetch(100))
+        db.delete([self.transaction, self.cart, self.maker, self.community])
+
+    def testSaleFor(self):
+        sale = salesrollup.sale_for(self.community, self.transaction, self.cart)
+        self.assertTrue(sale['units'] == 3)
+        self.assertTrue(withinDelta(sale['gross'], 25.00))
+        self.assertTrue(withinDelta(sale['shipping'], 2.00))
+        self.assertTrue(withinDelta(sale['fees'], 27.00 * 0.129 + 0.60))
+        self.assertTrue(withinDelta(sale['net'], 27.00 - sale['fees']))
+
+    def testApplyOnce(self):
+        salesrollup.apply_cart(self.community, self.cart)
+        salesrollup.apply_cart(self.community, self.cart)
+        self.assertTrue(MakerTransaction.get(self.transaction.key()).rolled_up)
+
+        day = MakerSalesRollup.get(salesrollup.rollup_key(self.maker.key(), 'day', self.day))
+        month = MakerSalesRollup.get(salesrollup.rollup_key(self.maker.key(), 'month', self.day))
+        self.assertTrue(day.units == 3 and day.transactions == 1)
+        self.assertTrue(month.units == 3 and month.transactions == 1)
+
+        totals = salesrollup.get_totals(self.maker.key(), self.day.replace(day=1), self.day)
+        self.assertTrue(totals['units'] == 3)
+        self.assertTrue(withinDelta(totals['gross'], 25.00))
+        self.assertTrue(salesrollup.get_lifetime_totals(self.maker.key())['units'] == 3)
+
+        before = self.day - datetime.timedelta(days=1)
+        self.assertTrue(salesrollup.get_totals(self.maker.key(), before, before)['units'] == 0)
+
+    def testRebuild(self):
+        salesrollup.apply_cart(self.community, self.cart)
+        salesrollup.rebuild_maker(self.community, self.maker.key())
+        totals = salesrollup.get_lifetime_totals(self.maker.key())
+        self.assertTrue(totals['units'] == 3)
+        self.assertTrue(totals['transactions'] == 1)
+
+    def testRebuildLock(self):
+        """ An apply waits out a rebuild, and a rebuild drops stale rollups. """
+        db.put(salesrollup.MakerRollupRebuild(key=salesrollup.rebuild_lock_key(self.maker.key())))
+        self.assertRaises(salesrollup.RebuildInProgress, salesrollup.apply_cart, self.community, self.cart)
+        self.assertTrue(not MakerTransaction.get(self.transaction.key()).rolled_up)
+
+        stale = MakerSalesRollup(key=salesrollup.rollup_key(self.maker.key(), 'month', datetime.date(2001, 1, 1)),
+                                 period='month', start=datetime.date(2001, 1, 1), units=7)
+        stale.put()
+        salesrollup.rebuild_maker(self.community, self.maker.key())
+        self.assertTrue(db.get(salesrollup.rebuild_lock_key(self.maker.key())) is None)
+        self.assertTrue(MakerSalesRollup.get(stale.key()) is None)
+        self.assertTrue(MakerTransaction.get(self.transaction.key()).rolled_up)
+        self.assertTrue(salesrollup.get_lifetime_totals(self.maker.key())['units'] == 3)
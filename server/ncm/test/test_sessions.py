@@ -0,0 +1,63 @@
+import os
+import unittest
+from google.appengine.api import memcache
+from gaesessions import Session, InProcessBackend, MemcacheBackend
+
+TEST_COOKIE_KEY = 'a test key which is long enough for RFC2104 0123456789'
+
+class TestSessionBackends(unittest.TestCase):
+    """ Test that sessions round trip through each backend. """
+
+    def setUp(self):
+        self.saved_cookie = os.environ.get('HTTP_COOKIE')
+        os.environ['HTTP_COOKIE'] = ''
+
+    def tearDown(self):
+        if self.saved_cookie is None:
+            os.environ.pop('HTTP_COOKIE', None)
+        else:
+            os.environ['HTTP_COOKIE'] = self.saved_cookie
+        memcache.flush_all()
+
+    def roundTrip(self, backend):
+        # A threshold of zero keeps the data out of the cookie
+        session = Session(cookie_key=TEST_COOKIE_KEY, cookie_only_threshold=0, backend=backend)
+        session['cart'] = ['a', 'b']
+        session.save()
+        sid = session.sid
+        self.assertTrue(backend.get(sid) is not None)
+
+        loaded = Session(sid=sid, cookie_key=TEST_COOKIE_KEY, cookie_only_threshold=0, backend=backend)
+        self.assertTrue(loaded.get('cart') == ['a', 'b'])
+
+        loaded.terminate()
+        self.assertTrue(backend.get(sid) is None)
+
+    def testInProcessBackend(self):
+        self.roundTrip(InProcessBackend())
+
+    def testMemcacheBackend(self):
+        self.roundTrip(MemcacheBackend())
+
+    def testLostSessionIsTerminated(self):
+        backend = InProcessBackend()
+        session = Session(sid='0000000000_' + '0' * 32, cookie_key=TEST_COOKIE_KEY, backend=backend)
+        self.assertTrue(session.get('cart') is None)
+        self.assertFalse(session.is_active())
+
+    def testCompressedCookie(self):
+        session = Session(cookie_key=TEST_COOKIE_KEY, backend=InProcessBackend())
+        cart = ['product key %d' % i for i in range(200)]
+        session['cart'] = cart
+        session.save()
+        headers = session.make_cookie_headers()
+        # ~4KB pickled, ~5.5KB once base64 encoded if it weren't compressed
+        self.assertTrue(len(headers) == 1)
+        self.assertTrue(len(headers[0]) < 2048)
+
+        # Replay the cookie the way the browser would on the next request
+        (name, value) = headers[0].split(';')[0].strip().split('=', 1)
+        os.environ['HTTP_COOKIE'] = '%s=%s' % (name, value)
+        loaded = Session(cookie_key=TEST_COOKIE_KEY, backend=InProcessBackend())
+        self.assertTrue(loaded.sid == session.sid)
+        self.assertTrue(loaded.get('cart') == cart)
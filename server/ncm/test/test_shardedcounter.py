@@ -0,0 +1,87 @@
+import unittest
+from google.appengine.api import memcache
+from google.appengine.ext import db
+import shardedcounter
+from shardedcounter import GeneralCounterShard, GeneralCounterShardConfig
+
+def shard_total(name):
+    total = 0
+    for shard in GeneralCounterShard.all().filter('name =', name):
+        total += shard.count
+    return total
+
+class TestShardedCounter(unittest.TestCase):
+    """ Test direct and buffered sharded counters. """
+
+    def setUp(self):
+        self.name = 'test_counter'
+
+    def tearDown(self):
+        memcache.flush_all()
+        shardedcounter._registered.clear()
+        shardedcounter._config_cache.clear()
+        db.delete(GeneralCounterShard.all(keys_only=True).filter('name =', self.name).fetch(100))
+        db.delete(GeneralCounterShardConfig.get_by_key_name(self.name))
+
+    def testIncrement(self):
+        shardedcounter.increment(self.name, 5)
+        shardedcounter.decrement(self.name)
+        self.assertTrue(shardedcounter.get_count(self.name) == 4)
+        self.assertTrue(shard_total(self.name) == 4)
+
+    def testBufferedIncrement(self):
+        shardedcounter.increment(self.name, 3)
+        shardedcounter.increment(self.name, 5, buffered=True)
+        shardedcounter.decrement(self.name, buffered=True)
+        # pending changes are counted but haven't reached the shards
+        self.assertTrue(shardedcounter.get_count(self.name) == 7)
+        self.assertTrue(shard_total(self.name) == 3)
+        self.assertTrue(GeneralCounterShardConfig.get_by_key_name(self.name).buffered)
+
+        self.assertTrue(shardedcounter.flush() >= 1)
+        self.assertTrue(shard_total(self.name) == 7)
+        self.assertTrue(shardedcounter.get_count(self.name) == 7)
+
+        # nothing left to write
+        self.assertTrue(shardedcounter.flush([self.name]) == 0)
+
+    def testBufferedDecrementBelowZero(self):
+        shardedcounter.decrement(self.name, buffered=True)
+        shardedcounter.decrement(self.name, buffered=True)
+        self.assertTrue(shardedcounter.flush([self.name]) == 1)
+        self.assertTrue(shard_total(self.name) == -2)
+
+    def testInlineFlush(self):
+        shardedcounter.increment(self.name, shardedcounter.MAX_PENDING, buffered=True)
+        self.assertTrue(shard_total(self.name) == shardedcounter.MAX_PENDING)
+
+    def testShardConfigCache(self):
+        self.assertTrue(shardedcounter.get_num_shards(self.name) == 20)
+        shardedcounter.increase_shards(self.name, 40)
+        self.assertTrue(shardedcounter.get_num_shards(self.name) == 40)
+        shardedcounter.increase_shards(self.name, 10)
+        self.assertTrue(shardedcounter.get_num_shards(self.name) == 40)
+
+    def testContentionAddsShards(self):
+        for i in range(shardedcounter.CONTENTION_SAMPLE):
+            shardedcounter._record_contention(self.name, 2)
+        config = GeneralCounterShardConfig.get_by_key_name(self.name)
+        self.assertTrue(config.collision_rate == 1.0)
+        self.assertTrue(config.num_shards == 40)
+        self.assertTrue(shardedcounter.get_num_shards(self.name) == 40)
+        self.assertTrue(shardedcounter.hot_counters(1)[0].name == self.name)
+
+    def testGetCounts(self):
+        other = self.name + '_other'
+        shardedcounter.increment(self.name, 4)
+        shardedcounter.increment(other, 2, buffered=True)
+        memcache.delete(self.name)
+        counts = shardedcounter.get_counts([self.name, other, self.name + '_never_used'])
+        self.assertTrue(counts[self.name] == 4)
+        self.assertTrue(counts[other] == 2)
+        self.assertTrue(counts[self.name + '_never_used'] == 0)
+        # the totals were cached for the next read
+        self.assertTrue(memcache.get(self.name) == '4')
+        shardedcounter.flush([other])
+        db.delete(GeneralCounterShard.all(keys_only=True).filter('name =', other).fetch(100))
+        db.delete(GeneralCounterShardConfig.get_by_key_name(other))
@@ -1,5 +1,7 @@
 import unittest
 import logging
+import datetime
+from google.appengine.api import memcache
 from google.appengine.ext import db
 from model import *
 from payment import *
@@ -53,7 +55,8 @@ class TestShopping(unittest.TestCase):
                               tags=['stuff', 'things'],
                               show=True,
                               disable=False,
-                              when=Product.buildWhenStamp(self.makers[i]),
+                              when=when_stamp(datetime.datetime.now(), str(self.makers[i].key())),
+                              when_time=datetime.datetime.now(),
                               inventory=1000,
                               category=self.community.categories[count % len(self.community.categories)]
                                          ))
@@ -118,6 +121,26 @@ class TestShopping(unittest.TestCase):
         self.assertTrue(email == 'maker5@gmail.com')
         self.assertTrue(withinDelta(amount, 4.63))
 
+    def testCreateForCart(self):
+        cart_items = []
+        for product in self.products:
+            cart_items.append(ShoppingCartItem(product_key=str(product.key()),
+                                               count=2,
+                                               price=product.price,
+                                               shipping=1.0))
+        products = ShoppingCartItem.loadProducts(cart_items)
+        self.assertTrue(len(products) == len(self.products))
+
+        (cart, maker_transactions) = CartTransaction.createForCart(cart_items, products, False)
+        self.assertTrue(cart.key().id() is not None)
+        self.assertTrue(len(maker_transactions) == 6)
+        details = 0
+        for maker_transaction in maker_transactions:
+            self.assertTrue(maker_transaction.parent_key() == cart.key())
+            details += len(maker_transaction.detail)
+        self.assertTrue(details == len(self.products))
+        self.assertTrue(maker_transactions[0].detail[0] == "%s:2:1.0:1.0" % str(self.products[0].key()))
+
     def testFindProductsByTag(self):
         """ Test searching for products with a single tag. """
         self.products[1].tags.append('grails')
@@ -155,7 +178,8 @@ class TestShopping(unittest.TestCase):
         self.assertTrue(latest[3].key() == self.products[5].key())
         
     def testFeatured(self):
-        (maker, featured) = Product.getFeatured(4, self.community)
+        memcache.delete(FeaturedSnapshot.cache_key(self.community))
+        (maker, featured) = FeaturedSnapshot.get_featured(self.community)
         self.assertTrue(maker is not None)
         self.assertTrue(str(maker.key()) == self.community.featured_maker)
         self.assertTrue(featured is not None)
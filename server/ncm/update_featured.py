@@ -16,34 +16,36 @@
 #  You should have received a copy of the GNU General Public License
 #  along with Creare.  If not, see <http://www.gnu.org/licenses/>.
 #
+# Rotate the featured maker: the next approved maker (in joined order)
+# with products to show becomes featured, and their newest products are
+# stored in a FeaturedSnapshot for the home page.
+#
 import logging
 from model import *
 
 def get_maker_with_products(makers):
-    if makers:
-        next_maker = None
-        for maker in makers:
-            product = Product.all(keys_only=True).filter('maker =', maker).filter('disable =', False).filter('show =', True).get()
-            if product:
-                next_maker = maker
-                break
-    return next_maker
-        
+    for maker in makers:
+        (products, next_cursor) = Product.findProductsForMaker(maker, FeaturedSnapshot.SIZE)
+        if products:
+            return (maker, products)
+    return (None, None)
+
 community = Community.all().get()
 current = None
 if community.featured_maker:
     current = Maker.get(community.featured_maker)
 
-next_maker = None
+(next_maker, products) = (None, None)
 if current:
-    makers = Maker.all(keys_only=True).order('joined').filter('joined >', current.joined).filter('approval_status =', 'Approved')
-    next_maker = get_maker_with_products(makers)
+    makers = Maker.all().order('joined').filter('joined >', current.joined).filter('approval_status =', 'Approved')
+    (next_maker, products) = get_maker_with_products(makers)
 
 if not next_maker:
-    makers = Maker.all(keys_only=True).order('joined').filter('approval_status =', 'Approved')
-    next_maker = get_maker_with_products(makers)
+    makers = Maker.all().order('joined').filter('approval_status =', 'Approved')
+    (next_maker, products) = get_maker_with_products(makers)
 
 if next_maker:
-    community.featured_maker = str(next_maker)
+    community.featured_maker = str(next_maker.key())
     community.put()
-    
+    FeaturedSnapshot.take(community, next_maker, products)
+    logging.info('Featuring %s with %d products' % (next_maker.store_name, len(products)))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#  Copyright 2011 Bill Glover
+#
+#  This file is part of Creare.
+#
+#  Creare is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Creare is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Creare.  If not, see <http://www.gnu.org/licenses/>.
+#
+# End to end checkout throughput against a running app whose community
+# points at paypal_simulator.py. Each simulated shopper adds products to
+# a cart, checks out, approves the payment at the simulator and follows
+# the redirect back to /return; the simulator then sends the IPN.
+#
+#   python checkout_benchmark.py --app http://localhost:8080 \
+#       --shoppers 10 --checkouts 20 PRODUCT_KEY [PRODUCT_KEY ...]
+#
+# Products need enough inventory for every checkout.
+#
+import random
+import threading
+import time
+import urllib
+import urllib2
+import cookielib
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class Shopper(threading.Thread):
+    """ Checks out over and over, recording how each attempt went. """
+    def __init__(self, options, products, results):
+        threading.Thread.__init__(self)
+        self.options = options
+        self.products = products
+        self.results = results
+
+    def rpc(self, opener, method, *args):
+        fields = [('arg%d' % i, json.dumps(arg)) for (i, arg) in enumerate(args)]
+        response = opener.open(self.options.app + '/rpc/' + method, urllib.urlencode(fields), 60)
+        return json.loads(response.read())
+
+    def checkout(self):
+        opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+        for product in random.sample(self.products, min(self.options.lines, len(self.products))):
+            result = self.rpc(opener, 'AddProductToCart', product)
+            if 'alert1' in result:
+                return 'add failed: ' + result['alert1']
+        start = time.time()
+        result = self.rpc(opener, 'OrderProductsInCart', 'Bench Shopper', 'shopper@example.com',
+                          '5305551212', '1 Bench St')
+        checkout_seconds = time.time() - start
+        if 'redirect' not in result:
+            return 'checkout failed: ' + str(result.get('message') or result.get('alert1'))
+        # approve at the simulator, which redirects back to /return
+        opener.open(result['redirect'], None, 60).read()
+        return checkout_seconds
+
+    def run(self):
+        for i in range(self.options.checkouts):
+            start = time.time()
+            try:
+                outcome = self.checkout()
+            except Exception, e:
+                outcome = 'error: %s' % e
+            self.results.append((time.time() - start, outcome))
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def main():
+    parser = OptionParser(usage='%prog [options] PRODUCT_KEY [PRODUCT_KEY ...]')
+    parser.add_option('--app', default='http://localhost:8080')
+    parser.add_option('--shoppers', type='int', default=10, help='concurrent shoppers')
+    parser.add_option('--checkouts', type='int', default=10, help='checkouts per shopper')
+    parser.add_option('--lines', type='int', default=3, help='products per cart')
+    (options, products) = parser.parse_args()
+    if not products:
+        parser.error('give at least one product key')
+
+    results = []
+    shoppers = [Shopper(options, products, results) for i in range(options.shoppers)]
+    start = time.time()
+    for shopper in shoppers:
+        shopper.start()
+    for shopper in shoppers:
+        shopper.join()
+    elapsed = time.time() - start
+
+    checkout_times = [outcome for (seconds, outcome) in results if not isinstance(outcome, str)]
+    failures = {}
+    for (seconds, outcome) in results:
+        if isinstance(outcome, str):
+            failures[outcome] = failures.get(outcome, 0) + 1
+
+    print '%d checkouts in %.1f s: %.2f completed/s' % (len(results), elapsed, len(checkout_times) / elapsed)
+    print 'OrderProductsInCart p50 %.0f ms, p90 %.0f ms, max %.0f ms' % (
+        percentile(checkout_times, 0.5) * 1000,
+        percentile(checkout_times, 0.9) * 1000,
+        percentile(checkout_times, 1.0) * 1000)
+    for (outcome, count) in sorted(failures.items()):
+        print '%5d  %s' % (count, outcome)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#  Copyright 2011 Bill Glover
+#
+#  This file is part of Creare.
+#
+#  Creare is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Creare is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Creare.  If not, see <http://www.gnu.org/licenses/>.
+#
+# A stand-in for the parts of Paypal that checkout talks to, for load
+# testing offline. It runs outside the app, e.g.
+#
+#   python paypal_simulator.py --port 8090 --latency 0.8 --error-rate 0.05
+#
+# then set the community's "Paypal simulator URL" to
+# http://localhost:8090 (it is only used while use_sandbox is on).
+#
+# It speaks:
+#   POST /AdaptivePayments/Pay      the NV Pay API, returns a pay key
+#   GET  /webscr?cmd=_ap-payment    the shopper approving the payment:
+#                                   redirects to the return URL and sends
+#                                   the IPN (add &action=cancel to cancel)
+#   POST /cgi-bin/webscr            _notify-validate for IPNs we sent
+#
+import BaseHTTPServer
+import SocketServer
+import logging
+import random
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+from cgi import parse_qsl
+from optparse import OptionParser
+
+class Simulator(object):
+    """ The simulated Paypal's settings and state. """
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.payments = {} # pay key -> the Pay request's fields
+        self.sent_ipns = set()
+        self.next_id = 1
+        self.stats = {'pay':0, 'pay_errors':0, 'approvals':0, 'cancels':0,
+                      'ipns':0, 'ipn_duplicates':0, 'ipn_failures':0,
+                      'verified':0, 'invalid':0}
+
+    def count(self, stat):
+        self.lock.acquire()
+        try:
+            self.stats[stat] += 1
+        finally:
+            self.lock.release()
+
+    def delay(self):
+        """ Sleep for one simulated network round trip. """
+        latency = random.gauss(self.options.latency, self.options.jitter)
+        if latency > 0:
+            time.sleep(latency)
+
+    def new_pay_key(self):
+        self.lock.acquire()
+        try:
+            pay_key = 'AP-SIM%012d' % self.next_id
+            self.next_id += 1
+            return pay_key
+        finally:
+            self.lock.release()
+
+    def build_ipn(self, pay_key, payment):
+        """ The IPN Paypal sends for a completed chained payment. """
+        fields = [('transaction_type', 'Adaptive Payment PAY'),
+                  ('status', 'COMPLETED'),
+                  ('pay_key', pay_key),
+                  ('sender_email', 'shopper@example.com'),
+                  ('action_type', 'PAY')]
+        i = 0
+        while 'receiverList.receiver(%d).email' % i in payment:
+            fields.append(('transaction[%d].receiver' % i, payment['receiverList.receiver(%d).email' % i]))
+            fields.append(('transaction[%d].amount' % i, 'USD ' + payment['receiverList.receiver(%d).amount' % i]))
+            fields.append(('transaction[%d].status' % i, 'Completed'))
+            fields.append(('transaction[%d].status_for_sender_txn' % i, 'Completed'))
+            i += 1
+        self.lock.acquire()
+        try:
+            self.sent_ipns.add(frozenset(fields))
+        finally:
+            self.lock.release()
+        return fields
+
+    def deliver_ipn(self, url, fields):
+        """ POST an IPN, retrying a few times like Paypal does. """
+        time.sleep(self.options.ipn_delay)
+        deliveries = 1
+        if random.random() < self.options.duplicate_rate:
+            deliveries = 2
+            self.count('ipn_duplicates')
+        for i in range(deliveries):
+            for attempt in range(4):
+                try:
+                    urllib2.urlopen(url, urllib.urlencode(fields), 30).read()
+                    self.count('ipns')
+                    break
+                except Exception, e:
+                    logging.warning('IPN to %s failed: %s' % (url, e))
+                    time.sleep(2 ** attempt)
+            else:
+                self.count('ipn_failures')
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves one request against the simulator. """
+    protocol_version = 'HTTP/1.0'
+
+    def respond(self, status, body='', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in (headers or []):
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_fields(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        return parse_qsl(self.rfile.read(length), keep_blank_values=True)
+
+    def do_POST(self):
+        path = urlparse.urlparse(self.path)[2]
+        if path == '/AdaptivePayments/Pay':
+            self.pay(dict(self.read_fields()))
+        elif path == '/cgi-bin/webscr':
+            self.notify_validate(self.read_fields())
+        else:
+            self.respond(404, 'Not Found')
+
+    def do_GET(self):
+        (scheme, netloc, path, params, query, fragment) = urlparse.urlparse(self.path)
+        fields = dict(parse_qsl(query))
+        if path == '/webscr' and fields.get('cmd') == '_ap-payment':
+            self.approve(fields.get('paykey'), fields.get('action') == 'cancel')
+        elif path == '/stats':
+            self.respond(200, '\n'.join(['%s %d' % item for item in sorted(self.server.simulator.stats.items())]))
+        else:
+            self.respond(404, 'Not Found')
+
+    def pay(self, fields):
+        simulator = self.server.simulator
+        simulator.count('pay')
+        simulator.delay()
+        if random.random() < simulator.options.error_rate:
+            simulator.count('pay_errors')
+            self.respond(503, 'Service Unavailable')
+            return
+        if 'receiverList.receiver(0).email' not in fields or 'ipnNotificationUrl' not in fields:
+            self.respond(200, urllib.urlencode([('responseEnvelope.ack', 'Failure'),
+                                                ('error(0).message', 'Invalid request')]))
+            return
+        pay_key = simulator.new_pay_key()
+        simulator.lock.acquire()
+        try:
+            simulator.payments[pay_key] = fields
+        finally:
+            simulator.lock.release()
+        self.respond(200, urllib.urlencode([('responseEnvelope.ack', 'Success'),
+                                            ('payKey', pay_key),
+                                            ('paymentExecStatus', 'CREATED')]))
+
+    def approve(self, pay_key, cancel):
+        simulator = self.server.simulator
+        payment = simulator.payments.get(pay_key)
+        if not payment:
+            self.respond(404, 'Unknown pay key')
+            return
+        if cancel:
+            simulator.count('cancels')
+            url = payment['cancelUrl']
+        else:
+            simulator.count('approvals')
+            url = payment['returnUrl']
+            fields = simulator.build_ipn(pay_key, payment)
+            thread = threading.Thread(target=simulator.deliver_ipn,
+                                      args=(payment['ipnNotificationUrl'], fields))
+            thread.setDaemon(True)
+            thread.start()
+        self.respond(302, '', [('Location', url.replace('${payKey}', pay_key))])
+
+    def notify_validate(self, fields):
+        simulator = self.server.simulator
+        simulator.delay()
+        fields = [(name, value) for (name, value) in fields if name != 'cmd']
+        if frozenset(fields) in simulator.sent_ipns:
+            simulator.count('verified')
+            self.respond(200, 'VERIFIED')
+        else:
+            simulator.count('invalid')
+            self.respond(200, 'INVALID')
+
+    def log_message(self, format, *args):
+        if self.server.simulator.options.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--port', type='int', default=8090)
+    parser.add_option('--latency', type='float', default=0.5, help='mean seconds per Paypal call')
+    parser.add_option('--jitter', type='float', default=0.1, help='standard deviation of the latency')
+    parser.add_option('--error-rate', type='float', default=0.0, help='fraction of Pay calls answered with a 503')
+    parser.add_option('--duplicate-rate', type='float', default=0.0, help='fraction of IPNs sent twice')
+    parser.add_option('--ipn-delay', type='float', default=1.0, help='seconds between approval and IPN')
+    parser.add_option('--verbose', action='store_true', default=False)
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = Server(('', options.port), Handler)
+    server.simulator = Simulator(options)
+    logging.info('Paypal simulator on port %d, GET /stats for counts' % options.port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()